@@ -0,0 +1,108 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csv
+import math
+import random
+
+from mishards.hash_ring import HashRing
+from mishards.router import bounded_load
+from mishards.router.metadata import file_load, SEARCHABLE_FILE_TYPES
+
+
+def load_dump(path, delimiter=','):
+    """Reads a `TableFiles` dump, e.g. the output of
+    `SELECT id, file_type, file_size, row_count FROM TableFiles`.
+
+    `id` is required, `file_type` is optional and at least one of `file_size`
+    or `row_count` should be present.
+    """
+    files = []
+    with open(path) as f:
+        for row in csv.DictReader(f, delimiter=delimiter):
+            file_type = row.get('file_type', None)
+            if file_type not in (None, '') and int(file_type) not in SEARCHABLE_FILE_TYPES:
+                continue
+            files.append((int(row['id']), file_load(row.get('file_size', 0), row.get('row_count', 0))))
+    return files
+
+
+def load_database(uri):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(uri)
+    with engine.connect() as conn:
+        rows = conn.execute(text('SELECT id, file_type, file_size, row_count FROM TableFiles'))
+        return [(int(file_id), file_load(file_size, row_count))
+                for file_id, file_type, file_size, row_count in rows
+                if file_type in SEARCHABLE_FILE_TYPES]
+
+
+def synthetic(files_num, seed=0, base_id=0):
+    # Segment sizes are heavily skewed: a few large IVF segments and many small ones
+    rng = random.Random(seed)
+    return [(base_id + i, int(rng.lognormvariate(20, 1.5))) for i in range(files_num)]
+
+
+def hash_assign(ring, nodes, files):
+    assignment = {}
+    loads = {node: 0 for node in nodes}
+    for (file_id, load), node in zip(files, ring.get_nodes([str(file_id) for file_id, _ in files])):
+        assignment[file_id] = node
+        loads[node] += load
+    return assignment, loads
+
+
+def moved(before, after):
+    return sum(1 for file_id, node in after.items() if before.get(file_id, node) != node)
+
+
+def simulate(name, strategy, files, nodes, added):
+    ring = HashRing(nodes)
+    assignment, loads = strategy(ring, nodes, files)
+
+    joined_nodes = nodes + ['node-{}'.format(len(nodes))]
+    joined, _ = strategy(HashRing(joined_nodes), joined_nodes, files)
+
+    left_nodes = nodes[1:]
+    left, _ = strategy(HashRing(left_nodes), left_nodes, files)
+
+    # Only files present before the new ones were flushed count as moved
+    grown, _ = strategy(ring, nodes, files + added)
+
+    print('{:<14} max/mean load: {:.3f}  moved on join: {:>6}  moved on leave: {:>6}  '
+          'moved on add: {:>6}'.format(name, bounded_load.load_ratio(loads), moved(assignment, joined),
+                                       moved(assignment, left), moved(assignment, grown)))
+
+
+def run(dump=None, uri=None, delimiter=',', nodes=8, epsilon=0.25, files_num=10000, seed=0,
+        add_ratio=0.01):
+    """Compares plain consistent hashing against bounded loads.
+
+    The files are read from a CSV `dump`, from the metadata database at `uri`,
+    or generated with skewed sizes if neither is given. Movement is measured
+    when a node joins, when one leaves and when `add_ratio` times as many new
+    files with skewed sizes are added.
+    """
+    if dump:
+        files = load_dump(dump, delimiter=delimiter)
+    elif uri:
+        files = load_database(uri)
+    else:
+        files = synthetic(files_num, seed=seed)
+
+    added = synthetic(int(math.ceil(len(files) * add_ratio)), seed=seed + 1,
+                      base_id=max([file_id for file_id, _ in files] or [0]) + 1)
+
+    node_names = ['node-{}'.format(i) for i in range(nodes)]
+    print('files: {}, added: {}, nodes: {}, epsilon: {}'.format(len(files), len(added), nodes, epsilon))
+
+    simulate('hash ring', hash_assign, files, node_names, added)
+    simulate('bounded load',
+             lambda ring, nodes, files: bounded_load.assign(ring, nodes, files, epsilon=epsilon),
+             files, node_names, added)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run)
@@ -0,0 +1,209 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import random
+import resource
+import multiprocessing
+import numpy as np
+from milvus.client.prepare import Prepare
+from milvus.grpc_gen import milvus_pb2, status_pb2
+
+from mishards import merge
+from mishards.grpc_utils import records
+
+
+def legacy_reduce(source_ids, ids, source_diss, diss, k, reverse):
+    if source_diss[k - 1] <= diss[0]:
+        return source_ids, source_diss
+    if diss[k - 1] <= source_diss[0]:
+        return ids, diss
+
+    source_diss.extend(diss)
+    diss_t = enumerate(source_diss)
+    diss_m_rst = sorted(diss_t, key=lambda x: x[1])[:k]
+    diss_m_out = [id_ for _, id_ in diss_m_rst]
+
+    source_ids.extend(ids)
+    id_m_out = [source_ids[i] for i, _ in diss_m_rst]
+
+    return id_m_out, diss_m_out
+
+
+def legacy_merge(results, topk, reverse=False):
+    merge_id_results = []
+    merge_dis_results = []
+    for result in results:
+        row_num = result.row_num
+        ids = result.ids
+        diss = result.distances
+        batch_len = len(ids) // row_num
+        for row_index in range(row_num):
+            id_batch = ids[row_index * batch_len: (row_index + 1) * batch_len]
+            dis_batch = diss[row_index * batch_len: (row_index + 1) * batch_len]
+            if len(merge_id_results) == row_index:
+                merge_id_results.append(id_batch)
+                merge_dis_results.append(dis_batch)
+            else:
+                merge_id_results[row_index], merge_dis_results[row_index] = \
+                    legacy_reduce(merge_id_results[row_index], id_batch,
+                                  merge_dis_results[row_index], dis_batch,
+                                  batch_len, reverse)
+
+    id_list = []
+    dis_list = []
+    for id_results, dis_results in zip(merge_id_results, merge_dis_results):
+        id_list.extend(id_results)
+        dis_list.extend(dis_results)
+    return id_list, dis_list
+
+
+def unpack(results):
+    id_arrays = []
+    dis_arrays = []
+    for result in results:
+        ids, diss = merge.as_topk_arrays(result)
+        id_arrays.append(ids)
+        dis_arrays.append(diss)
+    return id_arrays, dis_arrays
+
+
+def numpy_merge(results, topk, reverse=False):
+    id_arrays, dis_arrays = unpack(results)
+    ids, diss = merge.merge_topk(id_arrays, dis_arrays, topk, reverse=reverse)
+    return ids.ravel().tolist(), diss.ravel().tolist()
+
+
+def fake_results(nq, topk, shards, reverse=False):
+    results = []
+    for shard in range(shards):
+        distances = np.sort(np.random.random((nq, topk)).astype(np.float32), axis=1)
+        if reverse:
+            distances = distances[:, ::-1]
+        ids = np.random.randint(0, 1 << 40, size=(nq, topk), dtype=np.int64)
+        results.append(milvus_pb2.TopKQueryResult(
+            status=status_pb2.Status(error_code=status_pb2.SUCCESS),
+            row_num=nq,
+            ids=ids.ravel().tolist(),
+            distances=distances.ravel().tolist()))
+    return results
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def assemble_lists(status, nq, ids, distances):
+    # The reply path before results were kept as arrays
+    return milvus_pb2.TopKQueryResult(status=status, row_num=nq,
+                                      ids=ids.ravel().tolist(),
+                                      distances=distances.ravel().tolist()).SerializeToString()
+
+
+def assemble_arrays(status, nq, ids, distances):
+    return records.topk_query_result(status, nq, ids.ravel(), distances.ravel()).SerializeToString()
+
+
+def rss_mb():
+    # Current resident set size, ru_maxrss only tracks the peak
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / float(1 << 20)
+
+
+def measure_assembly(method, nq, topk):
+    """Runs in a fresh process: returns the assembly time and how far the
+    peak RSS rose above the RSS before assembling, in MB.
+    """
+    status = status_pb2.Status(error_code=status_pb2.SUCCESS, reason='Success')
+    ids = np.random.randint(0, 1 << 40, size=(nq, topk), dtype=np.int64)
+    distances = np.random.random((nq, topk)).astype(np.float32)
+    before = rss_mb()
+    start = time.time()
+    globals()[method](status, nq, ids, distances)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return elapsed, max(peak - before, 0)
+
+
+def assembly(nq, topk):
+    ctx = multiprocessing.get_context('spawn')
+    print('response assembly ({} protobuf backend):'.format('native' if records.SERIALIZED_COPY else 'python'))
+    for method in ('assemble_lists', 'assemble_arrays'):
+        with ctx.Pool(1) as pool:
+            elapsed, rss = pool.apply(measure_assembly, (method, nq, topk))
+        print('    {:<16} {:.4f}s, peak RSS +{:.1f}MB'.format(method, elapsed, rss))
+
+
+def search_request(nq, dim):
+    param = milvus_pb2.SearchParam(collection_name='c', topk=10)
+    for row in np.random.random((nq, dim)).astype(np.float32):
+        param.query_record_array.add(float_data=row.tolist())
+    return param
+
+
+def parse_lists(param):
+    # The request path before query rows were packed
+    return [list(record.float_data) for record in param.query_record_array]
+
+
+def parse_packed(param):
+    return records.pack_records(param.query_record_array)
+
+
+def forward(query_records):
+    # The SDK still builds every outgoing row with `add(float_data=row)`
+    return Prepare.search_param('c', 10, records.sdk_query_records(query_records), [], {}).SerializeToString()
+
+
+def packing(nq, dim, repeat=3):
+    param = search_request(nq, dim)
+    print('query packing nq={} dim={} ({} protobuf backend):'.format(
+        nq, dim, 'native' if records.SERIALIZED_COPY else 'python'))
+    totals = {}
+    for name, parse in (('lists', parse_lists), ('packed', parse_packed)):
+        parse_time = timeit(parse, param, repeat=repeat)
+        forward_time = timeit(forward, parse(param), repeat=repeat)
+        totals[name] = parse_time + forward_time
+        print('    {:<8} parse: {:.4f}s, forward: {:.4f}s'.format(name, parse_time, forward_time))
+    print('    speedup: parse+forward {:.1f}x'.format(totals['lists'] / totals['packed']))
+
+
+def run(nq=1000, topk=1000, shards=20, repeat=3, legacy=True, dim=128):
+    """Compare the numpy merge engine with the legacy per-row merge.
+
+    The legacy path is ascending-only, so only the L2 case is timed for it.
+    """
+    results = fake_results(nq, topk, shards)
+    print('nq={} topk={} shards={}'.format(nq, topk, shards))
+
+    numpy_time = timeit(numpy_merge, results, topk, repeat=repeat)
+    print('numpy  merge (L2): {:.4f}s'.format(numpy_time))
+
+    id_arrays, dis_arrays = unpack(results)
+    unpack_time = timeit(unpack, results, repeat=repeat)
+    reduce_time = timeit(merge.merge_topk, id_arrays, dis_arrays, topk, repeat=repeat)
+    print('    unpack protobuf: {:.4f}s, reduce: {:.4f}s'.format(unpack_time, reduce_time))
+
+    ip_results = fake_results(nq, topk, shards, reverse=True)
+    numpy_ip_time = timeit(numpy_merge, ip_results, topk, reverse=True, repeat=repeat)
+    print('numpy  merge (IP): {:.4f}s'.format(numpy_ip_time))
+
+    if legacy:
+        legacy_time = timeit(legacy_merge, results, topk, repeat=repeat)
+        print('legacy merge (L2): {:.4f}s'.format(legacy_time))
+        print('speedup: {:.1f}x'.format(legacy_time / numpy_time))
+
+    assembly(nq, topk)
+    packing(nq, dim, repeat=repeat)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(run)
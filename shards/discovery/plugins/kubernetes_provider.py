@@ -7,7 +7,6 @@ if __name__ == '__main__':
 import re
 import logging
 import time
-import copy
 import threading
 import queue
 import enum
@@ -23,7 +22,6 @@ INCLUSTER_NAMESPACE_PATH = '/var/run/secrets/kubernetes.io/serviceaccount/namesp
 
 class EventType(enum.Enum):
     PodHeartBeat = 1
-    Watch = 2
 
 
 class K8SMixin:
@@ -41,8 +39,21 @@ class K8SMixin:
             self.v1 = client.CoreV1Api()
 
 
-class K8SHeartbeatHandler(threading.Thread, K8SMixin):
-    name = 'kubernetes'
+class K8SPodInformer(threading.Thread, K8SMixin):
+    """Keeps a local cache of the pods matching `label_selector`.
+
+    The pods are listed once, then a single watch started from the
+    resourceVersion of the list keeps the cache up to date. The watch is
+    resumed from the last seen resourceVersion every `resync_interval`
+    seconds, when the whole cache is replayed to the event handler. The pods
+    are listed again if the resourceVersion expired (410 Gone), after an
+    error and every `relist_interval` seconds.
+
+    Watch events only update the cache. A `PodHeartBeat` event holding all
+    cached pods is put into `message_queue` once every `resync_interval`
+    seconds, so the event handler's thresholds keep counting intervals, and
+    right after every list, so a pod missing from it is dropped at once.
+    """
 
     def __init__(self,
                  message_queue,
@@ -54,85 +65,106 @@ class K8SHeartbeatHandler(threading.Thread, K8SMixin):
                           namespace=namespace,
                           in_cluster=in_cluster,
                           **kwargs)
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='K8SPodInformer', daemon=True)
         self.queue = message_queue
         self.terminate = False
         self.label_selector = label_selector
-        self.poll_interval = kwargs.get('poll_interval', 5)
+        self.resync_interval = kwargs.get('resync_interval', 5)
+        self.relist_interval = kwargs.get('relist_interval', 300)
+        self.watch_class = kwargs.get('watch_class', watch.Watch)
+        self.pods = {}
+        self.resource_version = None
+        self.last_list = 0
+        self.last_publish = 0
+        self.watcher = None
+
+    @staticmethod
+    def pod_event(pod):
+        return dict(pod=pod.metadata.name,
+                    ip=pod.status.pod_ip,
+                    ready=pod.status.phase == 'Running' and not pod.metadata.deletion_timestamp,
+                    reason=pod.status.reason,
+                    message=pod.status.message)
+
+    def publish(self):
+        self.queue.put({'eType': EventType.PodHeartBeat, 'events': list(self.pods.values())})
+
+    def heartbeat(self, force=False):
+        """Publishes the cache if `resync_interval` seconds passed since the last
+        time, or at once with `force`.
+        """
+        now = time.time()
+        if not force and now - self.last_publish < self.resync_interval:
+            return False
+        self.last_publish = now
+        self.publish()
+        return True
+
+    def relist(self):
+        pods = self.v1.list_namespaced_pod(namespace=self.namespace,
+                                           label_selector=self.label_selector)
+        self.pods = {pod.metadata.name: self.pod_event(pod) for pod in pods.items}
+        self.resource_version = pods.metadata.resource_version
+        self.last_list = time.time()
+        logger.debug('Listed {} pods at resourceVersion {}'.format(len(self.pods), self.resource_version))
+
+    def apply(self, event):
+        """Applies a watch event to the cache. Returns False if the watch has
+        to be restarted from a new list.
+        """
+        if event['type'] == 'ERROR':
+            raw = event.get('raw_object', None) or {}
+            logger.warning('Pod watch error: {}'.format(raw.get('message', raw)))
+            self.resource_version = None
+            return False
+
+        pod = event['object']
+        self.resource_version = pod.metadata.resource_version
+        if event['type'] == 'DELETED':
+            self.pods.pop(pod.metadata.name, None)
+        elif event['type'] in ('ADDED', 'MODIFIED'):
+            self.pods[pod.metadata.name] = self.pod_event(pod)
+        return True
+
+    def watch_once(self):
+        self.watcher = self.watch_class()
+        for event in self.watcher.stream(self.v1.list_namespaced_pod,
+                                         namespace=self.namespace,
+                                         label_selector=self.label_selector,
+                                         resource_version=self.resource_version,
+                                         timeout_seconds=self.resync_interval):
+            if self.terminate or not self.apply(event):
+                self.watcher.stop()
+                break
+            self.heartbeat()
+
+    def step(self):
+        if self.resource_version is None or time.time() - self.last_list >= self.relist_interval:
+            self.relist()
+            self.heartbeat(force=True)
+        try:
+            self.watch_once()
+        except client.rest.ApiException as exc:
+            if exc.status != 410:
+                raise
+            logger.info('Pod resourceVersion {} expired'.format(self.resource_version))
+            self.resource_version = None
+        if self.resource_version is not None:
+            # Resync: replay the cache so missed transitions are reconciled
+            self.heartbeat()
 
     def run(self):
         while not self.terminate:
             try:
-                pods = self.v1.list_namespaced_pod(
-                    namespace=self.namespace,
-                    label_selector=self.label_selector)
-                event_message = {'eType': EventType.PodHeartBeat, 'events': []}
-                for item in pods.items:
-                    pod = self.v1.read_namespaced_pod(name=item.metadata.name,
-                                                      namespace=self.namespace)
-                    name = pod.metadata.name
-                    ip = pod.status.pod_ip
-                    phase = pod.status.phase
-                    reason = pod.status.reason
-                    message = pod.status.message
-                    ready = True if phase == 'Running' else False
-
-                    pod_event = dict(pod=name,
-                                     ip=ip,
-                                     ready=ready,
-                                     reason=reason,
-                                     message=message)
-
-                    event_message['events'].append(pod_event)
-
-                self.queue.put(event_message)
-
+                self.step()
             except Exception as exc:
                 logger.error(exc)
-
-            time.sleep(self.poll_interval)
+                self.resource_version = None
+                time.sleep(1)
 
     def stop(self):
         self.terminate = True
-
-
-class K8SEventListener(threading.Thread, K8SMixin):
-    def __init__(self, message_queue, namespace, in_cluster=False, **kwargs):
-        K8SMixin.__init__(self,
-                          namespace=namespace,
-                          in_cluster=in_cluster,
-                          **kwargs)
-        threading.Thread.__init__(self)
-        self.queue = message_queue
-        self.terminate = False
-        self.at_start_up = True
-        self._stop_event = threading.Event()
-
-    def stop(self):
-        self.terminate = True
-        self._stop_event.set()
-
-    def run(self):
-        resource_version = ''
-        w = watch.Watch()
-        for event in w.stream(self.v1.list_namespaced_event,
-                              namespace=self.namespace,
-                              field_selector='involvedObject.kind=Pod'):
-            if self.terminate:
-                break
-
-            resource_version = int(event['object'].metadata.resource_version)
-
-            info = dict(
-                eType=EventType.Watch,
-                pod=event['object'].involved_object.name,
-                reason=event['object'].reason,
-                message=event['object'].message,
-                start_up=self.at_start_up,
-            )
-            self.at_start_up = False
-            # logger.info('Received event: {}'.format(info))
-            self.queue.put(info)
+        self.watcher and self.watcher.stop()
 
 
 class EventHandler(threading.Thread):
@@ -171,56 +203,37 @@ class EventHandler(threading.Thread):
     def on_drop(self, event, **kwargs):
         pass
 
-    def on_pod_started(self, event, **kwargs):
-        try_cnt = 3
-        pod = None
-        while try_cnt > 0:
-            try_cnt -= 1
-            try:
-                pod = self.mgr.v1.read_namespaced_pod(name=event['pod'],
-                                                      namespace=self.namespace)
-                if not pod.status.pod_ip:
-                    time.sleep(0.5)
-                    continue
-                break
-            except client.rest.ApiException as exc:
-                time.sleep(0.5)
-
-        if try_cnt <= 0 and not pod:
-            if not event['start_up']:
-                logger.warning('Pod {} is started but cannot read pod'.format(
-                    event['pod']))
-            return
-        elif try_cnt <= 0 and not pod.status.pod_ip:
-            logger.warning('NoPodIPFoundError')
-            return
-
-        self.record_pending_add(pod.metadata.name,
-                true_cb=partial(self.mgr.add_pod, pod.metadata.name, pod.status.pod_ip))
-
-    def on_pod_killing(self, event, **kwargs):
-        self.record_pending_delete(event['pod'],
-                true_cb=partial(self.mgr.delete_pod, event['pod']))
+    def known_pods(self):
+        # Ejected pods are still known, they have to be deleted once gone
+        snapshot = self.mgr.readonly_topo.snapshot
+        return set(snapshot.groups) | set(snapshot.ejected)
 
     def on_pod_heartbeat(self, event, **kwargs):
-        names = set(copy.deepcopy(list(self.mgr.readonly_topo.group_names)))
+        names = self.known_pods()
 
         pods_with_event = set()
+        pods_to_add = {}
         for each_event in event['events']:
             pods_with_event.add(each_event['pod'])
             if each_event['ready']:
                 self.record_pending_add(each_event['pod'],
-                    true_cb=partial(self.mgr.add_pod, each_event['pod'], each_event['ip']))
+                    true_cb=partial(pods_to_add.__setitem__, each_event['pod'], each_event['ip']))
             else:
                 self.record_pending_delete(each_event['pod'],
                     true_cb=partial(self.mgr.delete_pod, each_event['pod']))
 
+        # New pods are probed concurrently and added in one batch
+        pods_to_add = {pod: ip for pod, ip in pods_to_add.items()
+                       if not self.mgr.readonly_topo.has_group(pod)}
+        if pods_to_add:
+            self.mgr.add_pods(pods_to_add)
+
         pods_no_event = names - pods_with_event
         for name in pods_no_event:
             self.record_pending_delete(name,
                     true_cb=partial(self.mgr.delete_pod, name))
 
-        latest = self.mgr.readonly_topo.group_names
+        latest = self.known_pods()
         deleted = names - latest
         added = latest - names
         if deleted:
@@ -231,21 +244,10 @@ class EventHandler(threading.Thread):
         logger.debug('All Pods: {}'.format(list(latest)))
 
     def handle_event(self, event):
-        if event['eType'] == EventType.PodHeartBeat:
+        if event and event['eType'] == EventType.PodHeartBeat:
             return self.on_pod_heartbeat(event)
 
-        if not event or (event['reason'] not in ('Started', 'Killing')):
-            return self.on_drop(event)
-
-        if not re.match(self.pod_patt, event['pod']):
-            return self.on_drop(event)
-
-        logger.info('Handling event: {}'.format(event))
-
-        if event['reason'] == 'Started':
-            return self.on_pod_started(event)
-
-        return self.on_pod_killing(event)
+        return self.on_drop(event)
 
     def run(self):
         while not self.terminate:
@@ -278,6 +280,8 @@ class KubernetesProvider(object):
         self.in_cluster = self.in_cluster == 'true'
         self.poll_interval = config.DISCOVERY_KUBERNETES_POLL_INTERVAL
         self.poll_interval = int(self.poll_interval) if self.poll_interval else 5
+        self.relist_interval = config.DISCOVERY_KUBERNETES_RELIST_INTERVAL
+        self.relist_interval = int(self.relist_interval) if self.relist_interval else 300
         self.port = config.DISCOVERY_KUBERNETES_PORT
         self.port = int(self.port) if self.port else 19530
         self.kwargs = kwargs
@@ -292,20 +296,14 @@ class KubernetesProvider(object):
         ) if self.in_cluster else kconfig.load_kube_config()
         self.v1 = client.CoreV1Api()
 
-        self.listener = K8SEventListener(message_queue=self.queue,
-                                         namespace=self.namespace,
-                                         in_cluster=self.in_cluster,
-                                         v1=self.v1,
-                                         **kwargs)
-
-        self.pod_heartbeater = K8SHeartbeatHandler(
-            message_queue=self.queue,
-            namespace=self.namespace,
-            label_selector=self.label_selector,
-            in_cluster=self.in_cluster,
-            v1=self.v1,
-            poll_interval=self.poll_interval,
-            **kwargs)
+        self.informer = K8SPodInformer(message_queue=self.queue,
+                                       namespace=self.namespace,
+                                       label_selector=self.label_selector,
+                                       in_cluster=self.in_cluster,
+                                       v1=self.v1,
+                                       resync_interval=self.poll_interval,
+                                       relist_interval=self.relist_interval,
+                                       **kwargs)
 
         self.event_handler = EventHandler(mgr=self,
                                           message_queue=self.queue,
@@ -314,38 +312,28 @@ class KubernetesProvider(object):
                                           **kwargs)
 
     def add_pod(self, name, ip):
-        logger.debug('Register POD {} with IP {}'.format(
-            name, ip))
-        ok = True
-        status = StatusType.OK
-        try:
-            uri = 'tcp://{}:{}'.format(ip, self.port)
-            status, group = self.readonly_topo.create(name=name)
-            if status == StatusType.OK:
-                status, pool = group.create(name=name, uri=uri)
-        except ConnectionConnectError as exc:
-            ok = False
-            logger.error('Connection error to: {}'.format(addr))
-
-        # if ok and status == StatusType.OK:
-        #     logger.info('KubernetesProvider Add Group \"{}\" Of 1 Address: {}'.format(name, uri))
-        return ok
+        return self.add_pods({name: ip})
+
+    def add_pods(self, pods):
+        """Connects to the `{name: ip}` pods concurrently and adds the ones
+        which answered at once.
+        """
+        logger.debug('Register PODs {}'.format(pods))
+        statuses = self.readonly_topo.create_many(
+            {name: 'tcp://{}:{}'.format(ip, self.port) for name, ip in pods.items()})
+        return all(status in (StatusType.OK, StatusType.DUPLICATED) for status in statuses.values())
 
     def delete_pod(self, name):
-        pool = self.readonly_topo.delete_group(name)
+        self.readonly_topo.retire(name)
         return True
 
     def start(self):
-        self.listener.daemon = True
-        self.listener.start()
         self.event_handler.start()
-
-        self.pod_heartbeater.start()
+        self.informer.start()
         return True
 
     def stop(self):
-        self.listener.stop()
-        self.pod_heartbeater.stop()
+        self.informer.stop()
         self.event_handler.stop()
 
     @classmethod
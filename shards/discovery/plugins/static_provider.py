@@ -6,7 +6,6 @@ if __name__ == '__main__':
 import logging
 import socket
 from environs import Env
-from mishards.exceptions import ConnectionConnectError
 from mishards.topology import StatusType
 
 logger = logging.getLogger(__name__)
@@ -34,39 +33,35 @@ class StaticDiscovery(object):
         self.hosts = [resolve_address(host, self.port) for host in hosts]
 
     def start(self):
-        ok = True
-        for host in self.hosts:
-            ok &= self.add_pod(host, host)
-            if not ok: break
-        if ok and len(self.hosts) == 0:
+        if len(self.hosts) == 0:
             logger.error('No address is specified')
-            ok = False
-        return ok
+            return False
+        return self.add_pods({host: host for host in self.hosts})
 
     def stop(self):
         for host in self.hosts:
             self.delete_pod(host)
 
-    def add_pod(self, name, addr):
+    def add_pods(self, addrs):
+        """Connects to the `{name: addr}` pods concurrently and adds the ones
+        which answered at once.
+        """
+        statuses = self.readonly_topo.create_many(
+            {name: 'tcp://{}'.format(addr) for name, addr in addrs.items()})
         ok = True
-        status = StatusType.OK
-        try:
-            uri = 'tcp://{}'.format(addr)
-            status, group = self.readonly_topo.create(name=name)
+        for name, status in statuses.items():
             if status == StatusType.OK:
-                status, pool = group.create(name=name, uri=uri)
-            if status not in (StatusType.OK, StatusType.DUPLICATED):
+                logger.info('StaticDiscovery Add Static Group \"{}\" Of 1 Address: {}'.format(name, addrs[name]))
+            elif status != StatusType.DUPLICATED:
+                logger.error('Connection error to: {}'.format(addrs[name]))
                 ok = False
-        except ConnectionConnectError as exc:
-            ok = False
-            logger.error('Connection error to: {}'.format(addr))
-
-        if ok and status == StatusType.OK:
-            logger.info('StaticDiscovery Add Static Group \"{}\" Of 1 Address: {}'.format(name, addr))
         return ok
 
+    def add_pod(self, name, addr):
+        return self.add_pods({name: addr})
+
     def delete_pod(self, name):
-        pool = self.readonly_topo.delete_group(name)
+        self.readonly_topo.retire(name)
         return True
 
     @classmethod
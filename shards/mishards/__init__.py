@@ -30,17 +30,65 @@ def create_app(testing_config=None):
                                                              plugin_config=settings.TracingConfig,
                                                              span_decorator=GrpcSpanDecorator())
 
+    mirror = None
+    if config.METADATA_MIRROR_ENABLED:
+        from mishards.router.mirror import MetadataMirror
+        mirror = MetadataMirror(poll_interval=config.METADATA_MIRROR_POLL_INTERVAL,
+                                resync_interval=config.METADATA_MIRROR_RESYNC_INTERVAL)
+
     from mishards.router.factory import RouterFactory
     router = RouterFactory(config.ROUTER_PLUGIN_PATH).create(config.ROUTER_CLASS_NAME,
                                                              readonly_topo=readonly_topo,
-                                                             writable_topo=writable_topo)
+                                                             writable_topo=writable_topo,
+                                                             mirror=mirror)
+
+    if settings.NODE_WARMUP_ENABLED:
+        from mishards.warmup import NodeWarmer
+        readonly_topo.warmer = NodeWarmer(router, timeout=settings.NODE_WARMUP_TIMEOUT,
+                                          drain_timeout=settings.NODE_DRAIN_TIMEOUT,
+                                          batch_size=settings.SEGMENT_RELOAD_BATCH_SIZE)
+
+    if settings.CIRCUIT_BREAKER_ENABLED:
+        from mishards.breaker import HealthMonitor
+        readonly_topo.monitor = HealthMonitor(readonly_topo,
+                                              failures=settings.CIRCUIT_BREAKER_FAILURES,
+                                              error_rate=settings.CIRCUIT_BREAKER_ERROR_RATE,
+                                              timeout_rate=settings.CIRCUIT_BREAKER_TIMEOUT_RATE,
+                                              reset_timeout=settings.CIRCUIT_BREAKER_RESET_TIMEOUT)
+
+    admission = None
+    if settings.ADMISSION_ENABLED:
+        from mishards.admission import AdmissionController
+        admission = AdmissionController(search_capacity=settings.ADMISSION_SEARCH_CAPACITY,
+                                        write_limit=settings.ADMISSION_WRITE_LIMIT,
+                                        admin_limit=settings.ADMISSION_ADMIN_LIMIT,
+                                        max_wait=settings.ADMISSION_MAX_WAIT,
+                                        max_queue=settings.ADMISSION_MAX_QUEUE,
+                                        client_rate=settings.ADMISSION_CLIENT_RATE,
+                                        client_burst=settings.ADMISSION_CLIENT_BURST,
+                                        search_limit=settings.ADMISSION_SEARCH_LIMIT,
+                                        max_threads=settings.MAX_WORKERS)
 
     grpc_server.init_app(writable_topo=writable_topo,
                          readonly_topo=readonly_topo,
                          tracer=tracer,
                          router=router,
                          discover=discover,
-                         max_workers=settings.MAX_WORKERS)
+                         max_workers=settings.MAX_WORKERS,
+                         max_search_workers=settings.MAX_SEARCH_WORKERS,
+                         hedge_percentile=settings.SEARCH_HEDGE_PERCENTILE if settings.SEARCH_HEDGE_ENABLED else None,
+                         search_batch_window=settings.SEARCH_BATCH_WINDOW,
+                         search_batch_size=settings.SEARCH_BATCH_SIZE,
+                         metadata_cache_ttl=settings.METADATA_CACHE_TTL,
+                         metadata_cache_size=settings.METADATA_CACHE_SIZE,
+                         segment_reload_interval=settings.SEGMENT_RELOAD_INTERVAL,
+                         segment_reload_batch_size=settings.SEGMENT_RELOAD_BATCH_SIZE,
+                         async_mode=settings.SERVER_ASYNC_MODE,
+                         reuse_port=settings.SERVER_WORKERS > 1,
+                         admission=admission)
+
+    if mirror:
+        grpc_server.register_pre_run_handler(mirror.start)
 
     from mishards import exception_handlers
 
@@ -0,0 +1,317 @@
+import time
+import heapq
+import logging
+import asyncio
+import itertools
+import threading
+from functools import wraps
+from collections import OrderedDict
+import grpc
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionQueue:
+    """Admission of one class of RPCs.
+
+    Requests run as long as the cost in flight stays within `capacity` and,
+    with a `limit`, no more than `limit` of them run at once. A request
+    costing more than the capacity runs alone. Waiting requests are admitted
+    cheapest first, so a burst of heavy requests does not hold up light
+    ones. A request which could not be admitted within `max_wait` seconds, or
+    finds `max_queue` requests waiting already, is shed.
+
+    Requests of the threaded server wait in `acquire`, holding their thread,
+    those of the asyncio server in `acquire_async` on the event loop.
+    """
+
+    def __init__(self, name, capacity, max_wait=1, max_queue=16, limit=None, lock=None):
+        self.name = name
+        self.capacity = capacity
+        self.limit = limit
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.cv = threading.Condition(lock)
+        self.inflight = 0
+        self.running = 0
+        self.waiting = []
+        # Threads held by requests admitted or waiting in `acquire`
+        self.threads = 0
+        # (loop, event) of the requests waiting in `acquire_async`
+        self.wakers = set()
+        self.sequence = itertools.count()
+        self.admitted = REGISTRY.counter('admission.{}.admitted'.format(name))
+        self.shed = REGISTRY.counter('admission.{}.shed'.format(name))
+        self.wait_time = REGISTRY.histogram('admission.{}.wait'.format(name))
+        REGISTRY.gauge('admission.{}.inflight'.format(name), func=lambda: self.inflight)
+        REGISTRY.gauge('admission.{}.queue_depth'.format(name), func=lambda: len(self.waiting))
+
+    def _fits_no_lock(self, cost):
+        if self.limit is not None and self.running >= self.limit:
+            return False
+        return self.inflight == 0 or self.inflight + cost <= self.capacity
+
+    def _admit_no_lock(self, cost, started):
+        self.inflight += cost
+        self.running += 1
+        self.admitted.inc()
+        self.wait_time.observe(time.time() - started)
+        return True
+
+    def _notify_no_lock(self):
+        self.cv.notify_all()
+        for loop, event in self.wakers:
+            loop.call_soon_threadsafe(event.set)
+
+    def acquire(self, cost, wait=True):
+        """Waits until a request of `cost` is admitted. Returns False if it
+        was shed. Without `wait` a request which cannot run at once is shed.
+        """
+        started = time.time()
+        deadline = started + self.max_wait
+        with self.cv:
+            self.threads += 1
+            if not self.waiting and self._fits_no_lock(cost):
+                return self._admit_no_lock(cost, started)
+            if not wait or len(self.waiting) >= self.max_queue:
+                self.threads -= 1
+                self.shed.inc()
+                return False
+
+            entry = [cost, next(self.sequence)]
+            heapq.heappush(self.waiting, entry)
+            while True:
+                if self.waiting[0] is entry and self._fits_no_lock(cost):
+                    heapq.heappop(self.waiting)
+                    # The next request may fit as well
+                    self._notify_no_lock()
+                    return self._admit_no_lock(cost, started)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self._notify_no_lock()
+                    self.threads -= 1
+                    self.shed.inc()
+                    return False
+                self.cv.wait(remaining)
+
+    async def acquire_async(self, cost):
+        """`acquire` for a coroutine, which waits on its event loop.
+        """
+        started = time.time()
+        deadline = started + self.max_wait
+        with self.cv:
+            if not self.waiting and self._fits_no_lock(cost):
+                return self._admit_no_lock(cost, started)
+            if len(self.waiting) >= self.max_queue:
+                self.shed.inc()
+                return False
+            entry = [cost, next(self.sequence)]
+            heapq.heappush(self.waiting, entry)
+
+        waker = (asyncio.get_event_loop(), asyncio.Event())
+        admitted = False
+        try:
+            while True:
+                with self.cv:
+                    if self.waiting[0] is entry and self._fits_no_lock(cost):
+                        heapq.heappop(self.waiting)
+                        admitted = True
+                        self._notify_no_lock()
+                        return self._admit_no_lock(cost, started)
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.shed.inc()
+                        return False
+                    waker[1].clear()
+                    self.wakers.add(waker)
+                try:
+                    await asyncio.wait_for(waker[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self.cv:
+                        self.wakers.discard(waker)
+        finally:
+            # Shed, or the request was cancelled while waiting
+            if not admitted:
+                with self.cv:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self._notify_no_lock()
+
+    def release(self, cost, thread=True):
+        with self.cv:
+            self.inflight -= cost
+            self.running -= 1
+            if thread:
+                self.threads -= 1
+            self._notify_no_lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def take(self, tokens=1):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class AdmissionController:
+    """Admission control in front of the gRPC methods of the service handler.
+
+    RPCs are split into the `search`, `write` and `admin` classes, each with
+    its own `AdmissionQueue`. A search costs its nq x topk, so the capacity
+    of the search class is the number of result entries being searched for
+    at once; the other RPCs cost one, their capacity is a concurrency limit.
+
+    On the threaded server admitted and waiting requests both hold a server
+    thread. With `max_threads`, the size of the server's thread pool, a
+    request which cannot run at once is shed instead of waiting when that
+    would leave no thread free, and `search_limit` keeps searches alone from
+    taking every thread. On the asyncio server requests wait on the event
+    loop and hold no thread, `max_threads` does not apply there.
+
+    With a `client_rate`, every client, named by the `client-id` request
+    metadata or else by its address, is allowed that many requests per
+    second with bursts of up to `client_burst`. Rejected requests fail with
+    RESOURCE_EXHAUSTED.
+    """
+
+    SEARCH_METHODS = {'Search', 'SearchInFiles', 'SearchByID', 'GetVectorsByID'}
+    WRITE_METHODS = {'Insert', 'DeleteByID', 'Flush', 'Compact', 'CreateIndex', 'PreloadCollection'}
+    # Clients whose token buckets are kept
+    MAX_CLIENTS = 10000
+
+    def __init__(self, search_capacity=1000000, write_limit=8, admin_limit=16, max_wait=1,
+                 max_queue=16, client_rate=0, client_burst=None, search_limit=None, max_threads=None):
+        self.max_threads = max_threads
+        # Shared by the queues, so their thread counts are read together
+        self.lock = threading.Lock()
+        self.queues = {
+            'search': AdmissionQueue('search', search_capacity, max_wait=max_wait, max_queue=max_queue,
+                                     limit=search_limit, lock=self.lock),
+            'write': AdmissionQueue('write', write_limit, max_wait=max_wait, max_queue=max_queue,
+                                    lock=self.lock),
+            'admin': AdmissionQueue('admin', admin_limit, max_wait=max_wait, max_queue=max_queue,
+                                    lock=self.lock),
+        }
+        self.client_rate = client_rate
+        self.client_burst = client_burst or max(client_rate, 1)
+        self.buckets = OrderedDict()
+        self.rate_limited = REGISTRY.counter('admission.rate_limited')
+
+    def threads(self):
+        """Server threads held by admitted and waiting requests.
+        """
+        with self.lock:
+            return sum(queue.threads for queue in self.queues.values())
+
+    def rpc_class(self, method_name):
+        if method_name in self.SEARCH_METHODS:
+            return 'search'
+        if method_name in self.WRITE_METHODS:
+            return 'write'
+        return 'admin'
+
+    def cost(self, rpc_class, request):
+        if rpc_class != 'search':
+            return 1
+        nq = len(getattr(request, 'query_record_array', ()) or getattr(request, 'id_array', ()))
+        return max(nq, 1) * max(getattr(request, 'topk', 1), 1)
+
+    @staticmethod
+    def client_id(context):
+        if context is None:
+            return None
+        for key, value in context.invocation_metadata() or ():
+            if key == 'client-id':
+                return value
+        # E.g. ipv4:10.0.0.1:53412, the port differs per connection
+        return context.peer().rsplit(':', 1)[0]
+
+    def _rate_limit(self, client):
+        if not self.client_rate or client is None:
+            return True
+        with self.lock:
+            bucket = self.buckets.get(client, None)
+            if bucket is None:
+                bucket = self.buckets[client] = TokenBucket(self.client_rate, self.client_burst)
+                while len(self.buckets) > self.MAX_CLIENTS:
+                    self.buckets.popitem(last=False)
+            self.buckets.move_to_end(client)
+            return bucket.take()
+
+    def admit(self, method_name, request, context):
+        """Returns `(queue, cost, None)` for an admitted request, which has
+        to be released once done, or `(None, 0, reason)` for a rejected one.
+        """
+        client = self.client_id(context)
+        if not self._rate_limit(client):
+            self.rate_limited.inc()
+            return None, 0, 'Rate limit of client {} exceeded'.format(client)
+
+        rpc_class = self.rpc_class(method_name)
+        queue = self.queues[rpc_class]
+        cost = self.cost(rpc_class, request)
+        # The thread of this request itself must not be the last free one
+        wait = self.max_threads is None or self.threads() + 1 < self.max_threads
+        if not queue.acquire(cost, wait=wait):
+            logger.warning('{} of {} shed, {} requests are waiting'.format(method_name, client, len(queue.waiting)))
+            if not wait:
+                return None, 0, 'Server busy: no thread is free to queue the {} request'.format(rpc_class)
+            return None, 0, 'Server busy: {} request was not admitted within {}s'.format(rpc_class, queue.max_wait)
+        return queue, cost, None
+
+    async def admit_async(self, method_name, request, context):
+        """`admit` for the asyncio server.
+        """
+        client = self.client_id(context)
+        if not self._rate_limit(client):
+            self.rate_limited.inc()
+            return None, 0, 'Rate limit of client {} exceeded'.format(client)
+
+        rpc_class = self.rpc_class(method_name)
+        queue = self.queues[rpc_class]
+        cost = self.cost(rpc_class, request)
+        if not await queue.acquire_async(cost):
+            logger.warning('{} of {} shed, {} requests are waiting'.format(method_name, client, len(queue.waiting)))
+            return None, 0, 'Server busy: {} request was not admitted within {}s'.format(rpc_class, queue.max_wait)
+        return queue, cost, None
+
+    def wrap(self, method_name, func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(handler, request, context):
+                queue, cost, reason = await self.admit_async(method_name, request, context)
+                if reason is not None:
+                    await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, reason)
+                try:
+                    return await func(handler, request, context)
+                finally:
+                    queue.release(cost, thread=False)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(handler, request, context):
+            queue, cost, reason = self.admit(method_name, request, context)
+            if reason is not None:
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, reason)
+            try:
+                return func(handler, request, context)
+            finally:
+                queue.release(cost)
+
+        return wrapper
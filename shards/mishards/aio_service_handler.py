@@ -0,0 +1,193 @@
+import logging
+import time
+import asyncio
+from functools import partial
+from milvus.grpc_gen import milvus_pb2, status_pb2
+from milvus.client import types as Types
+
+from mishards import merge
+from mishards.grpc_utils import mark_grpc_method
+from mishards.grpc_utils import records
+from mishards.service_handler import ServiceHandler, QueryScope, ShardBudget
+
+logger = logging.getLogger(__name__)
+
+
+def wrap_future(sdk_future, loop, scope=None):
+    """Bridges an SDK future into an asyncio future of its raw response.
+
+    The SDK future is resolved by a gRPC callback thread; its result is only
+    read on `loop` once the underlying gRPC call is done, so it never blocks.
+    Cancelling the asyncio future cancels the SDK future through `scope`.
+    """
+    aio_future = loop.create_future()
+
+    def resolve():
+        if aio_future.done():
+            return
+        try:
+            aio_future.set_result(sdk_future.result(raw=True))
+        except Exception as exc:
+            aio_future.set_exception(exc)
+
+    def on_cancelled(future):
+        if future.cancelled():
+            (scope or QueryScope()).cancel_call(sdk_future)
+
+    aio_future.add_done_callback(on_cancelled)
+    sdk_future._future.add_done_callback(lambda _: loop.call_soon_threadsafe(resolve))
+    return aio_future
+
+
+class AsyncServiceHandler(ServiceHandler):
+    """ServiceHandler for the grpc.aio server.
+
+    Search and its fan-out run on the event loop: backend searches are awaited
+    as SDK futures, so an in-flight search does not hold a thread. Blocking
+    steps (routing, segment reloads) run on the search executor. The other
+    RPCs are inherited unchanged and run in the server's thread pool.
+    """
+
+    def __init__(self, tracer, router, **kwargs):
+        super().__init__(tracer, router, **kwargs)
+        if self.hedge_percentile is not None or self.coalescer is not None:
+            logger.warning('Search hedging and coalescing are not supported in async mode')
+
+    async def _search_in_shard_async(self, addr, collection_id, search_file_ids, ud_file_ids,
+                                     vectors, topk, search_params, span=None, metadata=None, scope=None):
+        logger.info(f"<{addr}> needed update segment ids {ud_file_ids}")
+        scope = scope or QueryScope()
+        loop = asyncio.get_event_loop()
+        conn = self.router.query_conn(addr, metadata=metadata)
+        with self.tracer.start_span('search_{}'.format(addr), child_of=span), self.router.track(addr):
+            started = time.time()
+            if self.reloader is not None:
+                self.reloader.submit(addr, collection_id, ud_file_ids)
+                if self.reloader.blocking(addr, search_file_ids):
+                    await loop.run_in_executor(self.search_executor, self.reloader.wait,
+                                               addr, search_file_ids, scope.remaining())
+            elif ud_file_ids:
+                await loop.run_in_executor(self.search_executor,
+                                           partial(conn.reload_segments, collection_id, ud_file_ids,
+                                                   timeout=scope.remaining()))
+            future = conn.search_in_segment(collection_name=collection_id,
+                                            file_ids=search_file_ids,
+                                            query_records=vectors,
+                                            top_k=topk,
+                                            params=search_params,
+                                            timeout=scope.remaining(), _async=True)
+            result = await wrap_future(future, loop, scope)
+            self.latency(addr).observe(time.time() - started)
+            return result
+
+    async def _do_query_async(self,
+                              collection_id,
+                              collection_meta,
+                              vectors,
+                              topk,
+                              search_params,
+                              partition_tags=None,
+                              **kwargs):
+        metadata = kwargs.get('metadata', None)
+        # The query is converted once and the same records go to every shard
+        vectors = records.sdk_query_records(vectors)
+        scope = kwargs.get('scope', None) or QueryScope()
+        loop = asyncio.get_event_loop()
+        self.reloader and self.reloader.watch(collection_id)
+
+        with self.tracer.start_span('get_routing'):
+            routing = await loop.run_in_executor(self.search_executor,
+                                                 partial(self.router.routing, collection_id,
+                                                         partition_tags=partition_tags,
+                                                         metadata=metadata))
+        logger.info('Routing: {}'.format(routing))
+
+        reverse = collection_meta.metric_type == Types.MetricType.IP
+        reducer = merge.TopKReducer(topk, reverse=reverse)
+        budget = None
+
+        with self.tracer.start_span('do_search') as span:
+            if len(routing) == 0:
+                ft = self.router.connection().search(collection_id, topk, vectors,
+                                                     list(partition_tags), search_params,
+                                                     timeout=scope.remaining(), _async=True)
+                reducer.add(await wrap_future(ft, loop, scope))
+            else:
+                if kwargs.get('partial_results', False):
+                    budget = ShardBudget(routing, kwargs.get('shard_budget', None))
+                tasks = {}
+                for addr, (search_file_ids, ud_file_ids) in routing.items():
+                    task = asyncio.ensure_future(self._search_in_shard_async(
+                        addr, collection_id, search_file_ids, ud_file_ids, vectors, topk,
+                        search_params, span=span, metadata=metadata, scope=scope))
+                    tasks[task] = addr
+
+                # The handler is cancelled by grpc.aio if the client goes away,
+                # the tasks and their backend searches are cancelled then too
+                try:
+                    await self._gather_async(tasks, reducer, scope, budget)
+                finally:
+                    cancelled = 0
+                    for task in tasks:
+                        cancelled += task.cancel()
+                    if cancelled:
+                        self.cancelled_calls.inc(cancelled)
+
+        with self.tracer.start_span('do_merge'):
+            return self._merge_partial_result(reducer, budget)
+
+    async def _gather_async(self, tasks, reducer, scope, budget=None):
+        pending = set(tasks)
+        while pending:
+            timeout = scope.remaining()
+            if budget is not None and budget.deadline is not None:
+                timeout = budget.remaining() if timeout is None else min(timeout, budget.remaining())
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = self._shard_result(task, budget)
+                if budget is not None and merge.is_error(result):
+                    budget.miss(tasks[task], merge.error_reason(result))
+                    continue
+                if not reducer.add(result):
+                    logger.error('Search failed: {}'.format(reducer.error))
+                    return
+            if pending and budget is not None and budget.expired():
+                for task in pending:
+                    budget.miss(tasks[task])
+                return
+            if pending and scope.expired():
+                self.deadline_exceeded.inc()
+                logger.warning('Search deadline exceeded')
+                reducer.add((status_pb2.Status(error_code=status_pb2.UNEXPECTED_ERROR,
+                                               reason='Search deadline exceeded'), None))
+                return
+
+    @mark_grpc_method
+    async def Search(self, request, context):
+
+        metadata = {'resp_class': milvus_pb2.TopKQueryResult}
+
+        loop = asyncio.get_event_loop()
+        collection_name, topk, params, collection_meta, query_record_array, partition_tags = \
+            await loop.run_in_executor(self.search_executor,
+                                       partial(self._parse_search_request, request, metadata=metadata))
+
+        partial_results, shard_budget = self._partial_options(params, metadata=metadata)
+
+        start = time.time()
+
+        status, id_results, dis_results = await self._do_query_async(collection_name,
+                                                                     collection_meta,
+                                                                     query_record_array,
+                                                                     topk,
+                                                                     params,
+                                                                     partition_tags=partition_tags,
+                                                                     metadata=metadata,
+                                                                     scope=QueryScope.from_context(context),
+                                                                     partial_results=partial_results,
+                                                                     shard_budget=shard_budget)
+
+        logger.info('SearchVector takes: {}'.format(time.time() - start))
+
+        return self._search_reply(request, status, id_results, dis_results)
@@ -0,0 +1,204 @@
+import time
+import enum
+import logging
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import grpc
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class BreakerState(enum.Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+
+def is_timeout(exc):
+    if isinstance(exc, (FutureTimeoutError, grpc.FutureTimeoutError)):
+        return True
+    return isinstance(exc, grpc.RpcError) and callable(getattr(exc, 'code', None)) \
+        and exc.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+class CircuitBreaker:
+    """Health of one read-only node.
+
+    The breaker opens after `failures` consecutive failed calls, once
+    `error_rate` of the last `window` calls failed, or once `timeout_rate` of
+    them timed out: a node which hangs holds every call until its deadline,
+    so fewer timeouts than errors are tolerated. An open breaker turns
+    half-open after `reset_timeout` seconds, and is closed again after
+    `probe_successes` successful probes in a row; a failed probe opens it
+    again.
+    """
+
+    def __init__(self, name, failures=5, error_rate=0.5, timeout_rate=0.25, window=20, reset_timeout=10,
+                 probe_successes=2, on_open=None, on_close=None):
+        self.name = name
+        self.failures = failures
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.reset_timeout = reset_timeout
+        self.probe_successes = probe_successes
+        self.on_open = on_open
+        self.on_close = on_close
+        self.lock = threading.Lock()
+        self.state = BreakerState.CLOSED
+        # (failed, timed out) of the last `window` calls
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.successful_probes = 0
+        self.opened_at = None
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.trips = 0
+
+    def record(self, error=None):
+        """Records the outcome of a call, `error` being the exception it
+        raised if any. Only calls made while the breaker is closed count.
+        """
+        with self.lock:
+            self.requests += 1
+            failed = error is not None
+            timed_out = failed and is_timeout(error)
+            if failed:
+                self.errors += 1
+                self.timeouts += timed_out
+            if self.state != BreakerState.CLOSED:
+                return
+            self.outcomes.append((failed, timed_out))
+            self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+            if self.consecutive_failures < self.failures and not self._error_rate_exceeded_no_lock():
+                return
+            self._open_no_lock()
+        logger.warning('<{}> circuit breaker opened: {}'.format(self.name, error))
+        self.on_open and self.on_open(self)
+
+    def _error_rate_exceeded_no_lock(self):
+        if len(self.outcomes) < self.outcomes.maxlen:
+            return False
+        errors = sum(failed for failed, _ in self.outcomes)
+        timeouts = sum(timed_out for _, timed_out in self.outcomes)
+        return errors >= self.error_rate * len(self.outcomes) or \
+            timeouts >= self.timeout_rate * len(self.outcomes)
+
+    def _open_no_lock(self):
+        self.state = BreakerState.OPEN
+        self.opened_at = time.time()
+        self.successful_probes = 0
+        self.trips += 1
+
+    def probe_due(self):
+        """Whether the node should be probed, an open breaker whose reset
+        timeout passed turns half-open.
+        """
+        with self.lock:
+            if self.state == BreakerState.OPEN and time.time() >= self.opened_at + self.reset_timeout:
+                self.state = BreakerState.HALF_OPEN
+            return self.state == BreakerState.HALF_OPEN
+
+    def record_probe(self, ok):
+        with self.lock:
+            if self.state != BreakerState.HALF_OPEN:
+                return
+            if not ok:
+                self._open_no_lock()
+                return
+            self.successful_probes += 1
+            if self.successful_probes < self.probe_successes:
+                return
+            self.state = BreakerState.CLOSED
+            self.outcomes.clear()
+            self.consecutive_failures = 0
+        logger.info('<{}> circuit breaker closed'.format(self.name))
+        self.on_close and self.on_close(self)
+
+    def stats(self):
+        with self.lock:
+            outcomes = list(self.outcomes)
+            return {
+                'state': self.state.value,
+                'requests': self.requests,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'error_rate': sum(failed for failed, _ in outcomes) / len(outcomes) if outcomes else 0,
+                'timeout_rate': sum(timed_out for _, timed_out in outcomes) / len(outcomes) if outcomes else 0,
+                'consecutive_failures': self.consecutive_failures,
+                'trips': self.trips,
+            }
+
+
+class HealthMonitor(threading.Thread):
+    """Keeps a `CircuitBreaker` for every routable node of a connection
+    topology. A node is ejected from the topology as soon as its breaker
+    opens, its files are then routed to the next node of the ring, and is
+    reinstated once its breaker closed. Half-open nodes are probed every
+    `interval` seconds with a server version request.
+    """
+
+    def __init__(self, topo, interval=1, probe_timeout=2, **breaker_options):
+        super().__init__(name='HealthMonitor', daemon=True)
+        self.topo = topo
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.breaker_options = breaker_options
+        self.breakers = {}
+        self.terminate = False
+        self.wakeup = threading.Event()
+        self.ejections = REGISTRY.counter('health.ejections')
+        self.reinstatements = REGISTRY.counter('health.reinstatements')
+        self.probes = REGISTRY.counter('health.probes')
+        REGISTRY.gauge('health.ejected', func=lambda: len(self.topo.ejected_groups))
+
+    def watch(self, name):
+        breaker = self.breakers.get(name, None)
+        if breaker is None:
+            breaker = CircuitBreaker(name, on_open=self.on_open, on_close=self.on_close,
+                                     **self.breaker_options)
+            self.breakers[name] = breaker
+        return breaker
+
+    def forget(self, name):
+        self.breakers.pop(name, None)
+
+    def on_open(self, breaker):
+        if self.topo.eject_group(breaker.name) is not None:
+            self.ejections.inc()
+
+    def on_close(self, breaker):
+        if self.topo.reinstate_group(breaker.name) is not None:
+            self.reinstatements.inc()
+
+    def probe(self, name):
+        group = self.topo.get_group(name)
+        conn = group.get(name) if group is not None else None
+        if conn is None:
+            return False
+        self.probes.inc()
+        try:
+            status, _ = conn.server_version(timeout=self.probe_timeout)
+            return status.OK()
+        except Exception as exc:
+            logger.debug('<{}> probe failed: {}'.format(name, exc))
+            return False
+
+    def poll(self):
+        for name, breaker in list(self.breakers.items()):
+            if breaker.probe_due():
+                breaker.record_probe(self.probe(name))
+
+    def run(self):
+        while not self.terminate:
+            try:
+                self.poll()
+            except Exception as exc:
+                logger.error('Health monitor poll failed: {}'.format(exc))
+            self.wakeup.wait(self.interval)
+
+    def stop(self):
+        self.terminate = True
+        self.wakeup.set()
@@ -0,0 +1,132 @@
+import time
+import logging
+import threading
+from mishards.metrics import REGISTRY
+from mishards.grpc_utils.records import concat_records
+
+logger = logging.getLogger(__name__)
+
+
+class Batch:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.rows = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Deadlines of the members, None for a member without deadline
+        self.deadlines = []
+
+    def deadline(self):
+        """The latest deadline of the members, None if one has none.
+        """
+        if not self.deadlines or None in self.deadlines:
+            return None
+        return max(self.deadlines)
+
+
+class SearchCoalescer:
+    """Coalesces concurrent searches sharing a key into one query.
+
+    The first search of a key opens a batch and waits up to `window` seconds,
+    or until `max_queries` query records were collected, before it runs the
+    query on behalf of the whole batch with the concatenated query records.
+    The merged result is then split back by rows to every caller. No extra
+    thread is involved: the opening caller does the work while the others wait.
+
+    The query serves every member of the batch, so it is not bound to the
+    opening caller: it runs until the latest deadline of the members. Every
+    other member waits up to its own deadline, or until its `abort` gives up.
+    """
+
+    # Seconds between two `abort` checks of a waiting member
+    CHECK_INTERVAL = 0.1
+
+    def __init__(self, window=0.002, max_queries=64):
+        self.window = window
+        self.max_queries = max_queries
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.batched = REGISTRY.counter('search.coalescer.batches')
+        self.coalesced = REGISTRY.counter('search.coalescer.queries')
+
+    def _close_no_lock(self, batch):
+        if self.batches.get(batch.key, None) is batch:
+            self.batches.pop(batch.key)
+        batch.full.set()
+
+    def search(self, key, query_records, query_func, deadline=None, abort=None):
+        """`query_func(query_records, deadline)` must return `(status, ids,
+        distances)` with `ids` and `distances` flattened row by row, as
+        `_do_query` does, and give up at `deadline`, the batch deadline.
+
+        `deadline` is the caller's own. While a member waits for the batch,
+        `abort()` is called at its deadline and every `CHECK_INTERVAL`
+        seconds; once it returns a result the member stops waiting and
+        returns that result instead.
+        """
+        rows = len(query_records)
+        with self.lock:
+            batch = self.batches.get(key, None)
+            if batch is not None and batch.rows and batch.rows + rows > self.max_queries:
+                self._close_no_lock(batch)
+                batch = None
+            opener = batch is None
+            if opener:
+                batch = Batch(key)
+                self.batches[key] = batch
+            offset = batch.rows
+            batch.chunks.append(query_records)
+            batch.deadlines.append(deadline)
+            batch.rows += rows
+            if batch.rows >= self.max_queries:
+                self._close_no_lock(batch)
+
+        if opener:
+            batch.full.wait(self.window)
+            with self.lock:
+                self._close_no_lock(batch)
+            self.batched.inc()
+            self.coalesced.inc(batch.rows)
+            try:
+                batch.result = query_func(concat_records(batch.chunks), batch.deadline())
+            except Exception as exc:
+                batch.error = exc
+            finally:
+                batch.done.set()
+        else:
+            aborted = self._wait(batch, deadline, abort)
+            if aborted is not None:
+                return aborted
+
+        if batch.error is not None:
+            raise batch.error
+        return self.split(batch.result, batch.rows, offset, rows)
+
+    def _wait(self, batch, deadline, abort):
+        """Waits for `batch` as a member with `deadline`. Returns the result of
+        `abort` if the member gave up, else None.
+        """
+        if abort is None:
+            batch.done.wait()
+            return None
+        while True:
+            timeout = self.CHECK_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - time.time(), 0))
+            if batch.done.wait(timeout):
+                return None
+            aborted = abort()
+            if aborted is not None:
+                return aborted
+
+    @staticmethod
+    def split(result, total_rows, offset, rows):
+        status, ids, distances = result
+        if len(ids) == 0 or total_rows == 0:
+            return status, ids, distances
+        width = len(ids) // total_rows
+        begin, end = offset * width, (offset + rows) * width
+        return status, ids[begin:end], distances[begin:end]
@@ -4,10 +4,19 @@ import json
 import logging
 import threading
 from functools import wraps
+from contextlib import contextmanager
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+import grpc
 from milvus import Milvus
+from milvus.client.exceptions import NotConnectError, VersionError
+from milvus.client.grpc_handler import GrpcHandler, set_uri
+from milvus.client.pool import _is_version_match, support_versions
+from milvus.client.types import Status
+from milvus.grpc_gen import milvus_pb2_grpc
 
-from mishards import (settings, exceptions, topology)
+from mishards import (settings, exceptions, topology, metrics)
+from mishards.breaker import is_timeout
 from utils import singleton
 
 logger = logging.getLogger(__name__)
@@ -225,9 +234,286 @@ logger = logging.getLogger(__name__)
 #         return connection
 
 
+class Channel:
+    """One client of a `ChannelPool`, with its own gRPC channel.
+    """
+
+    def __init__(self, index, client):
+        self.index = index
+        self.client = client
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        # Calls which ran out of the timeout they were given
+        self.expired = 0
+        self.latency = metrics.Histogram('channel', window=256)
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'requests': self.requests,
+            'errors': self.errors,
+            'expired': self.expired,
+            'p50': self.latency.percentile(50),
+            'p99': self.latency.percentile(99),
+        }
+
+
+class PooledFuture:
+    """Keeps the channel of an asynchronous call busy until its result was
+    taken or the call was cancelled.
+    """
+
+    def __init__(self, future, release):
+        self.future = future
+        self.release = release
+
+    def result(self, **kwargs):
+        try:
+            result = self.future.result(**kwargs)
+        except Exception as exc:
+            self.release(error=exc)
+            raise
+        self.release()
+        return result
+
+    def cancel(self):
+        try:
+            return self.future.cancel()
+        finally:
+            self.release(cancelled=True)
+
+    def expire(self):
+        """Cancels a call which did not answer within the deadline of its
+        query. Unlike a cancellation this counts as a timeout of the node.
+        """
+        try:
+            return self.future.cancel()
+        finally:
+            self.release(error=grpc.FutureTimeoutError())
+
+    def __getattr__(self, name):
+        return getattr(self.future, name)
+
+
+class ChannelHandler(GrpcHandler):
+    """The gRPC handler of the SDK on a subchannel pool of its own.
+
+    Channels built with the same arguments to the same address share their
+    subchannel, i.e. a single HTTP/2 connection, through the global
+    subchannel pool of gRPC. The channel arguments are the ones of the SDK
+    with `grpc.use_local_subchannel_pool` added.
+    """
+    CHANNEL_OPTIONS = [('grpc.max_send_message_length', -1),
+                       ('grpc.max_receive_message_length', -1),
+                       ('grpc.enable_retries', 1),
+                       ('grpc.keepalive_time_ms', 55000),
+                       ('grpc.use_local_subchannel_pool', 1)]
+
+    def _setup(self, host, port, uri, pre_ping=False):
+        self._uri = set_uri(host, port, uri)
+        self._channel = grpc.insecure_channel(self._uri, options=self.CHANNEL_OPTIONS)
+        self._stub = milvus_pb2_grpc.MilvusServiceStub(self._channel)
+        self.status = Status()
+
+    def close(self):
+        self._channel.close()
+
+
+class ChannelClient(Milvus):
+    """A client of the SDK holding one `ChannelHandler`.
+
+    Like the `Singleton` pool of the SDK, every thread shares the handler and
+    the server version is checked when the client is created. The default
+    `SingletonThread` pool would open another channel for every calling
+    thread and defeat the per channel accounting of `ChannelPool`.
+    """
+
+    def __init__(self, name=None, uri=None, try_connect=True, **kwargs):
+        self._name = name
+        self._uri = None
+        self._status = None
+        self._connected = False
+        self._handler = 'GRPC'
+        self._kw = kwargs
+        self._hooks = defaultdict()
+        self._conn = ChannelHandler(uri=uri, pre_ping=kwargs.get('pre_ping', True),
+                                    max_retry=kwargs.get('max_retry', 3))
+        try:
+            if try_connect:
+                self._conn.ping()
+            status, version = self._conn.server_version(timeout=30)
+            if not status.OK():
+                raise NotConnectError('Cannot check server version: {}'.format(status.message))
+            if not _is_version_match(version):
+                raise VersionError('Version of server {} does not match, expected is {}'.format(
+                    version, support_versions))
+        except Exception:
+            self._conn.close()
+            raise
+
+    def _connection(self):
+        return self._conn
+
+    def close(self):
+        conn, self._conn = self.__dict__.get('_conn', None), None
+        conn and conn.close()
+
+
+class ChannelPool(topology.TopoObject):
+    """`size` clients of one Milvus server, each with its own gRPC channel
+    and connection, which are connected when the pool is created.
+
+    Client methods are called through the pool: every call goes to the
+    channel with the fewest calls in flight, ties are taken in turn. The
+    in flight calls, request and error counts and the latency of every
+    channel are reported by `stats`. The outcome of every call which was not
+    cancelled is recorded by `breaker`, if the pool has one, timeouts
+    included. Only a call which timed out after it was dispatched with less
+    than `MIN_TIMEOUT` seconds left of the client deadline says nothing
+    about the node and is not recorded.
+    """
+    MIN_TIMEOUT = 0.1
+
+    def __init__(self, name, uri, size=1, **kwargs):
+        super().__init__(name, uri=uri, **kwargs)
+        self.uri = uri
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.channels = []
+        self.breaker = None
+        try:
+            for index in range(max(size, 1)):
+                self.channels.append(Channel(index, ChannelClient(name=name, uri=uri, **kwargs)))
+        except Exception:
+            self.close()
+            raise
+
+    def _acquire(self):
+        with self.lock:
+            count = len(self.channels)
+            start = self.next_index
+            self.next_index = (start + 1) % count
+            channel = min((self.channels[(start + i) % count] for i in range(count)),
+                          key=lambda c: c.inflight)
+            channel.inflight += 1
+            channel.requests += 1
+        return channel
+
+    def _release(self, channel, started, error=None, cancelled=False, timeout=None):
+        channel.latency.observe(time.time() - started)
+        expired = error is not None and timeout is not None and timeout < self.MIN_TIMEOUT \
+            and is_timeout(error)
+        with self.lock:
+            channel.inflight -= 1
+            if expired:
+                channel.expired += 1
+            elif error is not None:
+                channel.errors += 1
+        if self.breaker is not None and not cancelled and not expired:
+            self.breaker.record(error)
+
+    def _call(self, method, *args, **kwargs):
+        """Calls `method` of the client of the least loaded channel, `method`
+        being a name or a function taking the client first.
+        """
+        channel = self._acquire()
+        started = time.time()
+        timeout = kwargs.get('timeout', None)
+        try:
+            if callable(method):
+                result = method(channel.client, *args, **kwargs)
+            else:
+                result = getattr(channel.client, method)(*args, **kwargs)
+        except Exception as exc:
+            self._release(channel, started, error=exc, timeout=timeout)
+            raise
+        if kwargs.get('_async', False):
+            released = []
+
+            def release(error=None, cancelled=False):
+                if not released:
+                    released.append(True)
+                    self._release(channel, started, error=error, cancelled=cancelled, timeout=timeout)
+            return PooledFuture(result, release)
+        self._release(channel, started)
+        return result
+
+    @staticmethod
+    def _reload_segments(client, collection_name, segment_ids, timeout=None):
+        if timeout is None:
+            return client.reload_segments(collection_name, segment_ids)
+        # The SDK client takes no timeout for segment reloads, its handler does
+        with client._connection() as handler:
+            return handler.reload_segments(collection_name, segment_ids, timeout=timeout)
+
+    def reload_segments(self, collection_name, segment_ids, timeout=None):
+        return self._call(self._reload_segments, collection_name, segment_ids, timeout=timeout)
+
+    def _cmd(self, cmd, timeout=30):
+        # Cmd requests are passed through to the writable node's client
+        return self._call('_cmd', cmd, timeout)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not self.__dict__.get('channels'):
+            raise AttributeError(name)
+        attr = getattr(self.channels[0].client, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            return self._call(name, *args, **kwargs)
+        return call
+
+    def inflight(self):
+        return sum(channel.inflight for channel in self.channels)
+
+    def stats(self):
+        out = {
+            'uri': self.uri,
+            'inflight': self.inflight(),
+            'channels': [channel.stats() for channel in self.channels],
+        }
+        if self.breaker is not None:
+            out['breaker'] = self.breaker.stats()
+        return out
+
+    def close(self):
+        for channel in self.channels:
+            try:
+                channel.client.close()
+            except Exception as exc:
+                logger.warning('Closing a channel to {} failed: {}'.format(self.uri, exc))
+
+    def __str__(self):
+        return '<ChannelPool: {} x{}>'.format(self.name, len(self.channels))
+
+
 class ConnectionGroup(topology.TopoGroup):
     def __init__(self, name):
         super().__init__(name)
+        self.inflight_lock = threading.Lock()
+        self.inflight_requests = defaultdict(int)
+
+    @contextmanager
+    def track(self, name):
+        """Counts a request to connection `name` as in flight until the block exits.
+        """
+        with self.inflight_lock:
+            self.inflight_requests[name] += 1
+        try:
+            yield
+        finally:
+            with self.inflight_lock:
+                self.inflight_requests[name] -= 1
+
+    def inflight(self, name=None):
+        """Requests in flight to connection `name`, or to the whole group.
+        """
+        if name is not None:
+            return self.inflight_requests.get(name, 0)
+        return sum(self.inflight_requests.values())
 
     def stats(self):
         out = {}
@@ -236,10 +522,14 @@ class ConnectionGroup(topology.TopoGroup):
 
         return out
 
+    def close(self):
+        for item in self.items.values():
+            item.close()
+
     def on_pre_add(self, topo_object):
         # conn = topo_object.fetch()
         # conn.on_connect(metadata=None)
-        status, version = topo_object.server_version()
+        status, version = topo_object.server_version(timeout=settings.CONNECTION_PROBE_TIMEOUT)
         if not status.OK():
             logger.error('Cannot connect to newly added address: {}. Remove it now'.format(topo_object.name))
             return False
@@ -256,27 +546,133 @@ class ConnectionGroup(topology.TopoGroup):
             raise RuntimeError('\"uri\" is required to create connection pool')
         milvus_args = copy.deepcopy(kwargs)
         milvus_args["max_retry"] = settings.MAX_RETRY
-        pool = Milvus(name=name, **milvus_args)
+        milvus_args.setdefault('size', settings.CONNECTION_POOL_SIZE)
+        pool = ChannelPool(name=name, **milvus_args)
         status = self.add(pool)
         if status != topology.StatusType.OK:
+            pool.close()
             pool = None
         return status, pool
 
 
 class ConnectionTopology(topology.Topology):
-    def __init__(self):
+    # Maximum number of servers probed concurrently by `create_many`
+    MAX_PROBES = 32
+
+    def __init__(self, warmer=None, monitor=None):
         super().__init__()
+        # With a warmer new groups join and have to be activated, and groups
+        # are drained before they are deleted
+        self.warmer = warmer
+        # With a health monitor the connections of every routable group
+        # report to a circuit breaker, which ejects the group when it opens
+        self.monitor = monitor
 
     def stats(self):
         out = {}
-        for name, group in self.topo_groups.items():
-            out[name] = group.stats()
+        snapshot = self.snapshot
+        for groups in (snapshot.groups, snapshot.draining, snapshot.ejected):
+            for name, group in groups.items():
+                out[name] = group.stats()
 
         return out
 
+    def on_post_add_group(self, group):
+        if self.monitor is not None:
+            breaker = self.monitor.watch(group.name)
+            for conn in group.items.values():
+                if isinstance(conn, ChannelPool):
+                    conn.breaker = breaker
+        return super().on_post_add_group(group)
+
+    def on_post_delete_group(self, group):
+        from mishards.router.versions import file_versions
+        name = group if isinstance(group, str) else group.name
+        file_versions.drop_host(name)
+        self.monitor and self.monitor.forget(name)
+
     def create(self, name):
         group = ConnectionGroup(name)
-        status = self.add_group(group)
+        if self.warmer is not None:
+            status = self.join_group(group)
+        else:
+            status = self.add_group(group)
         if status == topology.StatusType.DUPLICATED:
             group = None
         return status, group
+
+    @staticmethod
+    def _prepare(name, uri):
+        group = ConnectionGroup(name)
+        try:
+            status, _ = group.create(name=name, uri=uri)
+        except Exception as exc:
+            logger.error('Cannot connect to {}: {}'.format(uri, exc))
+            status = topology.StatusType.ADD_ERROR
+        return status, group
+
+    @staticmethod
+    def _discard(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        _, group = future.result()
+        group.close()
+
+    def create_many(self, uris, timeout=None):
+        """Creates the groups of `{name: uri}` with one connection each.
+
+        The servers are connected to and probed concurrently, then all groups
+        which passed are added at once. A server which has not answered
+        within `timeout` seconds, `CONNECTION_PROBE_TIMEOUT` plus a margin by
+        default, is left out and its group is closed once the probe returns.
+        Returns the status of every name.
+        """
+        statuses = {name: topology.StatusType.DUPLICATED for name in uris if self.has_group(name)}
+        uris = {name: uri for name, uri in uris.items() if name not in statuses}
+        if not uris:
+            return statuses
+
+        timeout = settings.CONNECTION_PROBE_TIMEOUT + 5 if timeout is None else timeout
+        executor = ThreadPoolExecutor(max_workers=min(len(uris), self.MAX_PROBES))
+        futures = {executor.submit(self._prepare, name, uri): name for name, uri in uris.items()}
+        done, not_done = wait(futures, timeout=timeout)
+        executor.shutdown(wait=False)
+
+        groups = []
+        for future, name in futures.items():
+            if future in not_done:
+                logger.error('Probing {} timed out after {}s'.format(uris[name], timeout))
+                statuses[name] = topology.StatusType.ADD_ERROR
+                future.add_done_callback(self._discard)
+                continue
+            status, group = future.result()
+            if status == topology.StatusType.OK:
+                groups.append(group)
+            else:
+                statuses[name] = status
+
+        if self.warmer is not None:
+            for group in groups:
+                statuses[group.name] = self.join_group(group)
+                self.activate(group.name)
+        else:
+            statuses.update(self.add_groups(groups))
+        return statuses
+
+    def activate(self, name):
+        """Makes a group created by `create` routable, once it is warmed up.
+        """
+        if name not in self.joining_groups:
+            return
+        if self.warmer is None:
+            self.admit_group(name)
+            return
+        return self.warmer.join(self, name)
+
+    def retire(self, name):
+        """Deletes a group, after draining it if there is a warmer.
+        """
+        if self.warmer is None or name not in self.topo_groups:
+            self.delete_group(name)
+            return
+        return self.warmer.drain(self, name)
@@ -1,6 +1,7 @@
 import ujson
 from milvus import Status
 from functools import wraps
+from mishards.grpc_utils.records import pack_records
 
 
 def error_status(func):
@@ -92,13 +93,9 @@ class GrpcArgsParser(object):
             raise Exception("Search param loss")
         _params = ujson.loads(str(param.extra_params[0].value))
 
-        _query_record_array = []
         if param.query_record_array:
-            for record in param.query_record_array:
-                if record.float_data:
-                    _query_record_array.append(list(record.float_data))
-                else:
-                    _query_record_array.append(bytes(record.binary_data))
+            binary = not param.query_record_array[0].float_data
+            _query_record_array = pack_records(param.query_record_array, binary=binary)
         else:
             raise Exception("Search argument parse error: record array is empty")
 
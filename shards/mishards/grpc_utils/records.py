@@ -0,0 +1,134 @@
+import numpy as np
+from google.protobuf.internal import api_implementation
+from milvus.grpc_gen import milvus_pb2
+
+# Serializing a message is a plain memory copy with the C++/upb protobuf
+# backends, but walks every element with the pure python one
+SERIALIZED_COPY = api_implementation.Type() != 'python'
+
+_FLOAT_FIELD = milvus_pb2.RowRecord.DESCRIPTOR.fields_by_name['float_data']
+# A RowRecord holding only float_data serializes to this key, a varint length
+# and the packed little-endian floats
+_FLOAT_KEY = (_FLOAT_FIELD.number << 3) | 2
+
+
+def _varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def pack_float_records(records):
+    """Packs the `float_data` of RowRecords into one (nq, dim) float32 array.
+
+    With a native protobuf backend every row is copied from its serialized
+    form with a single `frombuffer`, no Python float is created per element.
+    The pure python backend fills the rows with `fromiter` instead.
+    """
+    nq = len(records)
+    dim = len(records[0].float_data) if nq else 0
+    out = np.empty((nq, dim), dtype=np.float32)
+    payload = dim * 4
+    serialized_size = _varint_size(_FLOAT_KEY) + _varint_size(payload) + payload
+    for i, record in enumerate(records):
+        if len(record.float_data) != dim:
+            raise ValueError('Query vectors have different dimensions: {} and {}'.format(
+                dim, len(record.float_data)))
+        if not dim:
+            continue
+        if not SERIALIZED_COPY:
+            out[i] = np.fromiter(record.float_data, dtype=np.float32, count=dim)
+            continue
+        data = record.SerializeToString()
+        if len(data) != serialized_size:
+            # Other fields are set as well: take the slow path for this row
+            out[i] = record.float_data
+            continue
+        out[i] = np.frombuffer(data, dtype='<f4', count=dim, offset=serialized_size - payload)
+    return out
+
+
+def pack_binary_records(records):
+    """Packs the `binary_data` of RowRecords into one (nq, nbytes) uint8 array.
+    """
+    nq = len(records)
+    data = b''.join(record.binary_data for record in records)
+    if nq and len(data) % nq:
+        raise ValueError('Query vectors have different dimensions')
+    return np.frombuffer(data, dtype=np.uint8).reshape(nq, len(data) // nq if nq else 0)
+
+
+def pack_records(records, binary=False):
+    return pack_binary_records(records) if binary else pack_float_records(records)
+
+
+def sdk_query_records(query_records):
+    """The SDK takes binary vectors only as a list of `bytes`. It still builds
+    every row with `add(float_data=row)`, which walks a numpy row element by
+    element, so float vectors are handed over as lists made by one `tolist`.
+    """
+    if not isinstance(query_records, np.ndarray):
+        return query_records
+    if query_records.dtype == np.uint8:
+        return [row.tobytes() for row in query_records]
+    return query_records.tolist()
+
+
+def concat_records(chunks):
+    if chunks and isinstance(chunks[0], np.ndarray):
+        return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+    return [record for chunk in chunks for record in chunk]
+
+
+_IDS_FIELD = milvus_pb2.TopKQueryResult.DESCRIPTOR.fields_by_name['ids']
+_DISTANCES_FIELD = milvus_pb2.TopKQueryResult.DESCRIPTOR.fields_by_name['distances']
+
+
+def encode_varints(values):
+    """Protobuf varint encoding of an int64 array, vectorized over the values.
+    """
+    values = np.ascontiguousarray(values, dtype=np.int64).view(np.uint64).ravel()
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest != 0
+        rest >>= np.uint64(7)
+
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    offsets = np.cumsum(sizes) - sizes
+    for k in range(int(sizes.max()) if len(sizes) else 0):
+        index = np.nonzero(sizes > k)[0]
+        chunk = (values[index] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        chunk |= (sizes[index] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[index] + k] = chunk
+    return out.tobytes()
+
+
+def _encode_varint(value):
+    return encode_varints(np.array([value], dtype=np.int64))
+
+
+def _packed_field(field, payload):
+    return _encode_varint((field.number << 3) | 2) + _encode_varint(len(payload)) + payload
+
+
+def topk_query_result(status, row_num, ids, distances):
+    """Builds a TopKQueryResult from int64 `ids` and float32 `distances` arrays.
+
+    With a native protobuf backend the packed repeated fields are encoded in
+    bulk from the arrays and parsed in one go, instead of converting every
+    entry into a Python object first.
+    """
+    if not SERIALIZED_COPY or not isinstance(ids, np.ndarray):
+        return milvus_pb2.TopKQueryResult(status=status, row_num=row_num,
+                                          ids=np.asarray(ids, dtype=np.int64).ravel().tolist(),
+                                          distances=np.asarray(distances, dtype=np.float32).ravel().tolist())
+
+    data = milvus_pb2.TopKQueryResult(status=status, row_num=row_num).SerializeToString()
+    if len(ids):
+        data += _packed_field(_IDS_FIELD, encode_varints(ids))
+        data += _packed_field(_DISTANCES_FIELD,
+                              np.ascontiguousarray(distances, dtype='<f4').tobytes())
+    return milvus_pb2.TopKQueryResult.FromString(data)
@@ -73,3 +73,69 @@ class TestGrpcUtils:
         assert not is_grpc_method(target)
         target = None
         assert not is_grpc_method(target)
+
+    def test_pack_records(self):
+        import numpy as np
+        from mishards.grpc_utils import records
+        from mishards.grpc_utils.grpc_args_parser import GrpcArgsParser as Parser
+
+        vectors = np.random.random((5, 300)).astype(np.float32)
+        param = milvus_pb2.SearchParam(collection_name='c', topk=3,
+                                       extra_params=[milvus_pb2.KeyValuePair(key='params', value='{}')])
+        for vector in vectors:
+            param.query_record_array.add(float_data=vector.tolist())
+
+        for serialized_copy in (True, False):
+            records.SERIALIZED_COPY, saved = serialized_copy, records.SERIALIZED_COPY
+            try:
+                packed = records.pack_records(param.query_record_array)
+            finally:
+                records.SERIALIZED_COPY = saved
+            assert packed.dtype == np.float32
+            assert packed.flags['C_CONTIGUOUS']
+            np.testing.assert_array_equal(packed, vectors)
+
+        status, (_, query_records, topk, _) = Parser.parse_proto_SearchParam(param)
+        assert status.OK() and topk == 3
+        np.testing.assert_array_equal(query_records, vectors)
+
+        param.query_record_array.add(float_data=[0.1])
+        try:
+            records.pack_records(param.query_record_array)
+            assert False
+        except ValueError:
+            pass
+
+        rows = [bytes(bytearray(range(i, i + 16))) for i in range(4)]
+        binary = milvus_pb2.SearchParam()
+        for row in rows:
+            binary.query_record_array.add(binary_data=row)
+        packed = records.pack_records(binary.query_record_array, binary=True)
+        assert packed.dtype == np.uint8 and packed.shape == (4, 16)
+        assert records.sdk_query_records(packed) == rows
+        assert records.sdk_query_records(vectors) == vectors.tolist()
+        assert records.sdk_query_records(rows) is rows
+        assert records.concat_records([packed[:1], packed[1:]]).shape == (4, 16)
+        assert records.concat_records([[1], [2, 3]]) == [1, 2, 3]
+
+    def test_topk_query_result(self):
+        import numpy as np
+        from mishards.grpc_utils import records
+
+        values = np.array([0, 1, 127, 128, 300, 1 << 40, -1, -(1 << 62)], dtype=np.int64)
+        expected = milvus_pb2.TopKQueryResult(ids=values.tolist()).SerializeToString()
+        assert expected.endswith(records.encode_varints(values))
+
+        status = status_pb2.Status(error_code=status_pb2.SUCCESS, reason='Success')
+        ids = np.random.randint(-1, 1 << 40, size=(10, 7)).astype(np.int64)
+        distances = np.random.random((10, 7)).astype(np.float32)
+        expected = milvus_pb2.TopKQueryResult(status=status, row_num=10, ids=ids.ravel().tolist(),
+                                              distances=distances.ravel().tolist())
+        for serialized_copy in (True, False):
+            records.SERIALIZED_COPY, saved = serialized_copy, records.SERIALIZED_COPY
+            try:
+                assert records.topk_query_result(status, 10, ids.ravel(), distances.ravel()) == expected
+                assert records.topk_query_result(status, 0, [], []) == \
+                    milvus_pb2.TopKQueryResult(status=status, row_num=0)
+            finally:
+                records.SERIALIZED_COPY = saved
@@ -1,6 +1,7 @@
 import math
 import sys
 from bisect import bisect
+import numpy as np
 
 if sys.version_info >= (2, 5):
     import hashlib
@@ -51,6 +52,8 @@ class HashRing(object):
                     self._sorted_keys.append(key)
 
         self._sorted_keys.sort()
+        self._sorted_keys_array = np.array(self._sorted_keys, dtype=np.uint64)
+        self._sorted_nodes = [self.ring[key] for key in self._sorted_keys]
 
     def get_node(self, string_key):
         """Given a string key a corresponding node in the hash ring is returned.
@@ -62,6 +65,22 @@ class HashRing(object):
             return None
         return self.ring[self._sorted_keys[pos]]
 
+    def get_nodes(self, string_keys):
+        """Bulk version of `get_node`: hashes all keys and bisects them against
+        the ring in one vectorized pass.
+
+        If the hash ring is empty, a list of `None` is returned.
+        """
+        if not self.ring:
+            return [None] * len(string_keys)
+
+        keys = np.fromiter((self.gen_key(key) for key in string_keys),
+                           dtype=np.uint64, count=len(string_keys))
+        positions = np.searchsorted(self._sorted_keys_array, keys, side='right')
+        positions[positions == len(self._sorted_keys)] = 0
+        nodes = self._sorted_nodes
+        return [nodes[pos] for pos in positions.tolist()]
+
     def get_node_pos(self, string_key):
         """Given a string key a corresponding node in the hash ring is returned
         along with it's position in the ring.
@@ -1,15 +1,29 @@
 import os
 import sys
+import signal
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from mishards import (settings, create_app)
 
 
-def main():
+def run_worker(index=None):
     server = create_app(settings.DefaultConfig)
+    if index is not None:
+        signal.signal(signal.SIGTERM, lambda *args: server.stop())
     server.run(port=settings.SERVER_PORT)
     return 0
 
 
+def main():
+    if settings.SERVER_WORKERS > 1:
+        from mishards.supervisor import Supervisor
+        log_name = settings.LOG_NAME
+        supervisor = Supervisor(run_worker, settings.SERVER_WORKERS,
+                                worker_env=lambda index: {'LOG_NAME': '{}-{}'.format(log_name, index)})
+        return supervisor.run()
+
+    return run_worker()
+
+
 if __name__ == '__main__':
     sys.exit(main())
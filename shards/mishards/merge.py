@@ -0,0 +1,151 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INVALID_ID = -1
+
+
+def as_topk_arrays(topk_result):
+    """View the flat `ids`/`distances` of a TopKQueryResult as (nq, k) arrays.
+    """
+    nq = topk_result.row_num
+    ids = np.array(topk_result.ids, dtype=np.int64)
+    distances = np.array(topk_result.distances, dtype=np.float32)
+    if nq <= 0 or ids.size % nq != 0 or ids.size != distances.size:
+        raise ValueError('Malformed topk result: row_num={} ids={} distances={}'.format(
+            nq, ids.size, distances.size))
+    return ids.reshape(nq, -1), distances.reshape(nq, -1)
+
+
+def merge_topk(id_arrays, distance_arrays, topk, reverse=False):
+    """Merge per-shard (nq, k_i) results into one (nq, min(topk, sum(k_i))) result.
+
+    All shards are concatenated along the column axis and reduced with a single
+    batched argpartition + argsort. `reverse` selects descending order, which is
+    what inner-product metrics need. Padding entries (id == -1) always sort last.
+    """
+    if not id_arrays:
+        raise ValueError('Nothing to merge')
+
+    nq = id_arrays[0].shape[0]
+    for ids, distances in zip(id_arrays, distance_arrays):
+        if ids.shape[0] != nq or ids.shape != distances.shape:
+            raise ValueError('merge error: inconsistent result shape {} / {} with nq={}'.format(
+                ids.shape, distances.shape, nq))
+
+    if len(id_arrays) == 1:
+        ids, distances = id_arrays[0], distance_arrays[0]
+    else:
+        ids = np.concatenate(id_arrays, axis=1)
+        distances = np.concatenate(distance_arrays, axis=1)
+
+    keys = np.negative(distances) if reverse else distances.copy()
+    keys[ids == INVALID_ID] = np.inf
+
+    width = keys.shape[1]
+    k = min(topk, width)
+    if k <= 0:
+        return ids[:, :0], distances[:, :0]
+
+    if k < width:
+        candidates = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        keys = np.take_along_axis(keys, candidates, axis=1)
+    else:
+        candidates = None
+
+    order = np.argsort(keys, axis=1, kind='stable')
+    if candidates is not None:
+        order = np.take_along_axis(candidates, order, axis=1)
+
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+def is_error(topk_result):
+    """True for an SDK `(status, None)` error tuple or a result with an error status.
+    """
+    return isinstance(topk_result, tuple) or topk_result.status.error_code != 0
+
+
+def error_reason(topk_result):
+    """The reason of an error result, see `is_error`. SDK statuses carry it
+    as `message`, protobuf ones as `reason`.
+    """
+    if isinstance(topk_result, tuple):
+        status = topk_result[0]
+        return getattr(status, 'reason', None) or getattr(status, 'message', '')
+    return topk_result.status.reason
+
+
+class TopKReducer:
+    """Incremental top-k accumulator for shard results.
+
+    Results are added as they arrive. With `fold=True` every add is reduced into
+    the running (nq, topk) arrays right away, so most of the merge work overlaps
+    with shards that are still searching. Otherwise results are buffered and
+    reduced in one batch by `result()`.
+    """
+
+    def __init__(self, topk, reverse=False):
+        self.topk = topk
+        self.reverse = reverse
+        self.error = None
+        self.ids = None
+        self.distances = None
+        self.pending_ids = []
+        self.pending_distances = []
+
+    def add(self, topk_result, fold=True):
+        """Add a raw TopKQueryResult (or an SDK `(status, None)` error tuple).
+
+        Returns False once an error status has been recorded.
+        """
+        if self.error is not None:
+            return False
+
+        if isinstance(topk_result, tuple):
+            self.error, _ = topk_result
+            return False
+
+        if topk_result.status.error_code != 0:
+            self.error = topk_result.status
+            return False
+
+        # row_num is equal to 0, result is empty
+        if not topk_result.row_num:
+            return True
+
+        ids, distances = as_topk_arrays(topk_result)
+        self.add_arrays(ids, distances, fold=fold)
+        return True
+
+    def add_arrays(self, ids, distances, fold=True):
+        self.pending_ids.append(ids)
+        self.pending_distances.append(distances)
+        if fold:
+            self.fold()
+
+    def fold(self):
+        if not self.pending_ids:
+            return
+        id_arrays, distance_arrays = self.pending_ids, self.pending_distances
+        if self.ids is not None:
+            id_arrays = [self.ids] + id_arrays
+            distance_arrays = [self.distances] + distance_arrays
+        self.ids, self.distances = merge_topk(id_arrays, distance_arrays, self.topk,
+                                              reverse=self.reverse)
+        self.pending_ids = []
+        self.pending_distances = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def result(self):
+        """Returns `(error_status, ids, distances)`; `error_status` is None on success
+        and `ids`/`distances` are None when no shard returned any row.
+        """
+        if self.error is not None:
+            return self.error, None, None
+        self.fold()
+        return None, self.ids, self.distances
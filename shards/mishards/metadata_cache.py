@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """TTL cache of collection metadata replies of the writable node.
+
+    Entries are keyed by `(collection_name, kind)` and hold the value of a
+    successful `(status, value)` reply. Failed replies are never cached.
+
+    DDL forwarded by this process drops the entries of its collection right
+    away; DDL sent through another proxy, or another worker process of this
+    one, is only seen once `ttl` expired.
+    A reply loaded while an invalidation happened is not stored, so a DDL
+    can not be undone by a concurrent load of the old metadata.
+    """
+
+    def __init__(self, ttl=60, capacity=4096, name='metadata.cache'):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.hits = REGISTRY.counter('{}.hits'.format(name))
+        self.misses = REGISTRY.counter('{}.misses'.format(name))
+        self.invalidations = REGISTRY.counter('{}.invalidations'.format(name))
+        REGISTRY.gauge('{}.size'.format(name), func=self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.capacity > 0
+
+    def get(self, collection_name, kind, loader):
+        """Returns the cached `(status, value)` reply, or calls `loader()` and
+        caches its reply if it is OK.
+        """
+        key = (collection_name, kind)
+        if self.enabled:
+            with self.lock:
+                entry = self.entries.get(key, None)
+                if entry is not None and entry[0] > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits.inc()
+                    return entry[1]
+                epoch = self.epoch
+        self.misses.inc()
+
+        status, value = loader()
+        if self.enabled and status.OK():
+            with self.lock:
+                if epoch == self.epoch:
+                    self.entries[key] = (time.time() + self.ttl, (status, value))
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.capacity:
+                        self.entries.popitem(last=False)
+        return status, value
+
+    def invalidate(self, collection_name, kinds=None):
+        """Drops the `kinds` entries of a collection, all of them by default.
+        """
+        with self.lock:
+            self.epoch += 1
+            for key in list(self.entries):
+                if key[0] == collection_name and (kinds is None or key[1] in kinds):
+                    self.entries.pop(key)
+            self.invalidations.inc()
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
@@ -0,0 +1,125 @@
+import bisect
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def stats(self):
+        return self.value
+
+
+class Gauge:
+    """A gauge is either set explicitly or computed on read by `func`.
+    """
+
+    def __init__(self, name, func=None):
+        self.name = name
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def stats(self):
+        return self.func() if self.func else self.value
+
+
+class Histogram:
+    """Per bucket sample counts plus a window of the most recent samples, from
+    which percentiles are computed.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, window=1024, buckets=None):
+        self.name = name
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.samples.append(value)
+
+    def percentile(self, p):
+        """The `p`th percentile of the recent samples, None if there is none.
+        """
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = min(int(round(p / 100.0 * (len(samples) - 1))), len(samples) - 1)
+        return samples[max(index, 0)]
+
+    def stats(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        buckets = {str(bound): n for bound, n in zip(self.buckets, counts)}
+        buckets['+Inf'] = counts[-1]
+        return {
+            'count': count,
+            'sum': total,
+            'buckets': buckets,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, name, factory):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = factory()
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name):
+        return self._get_or_create(name, lambda: Counter(name))
+
+    def gauge(self, name, func=None):
+        gauge = self._get_or_create(name, lambda: Gauge(name, func))
+        if func:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, **kwargs):
+        return self._get_or_create(name, lambda: Histogram(name, **kwargs))
+
+    def stats(self, prefix=None):
+        out = {}
+        for name, metric in sorted(self.metrics.items()):
+            if prefix and not name.startswith(prefix):
+                continue
+            try:
+                out[name] = metric.stats()
+            except Exception as exc:
+                logger.error('Cannot collect metric {}: {}'.format(name, exc))
+        return out
+
+
+REGISTRY = Registry()
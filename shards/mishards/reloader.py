@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from mishards import exceptions
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentReloader(threading.Thread):
+    """Reloads updated segments on read-only nodes in the background.
+
+    Every `interval` seconds the recently searched collections are routed
+    again. The routers compare the file versions of the metadata mirror, or
+    of the database, with the versions each node was last asked to load and
+    return the updated files, which are queued here instead of being reloaded
+    by the next search.
+
+    The queue of a node is drained in batches of up to `batch_size` segments
+    of one collection, with at most one batch in flight per node. A search
+    only blocks on the reloads, queued or in flight, of the segments it needs.
+    """
+
+    def __init__(self, router, interval=1, batch_size=64, max_workers=4, watch_ttl=600):
+        super().__init__(name='SegmentReloader', daemon=True)
+        self.router = router
+        self.interval = interval
+        self.batch_size = batch_size
+        self.watch_ttl = watch_ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.watched = OrderedDict()
+        self.queues = {}
+        self.busy = set()
+        self.pending = {}
+        self.terminate = False
+        self.wakeup = threading.Event()
+
+        self.batches = REGISTRY.counter('segment_reloader.batches')
+        self.segments = REGISTRY.counter('segment_reloader.segments')
+        self.errors = REGISTRY.counter('segment_reloader.errors')
+        self.waits = REGISTRY.counter('segment_reloader.waits')
+        self.latency = REGISTRY.histogram('segment_reloader.latency')
+        REGISTRY.gauge('segment_reloader.queue_depth', func=lambda: len(self.pending))
+        REGISTRY.gauge('segment_reloader.watched', func=lambda: len(self.watched))
+
+    def watch(self, collection_name):
+        with self.lock:
+            self.watched[collection_name] = time.time()
+            self.watched.move_to_end(collection_name)
+
+    def submit(self, host, collection_name, file_ids):
+        """Queues the reload of `file_ids` on `host`. Segments already queued
+        or in flight are not queued twice.
+        """
+        if not file_ids:
+            return
+        with self.lock:
+            queue = self.queues.setdefault(host, OrderedDict())
+            for file_id in file_ids:
+                if (host, file_id) in self.pending:
+                    continue
+                self.pending[(host, file_id)] = threading.Event()
+                queue[file_id] = collection_name
+            self._dispatch_no_lock(host)
+
+    def _dispatch_no_lock(self, host):
+        queue = self.queues.get(host, None)
+        if host in self.busy or not queue:
+            return
+        collection_name = next(iter(queue.values()))
+        file_ids = [file_id for file_id, name in queue.items() if name == collection_name][:self.batch_size]
+        for file_id in file_ids:
+            queue.pop(file_id)
+        if not queue:
+            self.queues.pop(host)
+        self.busy.add(host)
+        self.executor.submit(self._reload, host, collection_name, file_ids)
+
+    def _reload(self, host, collection_name, file_ids):
+        started = time.time()
+        try:
+            status = self.router.query_conn(host).reload_segments(collection_name, file_ids)
+            if status is not None and not status.OK():
+                raise RuntimeError(status.message)
+            self.segments.inc(len(file_ids))
+        except Exception as exc:
+            self.errors.inc()
+            logger.error('<{}> reloading {} segments of {} failed: {}'.format(
+                host, len(file_ids), collection_name, exc))
+        finally:
+            self.batches.inc()
+            self.latency.observe(time.time() - started)
+            with self.lock:
+                for file_id in file_ids:
+                    event = self.pending.pop((host, file_id), None)
+                    event and event.set()
+                self.busy.discard(host)
+                self._dispatch_no_lock(host)
+
+    def blocking(self, host, file_ids):
+        """Events of the reloads `file_ids` of `host` are waiting for.
+        """
+        if not self.pending:
+            return []
+        with self.lock:
+            return [self.pending[(host, file_id)] for file_id in file_ids
+                    if (host, file_id) in self.pending]
+
+    def wait(self, host, file_ids, timeout=None):
+        events = self.blocking(host, file_ids)
+        if not events:
+            return True
+        self.waits.inc()
+        deadline = None if timeout is None else time.time() + timeout
+        for event in events:
+            if not event.wait(None if deadline is None else max(deadline - time.time(), 0)):
+                return False
+        return True
+
+    def poll(self):
+        """Routes the watched collections and queues their updated segments.
+        """
+        now = time.time()
+        with self.lock:
+            while self.watched and next(iter(self.watched.values())) < now - self.watch_ttl:
+                self.watched.popitem(last=False)
+            collections = list(self.watched)
+
+        for collection_name in collections:
+            try:
+                routing = self.router.routing(collection_name)
+            except exceptions.CollectionNotFoundError:
+                with self.lock:
+                    self.watched.pop(collection_name, None)
+                continue
+            for host, (_, ud_file_ids) in routing.items():
+                if ud_file_ids:
+                    logger.info('<{}> queued reload of updated segments {}'.format(host, ud_file_ids))
+                    self.submit(host, collection_name, ud_file_ids)
+
+    def run(self):
+        while not self.terminate:
+            try:
+                self.poll()
+            except Exception as exc:
+                self.errors.inc()
+                logger.error('Segment reloader poll failed: {}'.format(exc))
+            self.wakeup.wait(self.interval)
+
+    def stop(self):
+        self.terminate = True
+        self.wakeup.set()
+        self.executor.shutdown(wait=False)
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from mishards import exceptions
 
 
@@ -36,8 +37,35 @@ class RouterMixin:
         # conn.on_connect(metadata=metadata)
 
         # conn = self.readonly_topo.get_group(name).get(name).fetch()
-        conn = self.readonly_topo.get_group(name).get(name)
+        conn = group.get(name)
         # if not conn:
         #     raise exceptions.ConnectionNotFoundError(name, metadata=metadata)
         # conn.on_connect(metadata=metadata)
         return conn
+
+    def alternate(self, name, search_file_ids, metadata=None):
+        """Returns `(host, ud_file_ids)` of another read-only node able to search
+        the files routed to `name`, or None if there is none.
+        """
+        return None
+
+    def placement(self, names, metadata=None):
+        """Returns `{host: {collection_name: [(file_id, updated_time)]}}`, the
+        files each node would be routed if the read-only nodes were `names`.
+        Nodes are warmed up with it before they join or leave; routers which
+        can not tell return an empty dict.
+        """
+        return {}
+
+    def inflight(self, name):
+        group = self.readonly_topo.get_group(name)
+        return group.inflight(name) if group is not None else 0
+
+    @contextmanager
+    def track(self, name):
+        group = self.readonly_topo.get_group(name)
+        if group is None:
+            yield
+            return
+        with group.track(name):
+            yield
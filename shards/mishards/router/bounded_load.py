@@ -0,0 +1,60 @@
+import math
+from collections import defaultdict
+
+
+def capacity(total_load, nodes_num, epsilon):
+    """Upper bound of the load a single node accepts: `(1 + epsilon)` times the mean.
+    """
+    if nodes_num <= 0:
+        return 0
+    return int(math.ceil((1 + epsilon) * total_load / nodes_num))
+
+
+def assign(ring, nodes, files, epsilon=0.25):
+    """Consistent hashing with bounded loads.
+
+    `files` is an iterable of `(file_id, load)` pairs. Every file walks the
+    ring from its hash position and is placed on the first node that still has
+    room for it under `capacity`. A node which owns nothing yet always accepts,
+    so a file larger than the capacity stays on its home node. If the whole
+    ring is full the least loaded node takes the file.
+
+    Files are placed from the largest to the smallest, so the result only
+    depends on the set of files and nodes. As with plain consistent hashing,
+    adding or removing a node mostly moves the files it gains or loses.
+
+    Returns `(assignment, loads)`: file id -> node and node -> total load.
+    """
+    nodes = list(nodes)
+    files = sorted(files, key=lambda f: (-f[1], f[0]))
+    limit = capacity(sum(load for _, load in files), len(nodes), epsilon)
+
+    assignment = {}
+    loads = defaultdict(int)
+    for node in nodes:
+        loads[node] = 0
+
+    if not nodes:
+        return assignment, loads
+
+    for file_id, load in files:
+        target = None
+        for node in ring.iterate_nodes(str(file_id)):
+            if loads[node] == 0 or loads[node] + load <= limit:
+                target = node
+                break
+        if target is None:
+            target = min(nodes, key=lambda n: (loads[n], str(n)))
+        assignment[file_id] = target
+        loads[target] += load
+
+    return assignment, loads
+
+
+def load_ratio(loads):
+    """Max/mean ratio of the node loads. 1.0 is a perfect balance.
+    """
+    values = list(loads.values())
+    if not values or not sum(values):
+        return 1.0
+    return max(values) / (sum(values) / len(values))
@@ -0,0 +1,132 @@
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict
+from mishards.metrics import REGISTRY
+from mishards.hash_ring import HashRing
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingCache:
+    """LRU cache of computed routings.
+
+    Every entry is stored together with the metadata version it was computed
+    from. A lookup with a different version drops the entry and counts as a miss.
+    """
+
+    def __init__(self, capacity=1024, name='router.cache'):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = REGISTRY.counter('{}.hits'.format(name))
+        self.misses = REGISTRY.counter('{}.misses'.format(name))
+        self.invalidations = REGISTRY.counter('{}.invalidations'.format(name))
+        REGISTRY.gauge('{}.size'.format(name), func=self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] != version:
+                self.entries.pop(key)
+                self.invalidations.inc()
+                entry = None
+
+            if entry is None:
+                self.misses.inc()
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits.inc()
+            return entry[1]
+
+    def put(self, key, version, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class HashRingCache:
+    """Keeps the hash ring of the latest topology generation.
+
+    A file id -> node map is kept along with the ring, so only files that have
+    not been seen under the current generation are hashed, in one bulk
+    `get_nodes` call.
+    """
+
+    MAX_MAPPED_FILES = 1 << 20
+
+    def __init__(self, ring_class=HashRing, name='router.ring'):
+        self.ring_class = ring_class
+        self.lock = threading.Lock()
+        self.generation = None
+        self.ring = None
+        self.file_nodes = {}
+        self.file_replicas = {}
+        self.rebuilds = REGISTRY.counter('{}.rebuilds'.format(name))
+        REGISTRY.gauge('{}.mapped_files'.format(name), func=lambda: len(self.file_nodes))
+
+    def get(self, topo):
+        """Returns `(ring, file_nodes)` of the current generation of `topo`.
+        """
+        ring, file_nodes, _ = self._get(topo)
+        return ring, file_nodes
+
+    def _get(self, topo):
+        # The generation and the servers have to come from the same snapshot
+        snapshot = topo.snapshot
+        generation = snapshot.generation
+        with self.lock:
+            if generation != self.generation or self.ring is None:
+                servers = list(snapshot.groups)
+                logger.info('Build hash ring of generation {} with servers: {}'.format(
+                    generation, servers))
+                self.ring = self.ring_class(servers)
+                self.file_nodes = {}
+                self.file_replicas = {}
+                self.generation = generation
+                self.rebuilds.inc()
+            return self.ring, self.file_nodes, self.file_replicas
+
+    def locate(self, topo, file_ids):
+        """Returns the ring node of every file in `file_ids`.
+        """
+        ring, file_nodes = self.get(topo)
+        missing = [file_id for file_id in file_ids if file_id not in file_nodes]
+        if missing:
+            if len(file_nodes) + len(missing) > self.MAX_MAPPED_FILES:
+                file_nodes.clear()
+            nodes = ring.get_nodes([str(file_id) for file_id in missing])
+            file_nodes.update(zip(missing, nodes))
+        return [file_nodes.get(file_id, None) or ring.get_node(str(file_id)) for file_id in file_ids]
+
+    def replicas(self, topo, file_ids, count):
+        """Returns a tuple of up to `count` distinct ring nodes for every file
+        in `file_ids`, the first of them being the node `locate` returns.
+        """
+        if count <= 1:
+            return [(node,) for node in self.locate(topo, file_ids)]
+
+        ring, _, file_replicas = self._get(topo)
+        if len(file_replicas) + len(file_ids) > self.MAX_MAPPED_FILES:
+            file_replicas.clear()
+
+        out = []
+        for file_id in file_ids:
+            replicas = file_replicas.get((file_id, count), None)
+            if replicas is None:
+                replicas = tuple(islice(ring.iterate_nodes(str(file_id)), count)) if ring.ring else (None,)
+                file_replicas[(file_id, count)] = replicas
+            out.append(replicas)
+        return out
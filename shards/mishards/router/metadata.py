@@ -0,0 +1,129 @@
+import logging
+import re
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy import and_, or_, func
+from mishards.models import Tables, TableFiles
+from mishards import exceptions, db
+
+logger = logging.getLogger(__name__)
+
+SEARCHABLE_FILE_TYPES = (TableFiles.FILE_TYPE_RAW,
+                         TableFiles.FILE_TYPE_TO_INDEX,
+                         TableFiles.FILE_TYPE_INDEX)
+
+
+def collection_list(collection_name, partition_tags=None, metadata=None):
+    """Returns the table ids of the collection and of its partitions matching
+    `partition_tags`.
+    """
+    if not partition_tags:
+        cond = and_(
+            or_(Tables.table_id == collection_name, Tables.owner_table == collection_name),
+            Tables.state != Tables.TO_DELETE)
+    else:
+        # TODO: collection default partition is '_default'
+        cond = and_(Tables.state != Tables.TO_DELETE,
+                    Tables.owner_table == collection_name)
+                    # Tables.partition_tag.in_(partition_tags))
+        if '_default' in partition_tags:
+            default_par_cond = and_(Tables.table_id == collection_name, Tables.state != Tables.TO_DELETE)
+            cond = or_(cond, default_par_cond)
+    try:
+        collections = db.Session.query(Tables.table_id, Tables.partition_tag).filter(cond).all()
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        raise exceptions.DBError(message=str(e), metadata=metadata)
+
+    if not collections:
+        logger.error("Cannot find collection {} / {} in metadata".format(collection_name, partition_tags))
+        raise exceptions.CollectionNotFoundError('{}:{}'.format(collection_name, partition_tags), metadata=metadata)
+
+    return match_partitions(collection_name, collections, partition_tags)
+
+
+def collection_names(metadata=None):
+    """Returns the names of all collections, without their partitions.
+    """
+    cond = and_(or_(Tables.owner_table == None, Tables.owner_table == ''),
+                Tables.state != Tables.TO_DELETE)
+    try:
+        collections = db.Session.query(Tables.table_id).filter(cond).all()
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        raise exceptions.DBError(message=str(e), metadata=metadata)
+
+    return [str(table_id) for table_id, in collections]
+
+
+def match_partitions(collection_name, collections, partition_tags=None):
+    """`collections` is an iterable of `(table_id, partition_tag)` pairs.
+    """
+    if not partition_tags:
+        return [str(table_id) for table_id, _ in collections]
+
+    out = []
+    for table_id, partition_tag in collections:
+        if table_id == collection_name:
+            out.append(collection_name)
+            continue
+
+        for tag in partition_tags:
+            if re.match(tag, partition_tag):
+                out.append(table_id)
+                break
+    return out
+
+
+def _searchable_cond(collection_list):
+    return and_(TableFiles.file_type.in_(SEARCHABLE_FILE_TYPES),
+                TableFiles.table_id.in_(collection_list))
+
+
+def searchable_files(collection_list, metadata=None):
+    """Returns `(file_id, updated_time)` tuples of all searchable files.
+    """
+    try:
+        files = db.Session.query(TableFiles.id, TableFiles.updated_time).filter(
+            _searchable_cond(collection_list)).all()
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        raise exceptions.DBError(message=str(e), metadata=metadata)
+
+    if not files:
+        logger.warning("Collection file is empty. {}".format(collection_list))
+
+    return [(int(file_id), int(updated_time)) for file_id, updated_time in files]
+
+
+def file_load(file_size, row_count):
+    """The load a file puts on the node scanning it: its size in bytes, or its
+    row count while the size is not yet recorded. Never less than 1.
+    """
+    return max(int(file_size or 0) or int(row_count or 0), 1)
+
+
+def searchable_file_loads(collection_list, metadata=None):
+    """Returns `(file_id, updated_time, load)` tuples of all searchable files.
+    """
+    try:
+        files = db.Session.query(TableFiles.id, TableFiles.updated_time,
+                                 TableFiles.file_size, TableFiles.row_count).filter(
+            _searchable_cond(collection_list)).all()
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        raise exceptions.DBError(message=str(e), metadata=metadata)
+
+    if not files:
+        logger.warning("Collection file is empty. {}".format(collection_list))
+
+    return [(int(file_id), int(updated_time), file_load(file_size, row_count))
+            for file_id, updated_time, file_size, row_count in files]
+
+
+def files_version(collection_list, metadata=None):
+    """A cheap probe which changes whenever searchable files are added, removed or updated.
+    """
+    try:
+        count, max_updated_time = db.Session.query(
+            func.count(TableFiles.id), func.max(TableFiles.updated_time)).filter(
+                _searchable_cond(collection_list)).one()
+    except sqlalchemy_exc.SQLAlchemyError as e:
+        raise exceptions.DBError(message=str(e), metadata=metadata)
+
+    return tuple(sorted(collection_list)), int(count or 0), int(max_updated_time or 0)
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import exc as sqlalchemy_exc
+from mishards.models import Tables, TableFiles
+from mishards.metrics import REGISTRY
+from mishards.router import metadata as meta
+from mishards.router.versions import file_versions
+from mishards import exceptions, db
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataMirror(threading.Thread):
+    """In-memory mirror of the `Tables` and `TableFiles` metadata.
+
+    `Tables` is small and reloaded on every poll. `TableFiles` is polled
+    incrementally on `updated_time`, and a full resync runs every
+    `resync_interval` seconds to drop rows deleted from the database. Routers
+    read collection and file lists from the mirror without a DB round trip.
+
+    Every collection carries a version which is bumped whenever one of its
+    searchable files changes, so routing caches can validate their entries
+    without probing the database.
+    """
+
+    def __init__(self, poll_interval=1, resync_interval=300, **kwargs):
+        super().__init__(name='MetadataMirror', daemon=True)
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.terminate = False
+        self.lock = threading.Lock()
+
+        self.tables = {}
+        self.files = {}
+        self.searchable = defaultdict(dict)
+        self.loads = {}
+        self.versions = defaultdict(int)
+        self.watermark = None
+        self.last_resync = 0
+        self.last_refresh = None
+
+        self.refreshes = REGISTRY.counter('metadata_mirror.refreshes')
+        self.errors = REGISTRY.counter('metadata_mirror.errors')
+        REGISTRY.gauge('metadata_mirror.lag_seconds', func=self.lag)
+        REGISTRY.gauge('metadata_mirror.tables', func=lambda: len(self.tables))
+        REGISTRY.gauge('metadata_mirror.files', func=lambda: len(self.files))
+
+    @property
+    def ready(self):
+        return self.last_refresh is not None
+
+    def lag(self):
+        """Seconds since the mirror last caught up with the database. -1 before the first sync.
+        """
+        if self.last_refresh is None:
+            return -1
+        return time.time() - self.last_refresh
+
+    def run(self):
+        while not self.terminate:
+            try:
+                self.refresh()
+            except Exception as exc:
+                self.errors.inc()
+                logger.error('Metadata mirror refresh failed: {}'.format(exc))
+            time.sleep(self.poll_interval)
+
+    def stop(self):
+        self.terminate = True
+
+    def refresh(self, full=None):
+        started = time.time()
+        full = full if full is not None else (started - self.last_resync >= self.resync_interval)
+        try:
+            tables = db.Session.query(Tables.table_id, Tables.owner_table,
+                                      Tables.partition_tag, Tables.state).all()
+            query = db.Session.query(TableFiles.id, TableFiles.table_id,
+                                     TableFiles.file_type, TableFiles.updated_time,
+                                     TableFiles.file_size, TableFiles.row_count)
+            if not full and self.watermark is not None:
+                query = query.filter(TableFiles.updated_time >= self.watermark)
+            files = query.all()
+        except sqlalchemy_exc.SQLAlchemyError as e:
+            raise exceptions.DBError(message=str(e))
+        finally:
+            db.remove_session()
+
+        with self.lock:
+            self.tables = {str(table_id): (owner_table, partition_tag, state)
+                           for table_id, owner_table, partition_tag, state in tables}
+            if full:
+                self._resync_no_lock(files)
+                self.last_resync = started
+                live_files = [file_id for searchable in self.searchable.values() for file_id in searchable]
+            else:
+                for row in files:
+                    self._apply_no_lock(*row)
+
+        if full:
+            # Forget the versions of files merged away or dropped
+            file_versions.retain(live_files)
+
+        self.last_refresh = started
+        self.refreshes.inc()
+
+    def _resync_no_lock(self, files):
+        previous = self.searchable
+        self.files = {}
+        self.searchable = defaultdict(dict)
+        self.loads = {}
+        self.watermark = None
+        for row in files:
+            self._apply_no_lock(*row)
+
+        for table_id in set(previous) | set(self.searchable):
+            if previous.get(table_id, {}) != self.searchable.get(table_id, {}):
+                self.versions[table_id] += 1
+
+    def _apply_no_lock(self, file_id, table_id, file_type, updated_time, file_size=0, row_count=0):
+        file_id = int(file_id)
+        updated_time = int(updated_time or 0)
+        self.loads[file_id] = meta.file_load(file_size, row_count)
+        if self.watermark is None or updated_time > self.watermark:
+            self.watermark = updated_time
+
+        previous = self.files.get(file_id, None)
+        if previous == (table_id, file_type, updated_time):
+            return
+        self.files[file_id] = (table_id, file_type, updated_time)
+
+        if previous is not None and previous[0] != table_id:
+            self.searchable[previous[0]].pop(file_id, None)
+            self.versions[previous[0]] += 1
+
+        if file_type in meta.SEARCHABLE_FILE_TYPES:
+            self.searchable[table_id][file_id] = updated_time
+        else:
+            self.searchable[table_id].pop(file_id, None)
+        self.versions[table_id] += 1
+
+    def collection_list(self, collection_name, partition_tags=None, metadata=None):
+        with self.lock:
+            tables = list(self.tables.items())
+
+        collections = []
+        for table_id, (owner_table, partition_tag, state) in tables:
+            if state == Tables.TO_DELETE:
+                continue
+            if not partition_tags:
+                match = table_id == collection_name or owner_table == collection_name
+            else:
+                match = owner_table == collection_name or \
+                    ('_default' in partition_tags and table_id == collection_name)
+            if match:
+                collections.append((table_id, partition_tag))
+
+        if not collections:
+            logger.error("Cannot find collection {} / {} in metadata mirror".format(
+                collection_name, partition_tags))
+            raise exceptions.CollectionNotFoundError('{}:{}'.format(collection_name, partition_tags),
+                                                     metadata=metadata)
+
+        return meta.match_partitions(collection_name, collections, partition_tags)
+
+    def collection_names(self, metadata=None):
+        with self.lock:
+            return [table_id for table_id, (owner_table, _, state) in self.tables.items()
+                    if not owner_table and state != Tables.TO_DELETE]
+
+    def searchable_files(self, collection_list, metadata=None):
+        with self.lock:
+            files = [(file_id, updated_time)
+                     for table_id in collection_list
+                     for file_id, updated_time in self.searchable.get(table_id, {}).items()]
+
+        if not files:
+            logger.warning("Collection file is empty. {}".format(collection_list))
+        return files
+
+    def searchable_file_loads(self, collection_list, metadata=None):
+        with self.lock:
+            files = [(file_id, updated_time, self.loads.get(file_id, 1))
+                     for table_id in collection_list
+                     for file_id, updated_time in self.searchable.get(table_id, {}).items()]
+
+        if not files:
+            logger.warning("Collection file is empty. {}".format(collection_list))
+        return files
+
+    def files_version(self, collection_list, metadata=None):
+        with self.lock:
+            return tuple((table_id, self.versions.get(table_id, 0))
+                         for table_id in sorted(collection_list))
@@ -0,0 +1,148 @@
+import logging
+from collections import defaultdict
+from mishards.router import RouterMixin
+from mishards.hash_ring import HashRing
+from mishards.router import metadata as meta
+from mishards.router import bounded_load
+from mishards.router.cache import RoutingCache, HashRingCache
+from mishards.router.versions import filter_file_to_update, prune_vanished_files
+from mishards import db, exceptions, settings
+
+logger = logging.getLogger(__name__)
+
+
+class Factory(RouterMixin):
+    """Places files with consistent hashing with bounded loads.
+
+    A file is weighted by its `file_size`, or `row_count` while the size is
+    unknown, and no read-only node is assigned more than
+    `1 + ROUTER_BOUNDED_LOAD_EPSILON` times the mean load of the collection.
+    The assignment always covers the whole collection and is cached by its
+    files version, so a query on some partitions routes their files to the
+    same nodes `placement` loads them on.
+    """
+    name = 'BoundedLoadHashRingRouter'
+
+    def __init__(self, writable_topo, readonly_topo, mirror=None, epsilon=None, **kwargs):
+        super(Factory, self).__init__(writable_topo=writable_topo,
+                                      readonly_topo=readonly_topo)
+        self.epsilon = settings.ROUTER_BOUNDED_LOAD_EPSILON if epsilon is None else epsilon
+        self.cache = RoutingCache(capacity=settings.ROUTER_CACHE_SIZE, name='router.bounded_load.cache')
+        self.assignments = RoutingCache(capacity=settings.ROUTER_CACHE_SIZE,
+                                        name='router.bounded_load.assignments')
+        self.rings = HashRingCache(name='router.bounded_load.ring')
+        self.mirror = mirror
+
+    @property
+    def metadata_source(self):
+        if self.mirror is not None and self.mirror.ready:
+            return self.mirror
+        return meta
+
+    def routing(self, collection_name, partition_tags=None, metadata=None, **kwargs):
+        source = self.metadata_source
+        try:
+            collection_list = source.collection_list(collection_name, partition_tags, metadata=metadata)
+            whole_list = source.collection_list(collection_name, metadata=metadata) \
+                if partition_tags else collection_list
+            whole_version = source.files_version(whole_list, metadata=metadata)
+
+            # Any change to the files of the collection may move files of the
+            # requested partitions, so everything is versioned by the whole one
+            generation = self.readonly_topo.generation
+            cache_key = (collection_name, tuple(partition_tags or ()), generation)
+            version = (tuple(sorted(collection_list)), whole_version)
+            routing = self.cache.get(cache_key, version)
+            if routing is not None:
+                return {host: (search_files, []) for host, search_files in routing.items()}
+
+            ring, _ = self.rings.get(self.readonly_topo)
+            assignment, files = self._assign(ring, collection_name, generation, whole_list,
+                                             whole_version, source, metadata)
+            if partition_tags:
+                files = source.searchable_files(collection_list, metadata=metadata)
+        finally:
+            db.remove_session()
+        if partition_tags:
+            prune_vanished_files(collection_list, [file_id for file_id, _ in files])
+
+        routing = {}
+        for file_id, updated_time in files:
+            # A file added after the assignment was computed falls back to its home node
+            host = assignment.get(file_id) or ring.get_node(str(file_id))
+            routing.setdefault(host, []).append((str(file_id), updated_time))
+
+        filter_routing = {}
+        for host, filess in routing.items():
+            ud_files = filter_file_to_update(host, filess)
+            search_files = [f[0] for f in filess]
+            filter_routing[host] = (search_files, ud_files)
+
+        self.cache.put(cache_key, version,
+                       {host: search_files for host, (search_files, _) in filter_routing.items()})
+
+        return filter_routing
+
+    def _assign(self, ring, collection_name, generation, whole_list, whole_version, source, metadata):
+        """Bounded-load assignment of every searchable file of the collection,
+        as `placement` computes it, whichever partitions are queried.
+
+        Returns `(assignment, files)`: file id -> node and the
+        `(file_id, updated_time)` pairs of the collection.
+        """
+        key = (collection_name, generation)
+        entry = self.assignments.get(key, whole_version)
+        if entry is not None:
+            return entry
+
+        files = source.searchable_file_loads(whole_list, metadata=metadata)
+        prune_vanished_files(whole_list, [file_id for file_id, _, _ in files])
+        assignment, loads = bounded_load.assign(ring, ring.nodes,
+                                                [(file_id, load) for file_id, _, load in files],
+                                                epsilon=self.epsilon)
+        logger.debug('Routing {} files of {} with max/mean load ratio {:.3f}'.format(
+            len(files), collection_name, bounded_load.load_ratio(loads)))
+
+        entry = (assignment, [(file_id, updated_time) for file_id, updated_time, _ in files])
+        self.assignments.put(key, whole_version, entry)
+        return entry
+
+    def placement(self, names, metadata=None):
+        ring = HashRing(list(names))
+        if not ring.ring:
+            return {}
+        source = self.metadata_source
+        out = defaultdict(dict)
+        try:
+            for collection_name in source.collection_names(metadata=metadata):
+                try:
+                    collection_list = source.collection_list(collection_name, metadata=metadata)
+                except exceptions.CollectionNotFoundError:
+                    continue
+                files = source.searchable_file_loads(collection_list, metadata=metadata)
+                prune_vanished_files(collection_list, [file_id for file_id, _, _ in files])
+                assignment, _ = bounded_load.assign(ring, ring.nodes,
+                                                    [(file_id, load) for file_id, _, load in files],
+                                                    epsilon=self.epsilon)
+                for file_id, updated_time, _ in files:
+                    out[assignment[file_id]].setdefault(collection_name, []).append(
+                        (str(file_id), updated_time))
+        finally:
+            db.remove_session()
+        return dict(out)
+
+    @classmethod
+    def Create(cls, **kwargs):
+        writable_topo = kwargs.pop('writable_topo', None)
+        if not writable_topo:
+            raise RuntimeError('Cannot find \'writable_topo\' to initialize \'{}\''.format(cls.name))
+        readonly_topo = kwargs.pop('readonly_topo', None)
+        if not readonly_topo:
+            raise RuntimeError('Cannot find \'readonly_topo\' to initialize \'{}\''.format(cls.name))
+        router = cls(writable_topo=writable_topo, readonly_topo=readonly_topo, **kwargs)
+        return router
+
+
+def setup(app):
+    logger.info('Plugin \'{}\' Installed In Package: {}'.format(__file__, app.plugin_package_name))
+    app.on_plugin_setup(Factory)
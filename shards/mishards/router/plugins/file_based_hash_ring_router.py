@@ -1,44 +1,34 @@
-from collections import defaultdict
 import logging
-import re
-from sqlalchemy import exc as sqlalchemy_exc
-from sqlalchemy import and_, or_
-from mishards.models import Tables, TableFiles
+from collections import defaultdict
+from itertools import islice
 from mishards.router import RouterMixin
-from mishards import exceptions, db
 from mishards.hash_ring import HashRing
+from mishards.router import metadata as meta
+from mishards.router.cache import RoutingCache, HashRingCache
+from mishards.router.versions import filter_file_to_update, filter_file_to_update_from, prune_vanished_files
+from mishards import db, exceptions, settings
 
 logger = logging.getLogger(__name__)
 
 
-file_updatetime_map = defaultdict(dict)
-
-
-def filter_file_to_update(host, files_list):
-    host_files = file_updatetime_map[host]
-
-    file_need_update_list = []
-    for fl in files_list:
-        file_id, update_time = fl
-        pre_update_time = host_files.get(file_id, 0)
-
-        if pre_update_time >= update_time:
-            continue
-        logger.debug("[{}] file id: {}.  pre update time {} is small than {}"
-                     .format(host, file_id, pre_update_time, update_time))
-        host_files[file_id] = update_time
-        # if pre_update_time > 0:
-        file_need_update_list.append(file_id)
-
-    return file_need_update_list
-
-
 class Factory(RouterMixin):
     name = 'FileBasedHashRingRouter'
 
-    def __init__(self, writable_topo, readonly_topo, **kwargs):
+    def __init__(self, writable_topo, readonly_topo, mirror=None, replication_factor=None, **kwargs):
         super(Factory, self).__init__(writable_topo=writable_topo,
                                       readonly_topo=readonly_topo)
+        self.cache = RoutingCache(capacity=settings.ROUTER_CACHE_SIZE)
+        self.rings = HashRingCache()
+        self.mirror = mirror
+        self.replication_factor = settings.ROUTER_REPLICATION_FACTOR \
+            if replication_factor is None else replication_factor
+
+    @property
+    def metadata_source(self):
+        # Fall back to the database until the mirror has completed its first sync
+        if self.mirror is not None and self.mirror.ready:
+            return self.mirror
+        return meta
 
     def routing(self, collection_name, partition_tags=None, metadata=None, **kwargs):
         range_array = kwargs.pop('range_array', None)
@@ -47,76 +37,47 @@ class Factory(RouterMixin):
     def _route(self, collection_name, range_array, partition_tags=None, metadata=None, **kwargs):
         # PXU TODO: Implement Thread-local Context
         # PXU TODO: Session life mgt
-
-        if not partition_tags:
-            cond = and_(
-                or_(Tables.table_id == collection_name, Tables.owner_table == collection_name),
-                Tables.state != Tables.TO_DELETE)
-        else:
-            # TODO: collection default partition is '_default'
-            cond = and_(Tables.state != Tables.TO_DELETE,
-                        Tables.owner_table == collection_name)
-                        # Tables.partition_tag.in_(partition_tags))
-            if '_default' in partition_tags:
-                default_par_cond = and_(Tables.table_id == collection_name, Tables.state != Tables.TO_DELETE)
-                cond = or_(cond, default_par_cond)
+        replicated = self.replication_factor > 1
+        source = self.metadata_source
         try:
-            collections = db.Session.query(Tables).filter(cond).all()
-        except sqlalchemy_exc.SQLAlchemyError as e:
-            raise exceptions.DBError(message=str(e), metadata=metadata)
-
-        if not collections:
-            logger.error("Cannot find collection {} / {} in metadata".format(collection_name, partition_tags))
-            raise exceptions.CollectionNotFoundError('{}:{}'.format(collection_name, partition_tags), metadata=metadata)
-
-        collection_list = []
-        if not partition_tags:
-            collection_list = [str(collection.table_id) for collection in collections]
-        else:
-            for collection in collections:
-                if collection.table_id == collection_name:
-                    collection_list.append(collection_name)
-                    continue
-
-                for tag in partition_tags:
-                    if re.match(tag, collection.partition_tag):
-                        collection_list.append(collection.table_id)
-                        break
-
-        file_type_cond = or_(
-            TableFiles.file_type == TableFiles.FILE_TYPE_RAW,
-            TableFiles.file_type == TableFiles.FILE_TYPE_TO_INDEX,
-            TableFiles.file_type == TableFiles.FILE_TYPE_INDEX,
-        )
-        file_cond = and_(file_type_cond, TableFiles.table_id.in_(collection_list))
-        try:
-            files = db.Session.query(TableFiles).filter(file_cond).all()
-        except sqlalchemy_exc.SQLAlchemyError as e:
-            raise exceptions.DBError(message=str(e), metadata=metadata)
-
-        if not files:
-            logger.warning("Collection file is empty. {}".format(collection_list))
-        #     logger.error("Cannot find collection file id {} / {} in metadata".format(collection_name, partition_tags))
-        #     raise exceptions.CollectionNotFoundError('Collection file id not found. {}:{}'.format(collection_name, partition_tags),
-        #                                              metadata=metadata)
-
-        db.remove_session()
-
-        servers = self.readonly_topo.group_names
-        logger.info('Available servers: {}'.format(list(servers)))
-
-        ring = HashRing(servers)
+            collection_list = source.collection_list(collection_name, partition_tags, metadata=metadata)
+            version = source.files_version(collection_list, metadata=metadata)
+
+            generation = self.readonly_topo.generation
+            cache_key = (collection_name, tuple(partition_tags or ()), generation)
+            routing = self.cache.get(cache_key, version)
+            if routing is not None and replicated:
+                return self._select_replicas(routing)
+            if routing is not None:
+                # Every file of this version was already recorded in
+                # file_versions when the entry was computed
+                return {host: (search_files, []) for host, search_files in routing.items()}
+
+            files = source.searchable_files(collection_list, metadata=metadata)
+        finally:
+            db.remove_session()
+        prune_vanished_files(collection_list, [file_id for file_id, _ in files])
+
+        if replicated:
+            placement = {}
+            file_replicas = self.rings.replicas(self.readonly_topo, [file_id for file_id, _ in files],
+                                                self.replication_factor)
+            for (file_id, updated_time), replicas in zip(files, file_replicas):
+                placement.setdefault(replicas, []).append((str(file_id), updated_time))
+            self.cache.put(cache_key, version, placement)
+            return self._select_replicas(placement)
+
+        target_hosts = self.rings.locate(self.readonly_topo, [file_id for file_id, _ in files])
 
         routing = {}
 
-        for f in files:
-            target_host = ring.get_node(str(f.id))
+        for (file_id, updated_time), target_host in zip(files, target_hosts):
             sub = routing.get(target_host, None)
             if not sub:
                 sub = []
                 routing[target_host] = sub
             # routing[target_host].append({"id": str(f.id), "update_time": int(f.updated_time)})
-            routing[target_host].append((str(f.id), int(f.updated_time)))
+            routing[target_host].append((str(file_id), updated_time))
 
         filter_routing = {}
         for host, filess in routing.items():
@@ -124,6 +85,70 @@ class Factory(RouterMixin):
             search_files = [f[0] for f in filess]
             filter_routing[host] = (search_files, ud_files)
 
+        self.cache.put(cache_key, version,
+                       {host: search_files for host, (search_files, _) in filter_routing.items()})
+
+        return filter_routing
+
+    def alternate(self, name, search_file_ids, metadata=None):
+        # The first nodes following `name` on the ring act as its buddies
+        ring, _ = self.rings.get(self.readonly_topo)
+        if not ring.ring:
+            return None
+        candidates = [node for node in islice(ring.iterate_nodes(name), max(self.replication_factor, 2) + 1)
+                      if node != name]
+        if not candidates:
+            return None
+        host = min(candidates, key=self.inflight)
+        return host, filter_file_to_update_from(host, name, search_file_ids)
+
+    def placement(self, names, metadata=None):
+        ring = HashRing(list(names))
+        if not ring.ring:
+            return {}
+        source = self.metadata_source
+        out = defaultdict(dict)
+        try:
+            for collection_name in source.collection_names(metadata=metadata):
+                try:
+                    collection_list = source.collection_list(collection_name, metadata=metadata)
+                except exceptions.CollectionNotFoundError:
+                    continue
+                files = source.searchable_files(collection_list, metadata=metadata)
+                prune_vanished_files(collection_list, [file_id for file_id, _ in files])
+                if self.replication_factor > 1:
+                    hosts = [islice(ring.iterate_nodes(str(file_id)), self.replication_factor)
+                             for file_id, _ in files]
+                else:
+                    hosts = [(host,) for host in ring.get_nodes([str(file_id) for file_id, _ in files])]
+                for (file_id, updated_time), replicas in zip(files, hosts):
+                    for host in replicas:
+                        out[host].setdefault(collection_name, []).append((str(file_id), updated_time))
+        finally:
+            db.remove_session()
+        return dict(out)
+
+    def _select_replicas(self, placement):
+        """`placement` maps a tuple of replica hosts to the `(file_id, updated_time)`
+        pairs they hold. Every replica set is served by its host with the fewest
+        requests in flight, files already picked for this query breaking ties.
+        """
+        inflight = {}
+        picked = defaultdict(int)
+        routing = {}
+        for replicas, files in placement.items():
+            for host in replicas:
+                if host not in inflight:
+                    inflight[host] = self.inflight(host)
+            host = min(replicas, key=lambda h: (inflight[h], picked[h]))
+            picked[host] += len(files)
+            routing.setdefault(host, []).extend(files)
+
+        filter_routing = {}
+        for host, filess in routing.items():
+            ud_files = filter_file_to_update(host, filess)
+            search_files = [f[0] for f in filess]
+            filter_routing[host] = (search_files, ud_files)
         return filter_routing
 
     @classmethod
@@ -0,0 +1,218 @@
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class HostFileVersions:
+    """The last version of every file a read-only host was asked to reload,
+    kept as two int64 arrays sorted by file id.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.times = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.times.nbytes
+
+    def _find(self, file_ids):
+        pos = np.searchsorted(self.ids, file_ids)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == file_ids[found]
+        return pos, found
+
+    def lookup(self, file_ids):
+        """Recorded versions of `file_ids`, 0 for unknown files.
+        """
+        file_ids = np.asarray(file_ids, dtype=np.int64)
+        pos, found = self._find(file_ids)
+        times = np.zeros(len(file_ids), dtype=np.int64)
+        times[found] = self.times[pos[found]]
+        return times
+
+    def update(self, file_ids, update_times):
+        """Records the versions which are newer than the known ones and returns
+        a mask of the files which were updated.
+        """
+        file_ids = np.asarray(file_ids, dtype=np.int64)
+        update_times = np.asarray(update_times, dtype=np.int64)
+        pos, found = self._find(file_ids)
+        previous = np.zeros(len(file_ids), dtype=np.int64)
+        previous[found] = self.times[pos[found]]
+        updated = previous < update_times
+
+        known = updated & found
+        self.times[pos[known]] = update_times[known]
+
+        new = updated & ~found
+        if new.any():
+            new_ids, index = np.unique(file_ids[new], return_index=True)
+            ids = np.concatenate([self.ids, new_ids])
+            order = np.argsort(ids, kind='mergesort')
+            self.ids = ids[order]
+            self.times = np.concatenate([self.times, update_times[new][index]])[order]
+        return updated
+
+    def count_unknown(self, file_ids):
+        """Number of distinct files of `file_ids` which are not recorded yet.
+        """
+        file_ids = np.asarray(file_ids, dtype=np.int64)
+        _, found = self._find(file_ids)
+        return len(np.unique(file_ids[~found]))
+
+    def retain(self, file_ids, invert=False):
+        """Drops every file not in the sorted int64 array `file_ids`, or every
+        file in it if `invert`. Returns the number of dropped files.
+        """
+        keep = np.isin(self.ids, file_ids, assume_unique=True, invert=invert)
+        dropped = len(self.ids) - int(keep.sum())
+        if dropped:
+            self.ids = self.ids[keep]
+            self.times = self.times[keep]
+        return dropped
+
+
+class FileVersionTable:
+    """Per read-only host tables of the file versions each host was last
+    asked to reload.
+
+    Hosts are dropped when their topology group is deleted. Files are
+    dropped once the routing of their collection no longer lists them, and
+    on every full resync of the metadata mirror. A host table growing beyond
+    `max_files` is reset, which costs one extra reload of its files.
+    """
+
+    def __init__(self, max_files=1 << 22, max_scopes=1024, name='router.file_versions'):
+        self.max_files = max_files
+        self.max_scopes = max_scopes
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # The files last routed for every collection list, by `refresh`
+        self.scopes = OrderedDict()
+        self.pruned = REGISTRY.counter('{}.pruned'.format(name))
+        REGISTRY.gauge('{}.files'.format(name), func=lambda: sum(len(t) for t in list(self.hosts.values())))
+        REGISTRY.gauge('{}.bytes'.format(name), func=self.nbytes)
+
+    def nbytes(self):
+        return sum(table.nbytes for table in list(self.hosts.values()))
+
+    def filter(self, host, files_list):
+        """Records the `(file_id, updated_time)` pairs of `files_list` for
+        `host` and returns the ids of the files whose version changed.
+        """
+        if not files_list:
+            return []
+        file_ids, update_times = zip(*files_list)
+        int_ids = [int(file_id) for file_id in file_ids]
+        with self.lock:
+            table = self.hosts.get(host, None)
+            if table is not None and len(table) + table.count_unknown(int_ids) > self.max_files:
+                logger.warning('File version table of {} is full, resetting it'.format(host))
+                table = None
+            if table is None:
+                table = self.hosts[host] = HostFileVersions()
+            updated = table.update(int_ids, update_times)
+
+        file_need_update_list = [file_id for file_id, ud in zip(file_ids, updated) if ud]
+        if file_need_update_list:
+            logger.debug('[{}] {} files need to be updated'.format(host, len(file_need_update_list)))
+        return file_need_update_list
+
+    def stale(self, host, files_list):
+        """Ids of the files of `files_list` whose version is newer than the
+        one recorded for `host`, which `filter` would return, without
+        recording anything.
+        """
+        if not files_list:
+            return []
+        file_ids, update_times = zip(*files_list)
+        recorded = self.lookup(host, file_ids)
+        return [file_id for file_id, update_time, known in zip(file_ids, update_times, recorded)
+                if known < int(update_time)]
+
+    def lookup(self, host, file_ids):
+        with self.lock:
+            table = self.hosts.get(host, None)
+            if table is None:
+                return np.zeros(len(file_ids), dtype=np.int64)
+            return table.lookup([int(file_id) for file_id in file_ids])
+
+    def drop_host(self, host):
+        with self.lock:
+            table = self.hosts.pop(host, None)
+        if table is not None:
+            self.pruned.inc(len(table))
+            logger.info('Dropped file versions of {}'.format(host))
+
+    def retain(self, file_ids):
+        """Drops the files not in `file_ids` from the tables of all hosts.
+        """
+        file_ids = np.unique(np.asarray(list(file_ids), dtype=np.int64))
+        dropped = 0
+        with self.lock:
+            for table in self.hosts.values():
+                dropped += table.retain(file_ids)
+        if dropped:
+            self.pruned.inc(dropped)
+            logger.info('Pruned {} vanished files from the file version tables'.format(dropped))
+        return dropped
+
+    def refresh(self, scope, file_ids):
+        """Records `file_ids` as the searchable files of `scope`, the collection
+        list of a routing, and drops the files of `scope` which vanished since
+        its previous refresh from the tables of all hosts.
+        """
+        file_ids = np.unique(np.asarray(list(file_ids), dtype=np.int64))
+        dropped = 0
+        with self.lock:
+            previous = self.scopes.pop(scope, None)
+            self.scopes[scope] = file_ids
+            while len(self.scopes) > self.max_scopes:
+                self.scopes.popitem(last=False)
+            if previous is None:
+                return 0
+            vanished = np.setdiff1d(previous, file_ids, assume_unique=True)
+            if len(vanished):
+                for table in self.hosts.values():
+                    dropped += table.retain(vanished, invert=True)
+        if dropped:
+            self.pruned.inc(dropped)
+            logger.debug('Pruned {} vanished files of {} from the file version tables'.format(dropped, scope))
+        return dropped
+
+
+# Shared by all router plugins
+file_versions = FileVersionTable()
+
+
+def filter_file_to_update(host, files_list):
+    return file_versions.filter(host, files_list)
+
+
+def stale_files(host, files_list):
+    return file_versions.stale(host, files_list)
+
+
+def prune_vanished_files(collection_list, file_ids):
+    """Drops the files of `collection_list` which are no longer searchable
+    from the file versions, `file_ids` being the searchable ones.
+    """
+    return file_versions.refresh(tuple(sorted(collection_list)), file_ids)
+
+
+def filter_file_to_update_from(host, source_host, file_ids):
+    """`filter_file_to_update` for files which were routed to `source_host`
+    but are searched on `host`.
+    """
+    update_times = file_versions.lookup(source_host, file_ids)
+    return filter_file_to_update(host, [(file_id, update_time)
+                                        for file_id, update_time in zip(file_ids, update_times)
+                                        if update_time])
@@ -2,6 +2,8 @@ import logging
 import sys
 import grpc
 import time
+import asyncio
+import threading
 import socket
 import inspect
 from urllib.parse import urlparse
@@ -32,6 +34,17 @@ class Server:
                  discover,
                  port=19530,
                  max_workers=10,
+                 max_search_workers=10,
+                 hedge_percentile=None,
+                 search_batch_window=0,
+                 search_batch_size=64,
+                 metadata_cache_ttl=60,
+                 metadata_cache_size=4096,
+                 segment_reload_interval=0,
+                 segment_reload_batch_size=64,
+                 async_mode=False,
+                 reuse_port=False,
+                 admission=None,
                  **kwargs):
         self.port = int(port)
         self.writable_topo = writable_topo
@@ -39,18 +52,46 @@ class Server:
         self.tracer = tracer
         self.router = router
         self.discover = discover
-
-        logger.debug('Init grpc server with max_workers: {}'.format(max_workers))
-
-        self.server_impl = grpc.server(
-            thread_pool=futures.ThreadPoolExecutor(max_workers=max_workers),
-            options=[(cygrpc.ChannelArgKey.max_send_message_length, -1),
-                     (cygrpc.ChannelArgKey.max_receive_message_length, -1)])
-
-        self.server_impl = self.tracer.decorate(self.server_impl)
+        self.max_search_workers = max_search_workers
+        self.hedge_percentile = hedge_percentile
+        self.search_batch_window = search_batch_window
+        self.search_batch_size = search_batch_size
+        self.metadata_cache_ttl = metadata_cache_ttl
+        self.metadata_cache_size = metadata_cache_size
+        self.segment_reload_interval = segment_reload_interval
+        self.segment_reload_batch_size = segment_reload_batch_size
+        self.max_workers = max_workers
+        self.async_mode = async_mode
+        self.reuse_port = reuse_port
+        self.admission = admission
+        self.handler = None
+        self.loop = None
+
+        if async_mode:
+            # The grpc.aio server is bound to its event loop, so it is created by start()
+            self.server_impl = None
+            if not self.tracer.empty:
+                logger.warning('Server interceptors for tracing are not supported in async mode')
+        else:
+            logger.debug('Init grpc server with max_workers: {}'.format(max_workers))
+
+            self.server_impl = grpc.server(
+                thread_pool=futures.ThreadPoolExecutor(max_workers=max_workers),
+                options=self.grpc_options)
+
+            self.server_impl = self.tracer.decorate(self.server_impl)
 
         self.register_pre_run_handler(self.pre_run_handler)
 
+    @property
+    def grpc_options(self):
+        options = [(cygrpc.ChannelArgKey.max_send_message_length, -1),
+                   (cygrpc.ChannelArgKey.max_receive_message_length, -1)]
+        if self.reuse_port:
+            # Worker processes of a supervisor listen on the same port
+            options.append(('grpc.so_reuseport', 1))
+        return options
+
     def pre_run_handler(self):
         woserver = settings.WOSERVER
         url = urlparse(woserver)
@@ -65,6 +106,18 @@ class Server:
         return func
 
     def wrap_method_with_errorhandler(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    if e.__class__ in self.error_handlers:
+                        return self.error_handlers[e.__class__](e)
+                    raise
+
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             try:
@@ -91,15 +144,61 @@ class Server:
             handler()
         return self.discover.start()
 
+    def create_handler(self, handler_class):
+        return handler_class(tracer=self.tracer,
+                             router=self.router,
+                             max_workers=self.max_search_workers,
+                             hedge_percentile=self.hedge_percentile,
+                             search_batch_window=self.search_batch_window,
+                             search_batch_size=self.search_batch_size,
+                             metadata_cache_ttl=self.metadata_cache_ttl,
+                             metadata_cache_size=self.metadata_cache_size,
+                             segment_reload_interval=self.segment_reload_interval,
+                             segment_reload_batch_size=self.segment_reload_batch_size)
+
     def start(self, port=None):
+        # The health monitor of the read-only nodes belongs to this app
+        monitor = getattr(self.readonly_topo, 'monitor', None)
+        if monitor is not None and monitor.ident is None:
+            monitor.start()
+
+        if self.async_mode:
+            return self.start_async(port)
+
         handler_class = self.decorate_handler(ServiceHandler)
-        add_MilvusServiceServicer_to_server(
-            handler_class(tracer=self.tracer,
-                          router=self.router), self.server_impl)
+        self.handler = self.create_handler(handler_class)
+        add_MilvusServiceServicer_to_server(self.handler, self.server_impl)
         self.server_impl.add_insecure_port("[::]:{}".format(
             str(port or self.port)))
         self.server_impl.start()
 
+    def start_async(self, port=None):
+        """Serves with grpc.aio on an event loop running in its own thread.
+
+        Search is served by coroutines on the loop; the other RPCs are still
+        plain methods and run in a pool of `max_workers` threads.
+        """
+        from grpc import aio
+        from mishards.aio_service_handler import AsyncServiceHandler
+
+        self.decorate_handler(ServiceHandler)
+        handler_class = self.decorate_handler(AsyncServiceHandler)
+        self.handler = self.create_handler(handler_class)
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='AioServer', daemon=True).start()
+
+        async def serve():
+            self.server_impl = aio.server(
+                migration_thread_pool=futures.ThreadPoolExecutor(max_workers=self.max_workers),
+                options=self.grpc_options)
+            add_MilvusServiceServicer_to_server(self.handler, self.server_impl)
+            self.server_impl.add_insecure_port("[::]:{}".format(
+                str(port or self.port)))
+            await self.server_impl.start()
+
+        asyncio.run_coroutine_threadsafe(serve(), self.loop).result()
+
     def run(self, port):
         logger.info('Milvus server start ......')
         port = port or self.port
@@ -123,12 +222,24 @@ class Server:
     def stop(self):
         logger.info('Server is shuting down ......')
         self.exit_flag = True
-        self.server_impl.stop(0)
+        if self.loop is not None:
+            if self.server_impl is not None:
+                asyncio.run_coroutine_threadsafe(self.server_impl.stop(0), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+        elif self.server_impl is not None:
+            self.server_impl.stop(0)
+        self.handler and self.handler.stop()
+        monitor = getattr(self.readonly_topo, 'monitor', None)
+        monitor and monitor.stop()
         self.tracer.close()
         logger.info('Server is closed')
 
     def decorate_handler(self, handler):
         for key, attr in handler.__dict__.items():
             if is_grpc_method(attr):
+                if self.admission is not None and not getattr(attr, 'admission', False):
+                    attr = self.admission.wrap(key, attr)
+                    attr.admission = True
                 setattr(handler, key, self.wrap_method_with_errorhandler(attr))
         return handler
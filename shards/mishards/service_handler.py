@@ -2,102 +2,366 @@ import logging
 import time
 import json
 import ujson
+import threading
 
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from milvus.grpc_gen import milvus_pb2, milvus_pb2_grpc, status_pb2
 from milvus.client import types as Types
 from milvus import MetricType
 
-from mishards import (db, exceptions)
+from mishards import (db, exceptions, merge, metrics)
+from mishards.coalescer import SearchCoalescer
+from mishards.metadata_cache import MetadataCache
+from mishards.reloader import SegmentReloader
 from mishards.grpc_utils import mark_grpc_method
+from mishards.grpc_utils import records
 from mishards.grpc_utils.grpc_args_parser import GrpcArgsParser as Parser
 
 logger = logging.getLogger(__name__)
 
 
+class QueryScope:
+    """The backend calls of one query, which are cancelled together once
+    the client deadline expired or the client went away.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.calls = []
+        self.cancelled = False
+
+    @classmethod
+    def from_context(cls, context):
+        remaining = context.time_remaining() if context is not None else None
+        return cls(None if remaining is None else time.time() + remaining)
+
+    def remaining(self):
+        """Seconds left until the deadline, None without deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def track(self, call):
+        with self.lock:
+            if not self.cancelled:
+                self.calls.append(call)
+                return
+        call.cancel()
+
+    def cancel(self):
+        """Cancels the calls still running, and the ones tracked from now on.
+        Returns the number of cancelled calls.
+        """
+        with self.lock:
+            self.cancelled = True
+            calls, self.calls = self.calls, []
+        cancelled = 0
+        for call in calls:
+            grpc_future = getattr(call, '_future', None)
+            if grpc_future is not None and grpc_future.done():
+                continue
+            self.cancel_call(call)
+            cancelled += 1
+        return cancelled
+
+    def cancel_call(self, call):
+        # A call still running once the deadline expired timed out on its node
+        expire = getattr(call, 'expire', None) if self.expired() else None
+        expire() if expire is not None else call.cancel()
+
+
+class ShardBudget:
+    """Shards of a search returning partial results. Shards which failed, or
+    did not answer within `budget` seconds if there is a budget, are left
+    out of the merge and reported missing.
+    """
+
+    def __init__(self, routing, budget=None):
+        self.routing = routing
+        self.deadline = None if budget is None else time.time() + budget
+        self.missing = set()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def miss(self, addr, error=None):
+        if addr in self.missing:
+            return
+        self.missing.add(addr)
+        logger.warning('<{}> left out of partial results: {}'.format(addr, error or 'shard budget exceeded'))
+
+    def reason(self):
+        segments = sum(len(self.routing[addr][0]) for addr in self.missing)
+        total = sum(len(search_file_ids) for search_file_ids, _ in self.routing.values())
+        return 'Partial results: {} of {} shards missing, {} of {} segments'.format(
+            len(self.missing), len(self.routing), segments, total)
+
+
 class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
     MAX_NPROBE = 2048
     MAX_TOPK = 2048
-
-    def __init__(self, tracer, router, max_workers=multiprocessing.cpu_count(), **kwargs):
-        self.collection_meta = {}
+    # No hedged request is sent to a node with fewer recorded searches
+    HEDGE_MIN_SAMPLES = 20
+    # Seconds between two checks whether the client of a search is still there
+    CLIENT_CHECK_INTERVAL = 0.1
+    # Search parameters asking for partial results, optionally within a
+    # budget in milliseconds for the shards to answer
+    PARTIAL_RESULTS_PARAM = 'partial_results'
+    SHARD_BUDGET_PARAM = 'shard_budget_ms'
+
+    def __init__(self, tracer, router, max_workers=multiprocessing.cpu_count(),
+                 hedge_percentile=None, search_batch_window=0, search_batch_size=64,
+                 metadata_cache_ttl=60, metadata_cache_size=4096,
+                 segment_reload_interval=0, segment_reload_batch_size=64, **kwargs):
+        self.metadata_cache = MetadataCache(ttl=metadata_cache_ttl, capacity=metadata_cache_size)
         self.error_handlers = {}
         self.tracer = tracer
         self.router = router
         self.max_workers = max_workers
+        self.search_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.hedge_percentile = hedge_percentile
+        self.hedges = metrics.REGISTRY.counter('search.hedges')
+        self.hedge_wins = metrics.REGISTRY.counter('search.hedge_wins')
+        self.deadline_exceeded = metrics.REGISTRY.counter('search.deadline_exceeded')
+        self.client_cancelled = metrics.REGISTRY.counter('search.client_cancelled')
+        self.cancelled_calls = metrics.REGISTRY.counter('search.cancelled_calls')
+        self.partial_searches = metrics.REGISTRY.counter('search.partial')
+        self.missing_shards = metrics.REGISTRY.counter('search.missing_shards')
+        self.coalescer = None
+        if search_batch_window > 0:
+            self.coalescer = SearchCoalescer(window=search_batch_window / 1000.0,
+                                             max_queries=search_batch_size)
+        self.reloader = None
+        if segment_reload_interval > 0:
+            self.reloader = SegmentReloader(router, interval=segment_reload_interval,
+                                            batch_size=segment_reload_batch_size)
+            self.reloader.start()
+
+    def latency(self, addr):
+        return metrics.REGISTRY.histogram('search.latency.{}'.format(addr))
+
+    def _hedge_delay(self, addr):
+        if self.hedge_percentile is None:
+            return None
+        histogram = self.latency(addr)
+        if histogram.count < self.HEDGE_MIN_SAMPLES:
+            return None
+        return histogram.percentile(self.hedge_percentile)
+
+    def stop(self):
+        self.search_executor.shutdown(wait=False)
+        self.reloader and self.reloader.stop()
+
+    def _merge_result(self, reducer):
+        error, ids, diss = reducer.result()
+        if error is not None:
+            return error, [], []
 
-    def _reduce(self, source_ids, ids, source_diss, diss, k, reverse):
-        if source_diss[k - 1] <= diss[0]:
-            return source_ids, source_diss
-        if diss[k - 1] <= source_diss[0]:
-            return ids, diss
-
-        source_diss.extend(diss)
-        diss_t = enumerate(source_diss)
-        diss_m_rst = sorted(diss_t, key=lambda x: x[1])[:k]
-        diss_m_out = [id_ for _, id_ in diss_m_rst]
-
-        source_ids.extend(ids)
-        id_m_out = [source_ids[i] for i, _ in diss_m_rst]
-
-        return id_m_out, diss_m_out
-
-    def _do_merge(self, files_n_topk_results, topk, reverse=False, **kwargs):
         status = status_pb2.Status(error_code=status_pb2.SUCCESS,
                                    reason="Success")
-        if not files_n_topk_results:
+        if ids is None:
             return status, [], []
 
-        merge_id_results = []
-        merge_dis_results = []
+        # Kept as int64/float32 arrays, the reply is built from them in bulk
+        return status, ids.ravel(), diss.ravel()
+
+    def _merge_partial_result(self, reducer, budget):
+        """`_merge_result` of a search which may return partial results, the
+        missing shards are reported in the status reason.
+        """
+        if budget is None or not budget.missing:
+            return self._merge_result(reducer)
+        self.partial_searches.inc()
+        self.missing_shards.inc(len(budget.missing))
+        if len(budget.missing) == len(budget.routing):
+            reducer.add((status_pb2.Status(error_code=status_pb2.UNEXPECTED_ERROR,
+                                           reason=budget.reason()), None))
+        status, ids, distances = self._merge_result(reducer)
+        if status.error_code == status_pb2.SUCCESS:
+            status.reason = budget.reason()
+        return status, ids, distances
 
+    def _do_merge(self, files_n_topk_results, topk, reverse=False, **kwargs):
         calc_time = time.time()
-        for files_collection in files_n_topk_results:
-            if isinstance(files_collection, tuple):
-                status, _ = files_collection
-                return status, [], []
-
-            if files_collection.status.error_code != 0:
-                return files_collection.status, [], []
 
-            row_num = files_collection.row_num
-            # row_num is equal to 0, result is empty
-            if not row_num:
-                continue
+        reducer = merge.TopKReducer(topk, reverse=reverse)
+        for files_collection in files_n_topk_results:
+            if not reducer.add(files_collection, fold=False):
+                break
 
-            ids = files_collection.ids
-            diss = files_collection.distances  # distance collections
-            # TODO: batch_len is equal to topk, may need to compare with topk
-            batch_len = len(ids) // row_num
-
-            for row_index in range(row_num):
-                id_batch = ids[row_index * batch_len: (row_index + 1) * batch_len]
-                dis_batch = diss[row_index * batch_len: (row_index + 1) * batch_len]
-
-                if len(merge_id_results) < row_index:
-                    raise ValueError("merge error")
-                elif len(merge_id_results) == row_index:
-                    # TODO: may bug here
-                    merge_id_results.append(id_batch)
-                    merge_dis_results.append(dis_batch)
-                else:
-                    merge_id_results[row_index], merge_dis_results[row_index] = \
-                        self._reduce(merge_id_results[row_index], id_batch,
-                                     merge_dis_results[row_index], dis_batch,
-                                     batch_len,
-                                     reverse)
+        result = self._merge_result(reducer)
 
         calc_time = time.time() - calc_time
         logger.info('Merge takes {}'.format(calc_time))
 
-        id_mrege_list = []
-        dis_mrege_list = []
-
-        for id_results, dis_results in zip(merge_id_results, merge_dis_results):
-            id_mrege_list.extend(id_results)
-            dis_mrege_list.extend(dis_results)
-
-        return status, id_mrege_list, dis_mrege_list
+        return result
+
+    def _search_in_shard(self, addr, collection_id, search_file_ids, ud_file_ids,
+                         vectors, topk, search_params, span=None, metadata=None, scope=None):
+        logger.info(f"<{addr}> needed update segment ids {ud_file_ids}")
+        scope = scope or QueryScope()
+        conn = self.router.query_conn(addr, metadata=metadata)
+        with self.tracer.start_span('search_{}'.format(addr), child_of=span), self.router.track(addr):
+            started = time.time()
+            if self.reloader is not None:
+                self.reloader.submit(addr, collection_id, ud_file_ids)
+                self.reloader.wait(addr, search_file_ids, timeout=scope.remaining())
+            elif ud_file_ids:
+                conn.reload_segments(collection_id, ud_file_ids, timeout=scope.remaining())
+            future = conn.search_in_segment(collection_name=collection_id,
+                                            file_ids=search_file_ids,
+                                            query_records=vectors,
+                                            top_k=topk,
+                                            params=search_params,
+                                            timeout=scope.remaining(), _async=True)
+            scope.track(future)
+            result = future.result(raw=True)
+            self.latency(addr).observe(time.time() - started)
+            return result
+
+    def _wait_timeout(self, scope, context, timeout=None):
+        """How long to wait for shard results before the deadline, or the
+        client, has to be checked again.
+        """
+        if context is not None:
+            timeout = self.CLIENT_CHECK_INTERVAL if timeout is None else min(timeout, self.CLIENT_CHECK_INTERVAL)
+        remaining = scope.remaining()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _abort_status(self, scope, context):
+        """The error status of a search whose deadline expired or whose
+        client went away, None if it goes on.
+        """
+        if scope.expired():
+            self.deadline_exceeded.inc()
+            reason = 'Search deadline exceeded'
+        elif context is not None and not context.is_active():
+            self.client_cancelled.inc()
+            reason = 'Search cancelled by the client'
+        else:
+            return None
+        logger.warning(reason)
+        return status_pb2.Status(error_code=status_pb2.UNEXPECTED_ERROR, reason=reason)
+
+    def _aborted(self, scope, context, reducer):
+        """Records an error in `reducer` if the deadline expired or the client
+        went away, the search is then given up.
+        """
+        status = self._abort_status(scope, context)
+        if status is None:
+            return False
+        reducer.add((status, None))
+        return True
+
+    def _shard_result(self, future, budget=None):
+        """The result of a shard search. Without a shard budget its errors
+        are raised, else they are returned as an SDK `(status, None)` tuple.
+        """
+        if budget is None:
+            return future.result()
+        try:
+            return future.result()
+        except Exception as exc:
+            return status_pb2.Status(error_code=status_pb2.UNEXPECTED_ERROR, reason=str(exc)), None
+
+    def _gather(self, shard_futures, reducer, scope=None, context=None, budget=None):
+        """Folds the shard results into `reducer` as they complete. With a
+        shard budget failed and late shards are reported to it and left out.
+        """
+        scope = scope or QueryScope()
+        pending = set(shard_futures)
+        while pending:
+            timeout = self._wait_timeout(scope, context, budget and budget.remaining())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                host, addr = shard_futures[future]
+                result = self._shard_result(future, budget)
+                if budget is not None and merge.is_error(result):
+                    budget.miss(addr, merge.error_reason(result))
+                    continue
+                if not reducer.add(result):
+                    logger.error('<{}> search failed: {}'.format(host, reducer.error))
+                    return
+            if pending and budget is not None and budget.expired():
+                for future in pending:
+                    budget.miss(shard_futures[future][1])
+                return
+            if pending and self._aborted(scope, context, reducer):
+                return
+
+    def _gather_hedged(self, shard_futures, reducer, hedge, scope=None, context=None, budget=None):
+        """Like `_gather`, but a shard which has not answered within its hedge
+        delay is sent to an alternate node by `hedge(addr)`. The first successful
+        answer of a shard is taken; an error only counts once no other request
+        for the shard is pending.
+        """
+        pending = set(shard_futures)
+        shards = set(addr for _, addr in shard_futures.values())
+        started = time.time()
+        deadlines = {}
+        for addr in shards:
+            delay = self._hedge_delay(addr)
+            if delay is not None:
+                deadlines[addr] = started + delay
+
+        scope = scope or QueryScope()
+        answered = set()
+        while pending and len(answered) < len(shards):
+            timeout = None
+            if deadlines:
+                timeout = max(min(deadlines.values()) - time.time(), 0)
+            if budget is not None and budget.deadline is not None:
+                timeout = budget.remaining() if timeout is None else min(timeout, budget.remaining())
+            done, _ = wait(pending, timeout=self._wait_timeout(scope, context, timeout),
+                           return_when=FIRST_COMPLETED)
+            if not done and budget is not None and budget.expired():
+                for addr in shards - answered:
+                    budget.miss(addr)
+                return
+            if not done and self._aborted(scope, context, reducer):
+                return
+
+            for future in done:
+                pending.discard(future)
+                host, addr = shard_futures[future]
+                if addr in answered:
+                    continue
+                result = self._shard_result(future, budget)
+                if merge.is_error(result) and any(shard_futures[f][1] == addr for f in pending):
+                    logger.warning('<{}> search failed, waiting for the hedged request'.format(host))
+                    continue
+                answered.add(addr)
+                deadlines.pop(addr, None)
+                if budget is not None and merge.is_error(result):
+                    budget.miss(addr, merge.error_reason(result))
+                    continue
+                if host != addr:
+                    self.hedge_wins.inc()
+                if not reducer.add(result):
+                    logger.error('<{}> search failed: {}'.format(host, reducer.error))
+                    return
+
+            now = time.time()
+            for addr, deadline in list(deadlines.items()):
+                if deadline > now:
+                    continue
+                deadlines.pop(addr)
+                future = hedge(addr)
+                if future is not None:
+                    pending.add(future)
 
     def _do_query(self,
                   context,
@@ -109,6 +373,15 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                   partition_tags=None,
                   **kwargs):
         metadata = kwargs.get('metadata', None)
+        # The query is converted once and the same records go to every shard
+        vectors = records.sdk_query_records(vectors)
+        self.reloader and self.reloader.watch(collection_id)
+        # The client deadline bounds every backend call of this query, unless
+        # the query runs in a scope of its own, e.g. for a coalesced batch
+        scope = kwargs.get('scope', None) or QueryScope.from_context(context)
+        # A detached query does not stop when the client of `context` went away
+        client = None if kwargs.get('detached', False) else context
+        budget = None
 
         routing = {}
         p_span = None if self.tracer.empty else context.get_active_span(
@@ -119,49 +392,74 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                                           metadata=metadata)
         logger.info('Routing: {}'.format(routing))
 
-        metadata = kwargs.get('metadata', None)
-
-        all_topk_results = []
+        reverse = collection_meta.metric_type == Types.MetricType.IP
+        reducer = merge.TopKReducer(topk, reverse=reverse)
 
         with self.tracer.start_span('do_search', child_of=p_span) as span:
             if len(routing) == 0:
-                ft = self.router.connection().search(collection_id, topk, vectors, list(partition_tags), search_params, _async=True)
+                ft = self.router.connection().search(collection_id, topk, vectors,
+                                                     list(partition_tags), search_params,
+                                                     timeout=scope.remaining(), _async=True)
                 ret = ft.result(raw=True)
-                all_topk_results.append(ret)
+                reducer.add(ret)
             else:
-                futures = []
+                span = kwargs.get('span', None)
+                span = span if span else (None if self.tracer.empty else
+                                          context.get_active_span().context)
+
+                # Scatter: dispatch every shard (including its reload pre-step) up front.
+                # Every future maps to (host searched, shard addr it answers for)
+                shard_futures = {}
+
+                def submit(host, addr, search_file_ids, ud_file_ids):
+                    future = self.search_executor.submit(self._search_in_shard, host,
+                                                         collection_id, search_file_ids,
+                                                         ud_file_ids, vectors, topk,
+                                                         search_params, span=span,
+                                                         metadata=metadata, scope=scope)
+                    shard_futures[future] = (host, addr)
+                    return future
+
+                if kwargs.get('partial_results', False):
+                    budget = ShardBudget(routing, kwargs.get('shard_budget', None))
                 for addr, files_tuple in routing.items():
                     search_file_ids, ud_file_ids = files_tuple
-                    logger.info(f"<{addr}> needed update segment ids {ud_file_ids}")
-                    conn = self.router.query_conn(addr, metadata=metadata)
-                    start = time.time()
-                    ud_file_ids and conn.reload_segments(collection_id, ud_file_ids)
-                    span = kwargs.get('span', None)
-                    span = span if span else (None if self.tracer.empty else
-                                              context.get_active_span().context)
-
-                    with self.tracer.start_span('search_{}'.format(addr),
-                                                child_of=span):
-                        future = conn.search_in_segment(collection_name=collection_id,
-                                                              file_ids=search_file_ids,
-                                                              query_records=vectors,
-                                                              top_k=topk,
-                                                              params=search_params, _async=True)
-                        futures.append(future)
-
-                    for f in futures:
-                        ret = f.result(raw=True)
-                        all_topk_results.append(ret)
+                    submit(addr, addr, search_file_ids, ud_file_ids)
+
+                def hedge(addr):
+                    search_file_ids = routing[addr][0]
+                    alternate = self.router.alternate(addr, search_file_ids, metadata=metadata)
+                    if alternate is None:
+                        return None
+                    host, ud_file_ids = alternate
+                    logger.info('<{}> is slow, hedging its search to <{}>'.format(addr, host))
+                    self.hedges.inc()
+                    return submit(host, addr, search_file_ids, ud_file_ids)
+
+                # Gather: fold results into the top-k accumulator as they complete
+                try:
+                    if self.hedge_percentile is None:
+                        self._gather(shard_futures, reducer, scope=scope, context=client, budget=budget)
+                    else:
+                        self._gather_hedged(shard_futures, reducer, hedge, scope=scope, context=client,
+                                            budget=budget)
+                finally:
+                    for future in list(shard_futures):
+                        future.cancel()
+                    # Backend searches nobody waits for anymore, e.g. the ones
+                    # of a failed or abandoned search or the losers of hedges
+                    cancelled = scope.cancel()
+                    if cancelled:
+                        self.cancelled_calls.inc(cancelled)
 
-        reverse = collection_meta.metric_type == Types.MetricType.IP
         with self.tracer.start_span('do_merge', child_of=p_span):
-            return self._do_merge(all_topk_results,
-                                  topk,
-                                  reverse=reverse,
-                                  metadata=metadata)
+            return self._merge_partial_result(reducer, budget)
 
     def _create_collection(self, collection_schema):
-        return self.router.connection().create_collection(collection_schema)
+        try:
+            return self.router.connection().create_collection(collection_schema)
+        finally:
+            self.metadata_cache.invalidate(collection_schema['collection_name'])
 
     @mark_grpc_method
     def CreateCollection(self, request, context):
@@ -184,7 +482,9 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                                  reason=_status.message)
 
     def _has_collection(self, collection_name, metadata=None):
-        return self.router.connection(metadata=metadata).has_collection(collection_name)
+        return self.metadata_cache.get(
+            collection_name, 'has',
+            lambda: self.router.connection(metadata=metadata).has_collection(collection_name))
 
     @mark_grpc_method
     def HasCollection(self, request, context):
@@ -204,18 +504,30 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
             error_code=_status.code, reason=_status.message),
             bool_reply=_bool)
 
+    def _create_partition(self, collection_name, tag):
+        try:
+            return self.router.connection().create_partition(collection_name, tag)
+        finally:
+            self.metadata_cache.invalidate(collection_name)
+
     @mark_grpc_method
     def CreatePartition(self, request, context):
         _collection_name, _tag = Parser.parse_proto_PartitionParam(request)
-        _status = self.router.connection().create_partition(_collection_name, _tag)
+        _status = self._create_partition(_collection_name, _tag)
         return status_pb2.Status(error_code=_status.code,
                                  reason=_status.message)
 
+    def _drop_partition(self, collection_name, tag):
+        try:
+            return self.router.connection().drop_partition(collection_name, tag)
+        finally:
+            self.metadata_cache.invalidate(collection_name)
+
     @mark_grpc_method
     def DropPartition(self, request, context):
         _collection_name, _tag = Parser.parse_proto_PartitionParam(request)
 
-        _status = self.router.connection().drop_partition(_collection_name, _tag)
+        _status = self._drop_partition(_collection_name, _tag)
         return status_pb2.Status(error_code=_status.code,
                                  reason=_status.message)
 
@@ -226,6 +538,11 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
         return milvus_pb2.BoolReply(status=status_pb2.Status(error_code=_status.code,
                                  reason=_status.message), bool_reply=_ok)
 
+    def _list_partitions(self, collection_name, metadata=None):
+        return self.metadata_cache.get(
+            collection_name, 'partitions',
+            lambda: self.router.connection(metadata=metadata).list_partitions(collection_name))
+
     @mark_grpc_method
     def ShowPartitions(self, request, context):
         _status, _collection_name = Parser.parse_proto_CollectionName(request)
@@ -236,14 +553,17 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
 
         logger.info('ShowPartitions {}'.format(_collection_name))
 
-        _status, partition_array = self.router.connection().list_partitions(_collection_name)
+        _status, partition_array = self._list_partitions(_collection_name)
 
         return milvus_pb2.PartitionList(status=status_pb2.Status(
             error_code=_status.code, reason=_status.message),
             partition_tag_array=[param.tag for param in partition_array])
 
     def _drop_collection(self, collection_name):
-        return self.router.connection().drop_collection(collection_name)
+        try:
+            return self.router.connection().drop_collection(collection_name)
+        finally:
+            self.metadata_cache.invalidate(collection_name)
 
     @mark_grpc_method
     def DropCollection(self, request, context):
@@ -261,7 +581,10 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                                  reason=_status.message)
 
     def _create_index(self, collection_name, index_type, param):
-        return self.router.connection().create_index(collection_name, index_type, param)
+        try:
+            return self.router.connection().create_index(collection_name, index_type, param)
+        finally:
+            self.metadata_cache.invalidate(collection_name)
 
     @mark_grpc_method
     def CreateIndex(self, request, context):
@@ -295,11 +618,7 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
             error_code=_status.code, reason=_status.message),
             vector_id_array=_ids)
 
-    @mark_grpc_method
-    def Search(self, request, context):
-
-        metadata = {'resp_class': milvus_pb2.TopKQueryResult}
-
+    def _parse_search_request(self, request, metadata=None):
         collection_name = request.collection_name
 
         topk = request.topk
@@ -319,47 +638,94 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
             raise exceptions.InvalidTopKError(
                 message='Invalid topk: {}'.format(topk), metadata=metadata)
 
-        collection_meta = self.collection_meta.get(collection_name, None)
+        status, collection_meta = self._describe_collection(collection_name, metadata=metadata)
+        if not status.OK():
+            raise exceptions.CollectionNotFoundError(collection_name,
+                                                metadata=metadata)
+
+        binary = int(collection_meta.metric_type) >= MetricType.HAMMING.value
+        try:
+            query_record_array = records.pack_records(request.query_record_array, binary=binary)
+        except ValueError as e:
+            raise exceptions.InvalidArgumentError(message=str(e), metadata=metadata)
+
+        partition_tags = getattr(request, "partition_tag_array", [])
+        return collection_name, topk, params, collection_meta, query_record_array, partition_tags
+
+    def _partial_options(self, params, metadata=None):
+        """Pops the partial results parameters out of the search `params`.
+        Returns whether partial results were asked for and the shard budget
+        in seconds, a budget implying partial results.
+        """
+        partial = params.pop(self.PARTIAL_RESULTS_PARAM, False)
+        budget = params.pop(self.SHARD_BUDGET_PARAM, None)
+        if not isinstance(partial, bool):
+            raise exceptions.InvalidArgumentError(
+                message='Invalid {}: {}'.format(self.PARTIAL_RESULTS_PARAM, partial), metadata=metadata)
+        if budget is None:
+            return partial, None
+        if isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget <= 0:
+            raise exceptions.InvalidArgumentError(
+                message='Invalid {}: {}'.format(self.SHARD_BUDGET_PARAM, budget), metadata=metadata)
+        return True, budget / 1000.0
+
+    def _search_reply(self, request, status, id_results, dis_results):
+        return records.topk_query_result(
+            status=status_pb2.Status(error_code=status.error_code,
+                                     reason=status.reason),
+            row_num=len(request.query_record_array) if len(id_results) else 0,
+            ids=id_results,
+            distances=dis_results)
+
+    @mark_grpc_method
+    def Search(self, request, context):
+
+        metadata = {'resp_class': milvus_pb2.TopKQueryResult}
 
-        if not collection_meta:
-            status, info = self.router.connection(
-                metadata=metadata).get_collection_info(collection_name)
-            if not status.OK():
-                raise exceptions.CollectionNotFoundError(collection_name,
-                                                    metadata=metadata)
+        collection_name, topk, params, collection_meta, query_record_array, partition_tags = \
+            self._parse_search_request(request, metadata=metadata)
 
-            self.collection_meta[collection_name] = info
-            collection_meta = info
+        partial_results, shard_budget = self._partial_options(params, metadata=metadata)
 
         start = time.time()
 
-        query_record_array = []
-        if int(collection_meta.metric_type) >= MetricType.HAMMING.value:
-            for query_record in request.query_record_array:
-                query_record_array.append(bytes(query_record.binary_data))
+        def query(query_records, **kwargs):
+            return self._do_query(context,
+                                  collection_name,
+                                  collection_meta,
+                                  query_records,
+                                  topk,
+                                  params,
+                                  partition_tags=partition_tags,
+                                  metadata=metadata,
+                                  partial_results=partial_results,
+                                  shard_budget=shard_budget,
+                                  **kwargs)
+
+        if self.coalescer is None:
+            status, id_results, dis_results = query(query_record_array)
         else:
-            for query_record in request.query_record_array:
-                query_record_array.append(list(query_record.float_data))
-
-        status, id_results, dis_results = self._do_query(context,
-                                                         collection_name,
-                                                         collection_meta,
-                                                         query_record_array,
-                                                         topk,
-                                                         params,
-                                                         partition_tags=getattr(request, "partition_tag_array", []),
-                                                         metadata=metadata)
+            # The partial results options are part of the key, the members of
+            # a batch share them. The batch runs detached from the client of
+            # its opener, until the latest deadline of its members
+            key = (collection_name, topk, ujson.dumps(params, sort_keys=True), tuple(partition_tags),
+                   partial_results, shard_budget)
+            scope = QueryScope.from_context(context)
+
+            def batch_query(query_records, deadline):
+                return query(query_records, scope=QueryScope(deadline), detached=True)
+
+            def abort():
+                status = self._abort_status(scope, context)
+                return None if status is None else (status, [], [])
+
+            status, id_results, dis_results = self.coalescer.search(key, query_record_array, batch_query,
+                                                                    deadline=scope.deadline, abort=abort)
 
         now = time.time()
         logger.info('SearchVector takes: {}'.format(now - start))
 
-        topk_result_list = milvus_pb2.TopKQueryResult(
-            status=status_pb2.Status(error_code=status.error_code,
-                                     reason=status.reason),
-            row_num=len(request.query_record_array) if len(id_results) else 0,
-            ids=id_results,
-            distances=dis_results)
-        return topk_result_list
+        return self._search_reply(request, status, id_results, dis_results)
 
     @mark_grpc_method
     def SearchInFiles(self, request, context):
@@ -432,7 +798,9 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
     #     # raise NotImplemented()
 
     def _describe_collection(self, collection_name, metadata=None):
-        return self.router.connection(metadata=metadata).get_collection_info(collection_name)
+        return self.metadata_cache.get(
+            collection_name, 'describe',
+            lambda: self.router.connection(metadata=metadata).get_collection_info(collection_name))
 
     @mark_grpc_method
     def DescribeCollection(self, request, context):
@@ -539,6 +907,16 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                 error_code=status_pb2.SUCCESS),
                 string_reply=json.dumps(stats, indent=2))
 
+        if _cmd == 'metrics':
+            return milvus_pb2.StringReply(status=status_pb2.Status(
+                error_code=status_pb2.SUCCESS),
+                string_reply=json.dumps(metrics.REGISTRY.stats(), indent=2))
+
+        if _cmd == 'latency':
+            return milvus_pb2.StringReply(status=status_pb2.Status(
+                error_code=status_pb2.SUCCESS),
+                string_reply=json.dumps(metrics.REGISTRY.stats(prefix='search.latency.'), indent=2))
+
         # if _cmd == 'version':
         #     _status, _reply = self._get_server_version(metadata=metadata)
         # else:
@@ -583,7 +961,9 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
         raise NotImplementedError("Not implemented in mishards")
 
     def _describe_index(self, collection_name, metadata=None):
-        return self.router.connection(metadata=metadata).get_index_info(collection_name)
+        return self.metadata_cache.get(
+            collection_name, 'index',
+            lambda: self.router.connection(metadata=metadata).get_index_info(collection_name))
 
     @mark_grpc_method
     def DescribeIndex(self, request, context):
@@ -688,7 +1068,10 @@ class ServiceHandler(milvus_pb2_grpc.MilvusServiceServicer):
                                  reason=_status.message)
 
     def _drop_index(self, collection_name):
-        return self.router.connection().drop_index(collection_name)
+        try:
+            return self.router.connection().drop_index(collection_name)
+        finally:
+            self.metadata_cache.invalidate(collection_name)
 
     @mark_grpc_method
     def DropIndex(self, request, context):
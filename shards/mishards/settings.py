@@ -28,6 +28,39 @@ SERVER_PORT = env.int('SERVER_PORT', 19530)
 SERVER_TEST_PORT = env.int('SERVER_TEST_PORT', 19530)
 WOSERVER = env.str('WOSERVER')
 MAX_WORKERS = env.int('MAX_WORKERS', 50)
+CONNECTION_PROBE_TIMEOUT = env.float('CONNECTION_PROBE_TIMEOUT', 10)
+CONNECTION_POOL_SIZE = env.int('CONNECTION_POOL_SIZE', 2)
+CIRCUIT_BREAKER_ENABLED = env.bool('CIRCUIT_BREAKER_ENABLED', False)
+CIRCUIT_BREAKER_FAILURES = env.int('CIRCUIT_BREAKER_FAILURES', 5)
+CIRCUIT_BREAKER_ERROR_RATE = env.float('CIRCUIT_BREAKER_ERROR_RATE', 0.5)
+CIRCUIT_BREAKER_TIMEOUT_RATE = env.float('CIRCUIT_BREAKER_TIMEOUT_RATE', 0.25)
+CIRCUIT_BREAKER_RESET_TIMEOUT = env.float('CIRCUIT_BREAKER_RESET_TIMEOUT', 10)
+SERVER_ASYNC_MODE = env.bool('SERVER_ASYNC_MODE', False)
+SERVER_WORKERS = env.int('SERVER_WORKERS', 1)
+MAX_SEARCH_WORKERS = env.int('MAX_SEARCH_WORKERS', 64)
+SEARCH_HEDGE_ENABLED = env.bool('SEARCH_HEDGE_ENABLED', False)
+SEARCH_HEDGE_PERCENTILE = env.float('SEARCH_HEDGE_PERCENTILE', 95)
+SEARCH_BATCH_WINDOW = env.float('SEARCH_BATCH_WINDOW', 0)
+SEARCH_BATCH_SIZE = env.int('SEARCH_BATCH_SIZE', 64)
+METADATA_CACHE_TTL = env.float('METADATA_CACHE_TTL', 60)
+METADATA_CACHE_SIZE = env.int('METADATA_CACHE_SIZE', 4096)
+ADMISSION_ENABLED = env.bool('ADMISSION_ENABLED', False)
+ADMISSION_SEARCH_CAPACITY = env.int('ADMISSION_SEARCH_CAPACITY', 1000000)
+ADMISSION_SEARCH_LIMIT = env.int('ADMISSION_SEARCH_LIMIT', 32)
+ADMISSION_WRITE_LIMIT = env.int('ADMISSION_WRITE_LIMIT', 8)
+ADMISSION_ADMIN_LIMIT = env.int('ADMISSION_ADMIN_LIMIT', 16)
+ADMISSION_MAX_WAIT = env.float('ADMISSION_MAX_WAIT', 1)
+ADMISSION_MAX_QUEUE = env.int('ADMISSION_MAX_QUEUE', 16)
+ADMISSION_CLIENT_RATE = env.float('ADMISSION_CLIENT_RATE', 0)
+ADMISSION_CLIENT_BURST = env.float('ADMISSION_CLIENT_BURST', 0)
+SEGMENT_RELOAD_INTERVAL = env.float('SEGMENT_RELOAD_INTERVAL', 0)
+SEGMENT_RELOAD_BATCH_SIZE = env.int('SEGMENT_RELOAD_BATCH_SIZE', 64)
+NODE_WARMUP_ENABLED = env.bool('NODE_WARMUP_ENABLED', False)
+NODE_WARMUP_TIMEOUT = env.float('NODE_WARMUP_TIMEOUT', 300)
+NODE_DRAIN_TIMEOUT = env.float('NODE_DRAIN_TIMEOUT', 30)
+ROUTER_CACHE_SIZE = env.int('ROUTER_CACHE_SIZE', 1024)
+ROUTER_BOUNDED_LOAD_EPSILON = env.float('ROUTER_BOUNDED_LOAD_EPSILON', 0.25)
+ROUTER_REPLICATION_FACTOR = env.int('ROUTER_REPLICATION_FACTOR', 1)
 
 
 class TracingConfig:
@@ -61,6 +94,9 @@ class DefaultConfig:
     SQL_POOL_TIMEOUT = env.int('pool_timeout', 30)
     SQL_POOL_PRE_PING = env.bool('pool_pre_ping', True)
     SQL_MAX_OVERFLOW = env.int('max_overflow', 0)
+    METADATA_MIRROR_ENABLED = env.bool('METADATA_MIRROR_ENABLED', False)
+    METADATA_MIRROR_POLL_INTERVAL = env.float('METADATA_MIRROR_POLL_INTERVAL', 1)
+    METADATA_MIRROR_RESYNC_INTERVAL = env.float('METADATA_MIRROR_RESYNC_INTERVAL', 300)
     TRACER_PLUGIN_PATH = env.str('TRACER_PLUGIN_PATH', '')
     TRACER_CLASS_NAME = env.str('TRACER_CLASS_NAME', '')
     ROUTER_PLUGIN_PATH = env.str('ROUTER_PLUGIN_PATH', '')
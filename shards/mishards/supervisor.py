@@ -0,0 +1,103 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """Runs `target(index)` in `workers` processes and restarts crashed ones.
+
+    Workers are started with the `spawn` method: gRPC does not survive a
+    fork once its threads are running, and every worker has to build its own
+    topology, discovery client and DB engine anyway.
+
+    A worker which crashes within `min_uptime` seconds of its start is
+    restarted with an exponential backoff capped at `max_backoff` seconds.
+    """
+
+    def __init__(self, target, workers, worker_env=None, min_uptime=10, max_backoff=30,
+                 start_method='spawn'):
+        self.target = target
+        self.workers = workers
+        self.worker_env = worker_env
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.context = multiprocessing.get_context(start_method)
+        self.processes = {}
+        self.started_at = {}
+        self.backoff = {}
+        self.restart_at = {}
+        self.restarts = 0
+        self.terminate = False
+
+    def _start_worker(self, index):
+        if self.worker_env:
+            # Spawned processes inherit the environment at start time
+            os.environ.update(self.worker_env(index))
+        process = self.context.Process(target=self.target, args=(index,),
+                                       name='mishards-worker-{}'.format(index), daemon=True)
+        process.start()
+        logger.info('Started worker {} with pid {}'.format(index, process.pid))
+        self.processes[index] = process
+        self.started_at[index] = time.time()
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def poll(self):
+        """Restarts the workers which exited. Returns the number of running workers.
+        """
+        now = time.time()
+        for index, process in list(self.processes.items()):
+            if process.is_alive() or self.terminate:
+                continue
+
+            if index not in self.restart_at:
+                uptime = now - self.started_at[index]
+                if uptime < self.min_uptime:
+                    self.backoff[index] = min(max(self.backoff.get(index, 0) * 2, 1), self.max_backoff)
+                else:
+                    self.backoff[index] = 0
+                self.restart_at[index] = now + self.backoff[index]
+                logger.error('Worker {} (pid {}) exited with code {} after {:.1f}s, restarting in {}s'.format(
+                    index, process.pid, process.exitcode, uptime, self.backoff[index]))
+
+            if now >= self.restart_at[index]:
+                self.restart_at.pop(index)
+                self.restarts += 1
+                self._start_worker(index)
+
+        return sum(1 for process in self.processes.values() if process.is_alive())
+
+    def stop(self, timeout=10):
+        self.terminate = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + timeout
+        for process in self.processes.values():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning('Killing worker pid {}'.format(process.pid))
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+    def run(self, interval=1):
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, lambda *args: setattr(self, 'terminate', True))
+
+        self.start()
+        try:
+            while not self.terminate:
+                self.poll()
+                time.sleep(interval)
+        finally:
+            logger.info('Stopping {} workers ......'.format(len(self.processes)))
+            self.stop()
+        return 0
@@ -0,0 +1,170 @@
+import logging
+import time
+import threading
+import asyncio
+import pytest
+import mock
+import grpc
+from milvus.grpc_gen import milvus_pb2
+
+logger = logging.getLogger(__name__)
+
+
+class TestAdmissionController:
+    def context(self, peer='ipv4:10.0.0.1:5000', client_id=None):
+        context = mock.MagicMock()
+        context.peer.return_value = peer
+        context.invocation_metadata.return_value = [('client-id', client_id)] if client_id else []
+        context.abort.side_effect = RuntimeError
+        return context
+
+    def test_queue(self):
+        from mishards.admission import AdmissionQueue
+        queue = AdmissionQueue('test_queue', capacity=100, max_wait=1, max_queue=2)
+        assert queue.acquire(1000)
+        order = []
+
+        def acquire(cost):
+            if queue.acquire(cost):
+                order.append(cost)
+                queue.release(cost)
+
+        threads = [threading.Thread(target=acquire, args=(cost,)) for cost in (80, 10)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        # The queue is full
+        assert not queue.acquire(1)
+        queue.release(1000)
+        for thread in threads:
+            thread.join()
+        # The cheaper request goes first, though it came later
+        assert order == [10, 80]
+
+        assert queue.acquire(60)
+        start = time.time()
+        assert not queue.acquire(60)
+        assert 0.9 < time.time() - start < 1.5
+        assert queue.acquire(40)
+        assert queue.shed.value == 2
+
+        limited = AdmissionQueue('test_limited_queue', capacity=100, max_wait=0.1, limit=2)
+        assert limited.acquire(1) and limited.acquire(1)
+        assert not limited.acquire(1)
+        limited.release(1)
+        assert limited.acquire(1, wait=False)
+        assert not limited.acquire(1, wait=False)
+        assert limited.running == 2 and limited.shed.value == 2
+
+    def test_saturated(self):
+        from mishards.admission import AdmissionController
+        controller = AdmissionController(search_capacity=1000, search_limit=1, write_limit=1,
+                                         max_wait=1, max_threads=3)
+        request = milvus_pb2.SearchParam(topk=10, query_record_array=[milvus_pb2.RowRecord()])
+        search, cost, _ = controller.admit('Search', request, self.context())
+        flush, _, _ = controller.admit('Flush', None, self.context())
+        assert controller.threads() == 2
+
+        # Waiting would take the last free thread: shed at once
+        start = time.time()
+        queue, _, reason = controller.admit('Search', request, self.context())
+        assert queue is None and 'no thread is free' in reason
+        assert time.time() - start < 0.5
+        # Requests which can run at once are still admitted
+        admin, _, reason = controller.admit('HasCollection', None, self.context())
+        assert reason is None
+        search.release(cost)
+        flush.release(1)
+        admin.release(1)
+        assert controller.threads() == 0 and search.inflight == 0
+
+    def test_wrap(self):
+        from mishards.admission import AdmissionController
+        controller = AdmissionController(search_capacity=1000, write_limit=1, max_wait=0.1,
+                                         client_rate=1, client_burst=2)
+        calls = []
+
+        def Search(handler, request, context):
+            calls.append(controller.queues['search'].inflight)
+            return 'ok'
+
+        search = controller.wrap('Search', Search)
+        request = milvus_pb2.SearchParam(topk=10, query_record_array=[milvus_pb2.RowRecord()] * 5)
+        assert controller.rpc_class('Flush') == 'write'
+        assert controller.rpc_class('HasCollection') == 'admin'
+        assert controller.cost('search', request) == 50
+
+        assert search(None, request, self.context()) == 'ok'
+        assert search(None, request, self.context(peer='ipv4:10.0.0.1:5001')) == 'ok'
+        assert calls == [50, 50]
+        assert controller.queues['search'].inflight == 0
+        # The third request of the client within a second is rate limited
+        context = self.context()
+        with pytest.raises(RuntimeError):
+            search(None, request, context)
+        assert context.abort.call_args[0][0] == grpc.StatusCode.RESOURCE_EXHAUSTED
+        # Other clients are not
+        assert search(None, request, self.context(client_id='other')) == 'ok'
+
+        flush = controller.wrap('Flush', lambda handler, request, context: time.sleep(0.3))
+        thread = threading.Thread(target=flush, args=(None, None, self.context(client_id='a')))
+        thread.start()
+        time.sleep(0.05)
+        context = self.context(client_id='b')
+        with pytest.raises(RuntimeError):
+            flush(None, None, context)
+        assert 'Server busy' in context.abort.call_args[0][1]
+        thread.join()
+
+    def test_wrap_async(self):
+        from mishards.admission import AdmissionController
+        # Too few threads to wait for one on the threaded server
+        controller = AdmissionController(write_limit=1, max_wait=1, max_threads=1)
+        queue = controller.queues['write']
+        calls = []
+        delay = [0.1]
+
+        async def Flush(handler, request, context):
+            calls.append((queue.running, controller.threads()))
+            await asyncio.sleep(delay[0])
+            return 'ok'
+
+        flush = controller.wrap('Flush', Flush)
+
+        async def flush_many(*contexts):
+            return await asyncio.gather(*[flush(None, None, context) for context in contexts],
+                                        return_exceptions=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            start = time.time()
+            results = loop.run_until_complete(flush_many(*[self.context(client_id=str(i)) for i in range(3)]))
+            assert results == ['ok'] * 3
+            assert time.time() - start >= 0.3
+            # The waiting requests held no thread
+            assert calls == [(1, 0)] * 3
+            assert queue.running == 0 and queue.threads == 0
+
+            # A request not admitted within max_wait is shed
+            queue.max_wait, delay[0] = 0.1, 0.3
+            context = self.context(client_id='b')
+            outcomes = loop.run_until_complete(flush_many(self.context(client_id='a'), context))
+            assert outcomes[0] == 'ok' and isinstance(outcomes[1], RuntimeError)
+            assert 'not admitted within' in context.abort.call_args[0][1]
+
+            # A cancelled request leaves the queue
+            async def cancel():
+                first = loop.create_task(flush(None, None, self.context(client_id='a')))
+                second = loop.create_task(flush(None, None, self.context(client_id='b')))
+                await asyncio.sleep(0.02)
+                assert len(queue.waiting) == 1
+                second.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await second
+                assert not queue.waiting
+                return await first
+
+            assert loop.run_until_complete(cancel()) == 'ok'
+            assert queue.running == 0 and queue.inflight == 0
+        finally:
+            loop.close()
@@ -0,0 +1,88 @@
+import logging
+import time
+import threading
+import pytest
+
+logger = logging.getLogger(__name__)
+
+
+class TestSearchCoalescer:
+    def test_coalesce(self):
+        from mishards.coalescer import SearchCoalescer
+        calls = []
+
+        def query(query_records, deadline):
+            calls.append(list(query_records))
+            ids = [r * 10 + i for r in query_records for i in range(2)]
+            return 'ok', ids, [float(i) for i in ids]
+
+        coalescer = SearchCoalescer(window=0.2, max_queries=64)
+        results = {}
+
+        def search(value):
+            results[value] = coalescer.search(('c', 2), [value], query)
+
+        threads = [threading.Thread(target=search, args=(v,)) for v in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert sorted(calls[0]) == list(range(1, 9))
+        for value, (status, ids, distances) in results.items():
+            assert status == 'ok'
+            assert ids == [value * 10, value * 10 + 1]
+
+    def test_full_batch_and_error(self):
+        from mishards.coalescer import SearchCoalescer
+        coalescer = SearchCoalescer(window=10, max_queries=2)
+
+        start = time.time()
+        status, ids, _ = coalescer.search('k', [1, 2], lambda records, deadline: ('ok', records, records))
+        assert time.time() - start < 1
+        assert ids == [1, 2]
+
+        def fail(records, deadline):
+            raise RuntimeError('backend down')
+
+        with pytest.raises(RuntimeError):
+            coalescer.search('k', [1, 2, 3], fail)
+
+    def test_member_deadlines(self):
+        from mishards.coalescer import SearchCoalescer
+        coalescer = SearchCoalescer(window=0.1, max_queries=64)
+        release = threading.Event()
+        deadlines = []
+
+        def query(query_records, deadline):
+            deadlines.append(deadline)
+            release.wait(2)
+            return 'ok', list(query_records), list(query_records)
+
+        now = time.time()
+        results = {}
+
+        def search(value, deadline):
+            def abort():
+                return ('expired', [], []) if time.time() >= deadline else None
+            results[value] = coalescer.search('k', [value], query, deadline=deadline, abort=abort)
+
+        threads = {}
+        for value, deadline in ((1, now + 0.2), (2, now + 0.3), (3, now + 10)):
+            threads[value] = threading.Thread(target=search, args=(value, deadline))
+            threads[value].start()
+            time.sleep(0.01)
+
+        # A member gives up at its own deadline, the batch goes on
+        threads[2].join(2)
+        assert results[2][0] == 'expired'
+        release.set()
+        for thread in threads.values():
+            thread.join()
+
+        # The batch runs until the latest deadline of its members, even though
+        # the deadline of the opener passed
+        assert deadlines == [now + 10]
+        assert results[1] == ('ok', [1], [1])
+        assert results[3] == ('ok', [3], [3])
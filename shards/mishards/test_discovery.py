@@ -0,0 +1,350 @@
+import logging
+import queue
+import threading
+import time
+import mock
+import pytest
+import grpc
+from types import SimpleNamespace
+from kubernetes.client.rest import ApiException
+from discovery.plugins.kubernetes_provider import K8SPodInformer, EventHandler, EventType
+from mishards.topology import Topology, TopoGroup
+
+logger = logging.getLogger(__name__)
+
+
+def fake_pod(name, phase='Running', version=1, deleting=False):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, resource_version=str(version),
+                                 deletion_timestamp='now' if deleting else None),
+        status=SimpleNamespace(pod_ip='10.0.0.{}'.format(version), phase=phase,
+                               reason=None, message=None))
+
+
+class FakeCoreV1Api:
+    """Serves `list_namespaced_pod` from a dict of pods and a log of watch events.
+    """
+
+    def __init__(self, pods):
+        self.version = 1
+        self.pods = {pod.metadata.name: pod for pod in pods}
+        self.log = []
+        self.expired_before = 0
+        self.lists = 0
+        self.watches = 0
+
+    def emit(self, event_type, pod):
+        self.version += 1
+        pod.metadata.resource_version = str(self.version)
+        if event_type == 'DELETED':
+            self.pods.pop(pod.metadata.name, None)
+        else:
+            self.pods[pod.metadata.name] = pod
+        self.log.append({'type': event_type, 'object': pod})
+
+    def list_namespaced_pod(self, namespace, label_selector=None, watch=False,
+                            resource_version=None, **kwargs):
+        if not watch:
+            self.lists += 1
+            return SimpleNamespace(items=list(self.pods.values()),
+                                   metadata=SimpleNamespace(resource_version=str(self.version)))
+        self.watches += 1
+        if int(resource_version) < self.expired_before:
+            raise ApiException(status=410, reason='Gone')
+        return [event for event in self.log
+                if int(event['object'].metadata.resource_version) > int(resource_version)]
+
+    def read_namespaced_pod(self, *args, **kwargs):
+        raise AssertionError('Pods are never read one by one')
+
+
+class FakeWatch:
+    def stream(self, func, **kwargs):
+        return iter(func(watch=True, **kwargs))
+
+    def stop(self):
+        pass
+
+
+def snapshots(message_queue):
+    out = []
+    while not message_queue.empty():
+        message = message_queue.get()
+        assert message['eType'] == EventType.PodHeartBeat
+        out.append({event['pod']: event['ready'] for event in message['events']})
+    return out
+
+
+class TestK8SPodInformer:
+    def test_list_then_watch(self):
+        api = FakeCoreV1Api([fake_pod('ro-0'), fake_pod('ro-1', phase='Pending')])
+        message_queue = queue.Queue()
+        informer = K8SPodInformer(message_queue, namespace='ns', label_selector='tier=ro',
+                                  v1=api, watch_class=FakeWatch, resync_interval=0)
+
+        informer.step()
+        assert api.lists == 1 and api.watches == 1
+        assert snapshots(message_queue)[-1] == {'ro-0': True, 'ro-1': False}
+
+        api.emit('MODIFIED', fake_pod('ro-1'))
+        api.emit('MODIFIED', fake_pod('ro-0', deleting=True))
+        api.emit('ADDED', fake_pod('ro-2'))
+        informer.step()
+        assert api.lists == 1 and api.watches == 2
+        assert informer.resource_version == str(api.version)
+        assert snapshots(message_queue)[-1] == {'ro-0': False, 'ro-1': True, 'ro-2': True}
+
+        api.emit('DELETED', fake_pod('ro-0'))
+        informer.step()
+        assert snapshots(message_queue)[-1] == {'ro-1': True, 'ro-2': True}
+        assert api.lists == 1
+
+    def test_relist(self):
+        api = FakeCoreV1Api([fake_pod('ro-0')])
+        message_queue = queue.Queue()
+        informer = K8SPodInformer(message_queue, namespace='ns', label_selector='tier=ro',
+                                  v1=api, watch_class=FakeWatch, resync_interval=0,
+                                  relist_interval=3600)
+        informer.step()
+
+        # The resourceVersion expired: the watch fails with 410 and the pods are listed again
+        api.pods['ro-1'] = fake_pod('ro-1', version=5)
+        api.version = 5
+        api.expired_before = 5
+        informer.step()
+        assert informer.resource_version is None
+        informer.step()
+        assert api.lists == 2
+        assert snapshots(message_queue)[-1] == {'ro-0': True, 'ro-1': True}
+
+        # An ERROR event in the watch stream
+        api.log.append({'type': 'ERROR', 'object': fake_pod('status', version=api.version + 1),
+                        'raw_object': {'code': 410, 'message': 'too old resource version'}})
+        informer.step()
+        assert informer.resource_version is None
+        informer.step()
+        assert api.lists == 3
+
+    def test_heartbeat_interval(self):
+        api = FakeCoreV1Api([fake_pod('ro-0')])
+        message_queue = queue.Queue()
+        informer = K8SPodInformer(message_queue, namespace='ns', label_selector='tier=ro',
+                                  v1=api, watch_class=FakeWatch, resync_interval=5)
+
+        with mock.patch('discovery.plugins.kubernetes_provider.time.time', return_value=1000):
+            informer.step()
+            assert snapshots(message_queue) == [{'ro-0': True}]
+
+            # Watch events only update the cache
+            for i in range(5):
+                api.emit('ADDED', fake_pod('ro-{}'.format(i + 1)))
+                informer.step()
+            assert snapshots(message_queue) == []
+            assert len(informer.pods) == 6
+
+        with mock.patch('discovery.plugins.kubernetes_provider.time.time', return_value=1005):
+            api.emit('DELETED', fake_pod('ro-0'))
+            informer.step()
+            informer.step()
+            assert snapshots(message_queue) == [{'ro-{}'.format(i + 1): True for i in range(5)}]
+
+        # A pod gone while the watch was down is dropped right after the list
+        with mock.patch('discovery.plugins.kubernetes_provider.time.time', return_value=1006):
+            api.pods.pop('ro-1')
+            api.expired_before = api.version + 1
+            informer.step()
+            informer.step()
+            assert api.lists == 2
+            assert snapshots(message_queue) == [{'ro-{}'.format(i + 1): True for i in range(1, 5)}]
+
+
+class TestEventHandler:
+    def test_ejected_pod_deleted(self):
+        topo = Topology()
+        for name in ('ro-0', 'ro-1'):
+            topo.add_group(TopoGroup(name))
+        topo.eject_group('ro-1')
+        deleted = []
+        mgr = SimpleNamespace(readonly_topo=topo, add_pods=mock.MagicMock(),
+                              delete_pod=lambda name: deleted.append(topo.delete_group(name) or name))
+        handler = EventHandler(mgr, queue.Queue(), namespace='ns', pod_patt='.*')
+
+        # The pod of the ejected group is gone
+        handler.on_pod_heartbeat({'events': [{'pod': 'ro-0', 'ip': '10.0.0.1', 'ready': True}]})
+        assert deleted == ['ro-1']
+        assert not topo.has_group('ro-1')
+        assert not mgr.add_pods.called
+
+
+class TestConnectionTopology:
+    def test_create_many(self):
+        from mishards.connections import ConnectionGroup, ConnectionTopology
+        from mishards.topology import StatusType
+
+        def probe(group, conn):
+            time.sleep(3 if group.name == 'dead' else 0.2)
+            return group.name != 'bad'
+
+        topo = ConnectionTopology()
+        uris = {'ro{}'.format(i): 'tcp://127.0.0.1:{}'.format(20000 + i) for i in range(20)}
+        uris.update(dead='tcp://127.0.0.1:19999', bad='tcp://127.0.0.1:19998')
+        with mock.patch.object(ConnectionGroup, 'on_pre_add', probe), \
+                mock.patch('mishards.connections.ChannelClient', mock.MagicMock):
+            start = time.time()
+            statuses = topo.create_many(uris, timeout=1)
+            elapsed = time.time() - start
+            assert topo.create_many({'ro0': uris['ro0']}) == {'ro0': StatusType.DUPLICATED}
+
+        assert elapsed < 1.5
+        assert statuses.pop('dead') == StatusType.ADD_ERROR
+        assert statuses.pop('bad') == StatusType.VERSION_ERROR
+        assert set(statuses.values()) == {StatusType.OK}
+        assert set(topo.group_names) == set(statuses)
+        assert topo.generation == 1
+
+    def test_create_many_late_probe(self):
+        from mishards.connections import ConnectionGroup, ConnectionTopology
+        from mishards.topology import StatusType
+
+        released = threading.Event()
+        clients = []
+
+        def probe(group, conn):
+            if group.name == 'slow':
+                released.wait(5)
+            return True
+
+        def client(**kwargs):
+            clients.append(mock.MagicMock(name=kwargs['name']))
+            return clients[-1]
+
+        topo = ConnectionTopology()
+        uris = {'ro0': 'tcp://127.0.0.1:20000', 'slow': 'tcp://127.0.0.1:19999'}
+        with mock.patch.object(ConnectionGroup, 'on_pre_add', probe), \
+                mock.patch('mishards.connections.ChannelClient', side_effect=client), \
+                mock.patch('mishards.connections.settings.CONNECTION_POOL_SIZE', 1):
+            statuses = topo.create_many(uris, timeout=0.5)
+            assert statuses == {'ro0': StatusType.OK, 'slow': StatusType.ADD_ERROR}
+            slow = [c for c in clients if c._mock_name == 'slow']
+            assert not slow[0].close.called
+
+            # The probe outlives the timeout, its connections are closed once it returns
+            released.set()
+            for _ in range(50):
+                if slow[0].close.called:
+                    break
+                time.sleep(0.02)
+
+        assert slow[0].close.called
+        assert not [c for c in clients if c._mock_name == 'ro0'][0].close.called
+        assert list(topo.group_names) == ['ro0']
+
+    def test_channel_connections(self):
+        from concurrent import futures
+        from milvus.client.grpc_handler import GrpcHandler
+        from milvus.grpc_gen import milvus_pb2, milvus_pb2_grpc, status_pb2
+        from mishards.connections import ChannelPool
+
+        peers = []
+
+        class Servicer(milvus_pb2_grpc.MilvusServiceServicer):
+            def Cmd(self, request, context):
+                peers.append(context.peer())
+                return milvus_pb2.StringReply(status=status_pb2.Status(error_code=status_pb2.SUCCESS),
+                                              string_reply='0.10.0')
+
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        milvus_pb2_grpc.add_MilvusServiceServicer_to_server(Servicer(), server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        server.start()
+        uri = 'tcp://127.0.0.1:{}'.format(port)
+        try:
+            # Channels the SDK builds with the same arguments share a connection
+            handlers = [GrpcHandler(uri=uri) for _ in range(2)]
+            for handler in handlers:
+                handler._cmd('version')
+            assert len(set(peers)) == 1
+
+            del peers[:]
+            pool = ChannelPool('ro0', uri=uri, size=3)
+            for _ in range(3):
+                pool._cmd('version')
+            # One call to check the version when a channel is created, one more per channel
+            assert len(peers) == 6
+            assert len(set(peers)) == 3
+            pool.close()
+        finally:
+            server.stop(None)
+
+    def test_channel_pool(self):
+        from mishards.connections import ChannelPool
+        from mishards.breaker import CircuitBreaker
+
+        class Expired(grpc.RpcError):
+            def code(self):
+                return grpc.StatusCode.DEADLINE_EXCEEDED
+
+        class Future:
+            def __init__(self, client):
+                self.client = client
+
+            def result(self, **kwargs):
+                return self.client.index
+
+        class Client:
+            created = []
+
+            def __init__(self, name=None, uri=None, pool=None, **kwargs):
+                self.index = len(self.created)
+                self.created.append(self)
+
+            def search_in_segment(self, *args, _async=False, **kwargs):
+                return Future(self) if _async else self.index
+
+            def reload_segments(self, *args):
+                raise RuntimeError('unavailable')
+
+            def _cmd(self, cmd, timeout=30):
+                return cmd, self.index
+
+            def flush(self, collection_names, timeout=None):
+                raise Expired()
+
+            def close(self):
+                pass
+
+        with mock.patch('mishards.connections.ChannelClient', Client):
+            pool = ChannelPool('ro0', uri='tcp://127.0.0.1:19530', size=3)
+        assert len(Client.created) == 3
+
+        futures = [pool.search_in_segment('c', _async=True) for _ in range(3)]
+        assert sorted(f.result() for f in futures) == [0, 1, 2]
+        # Channels are taken in turn when none of them is busy
+        assert [pool.search_in_segment('c') for _ in range(3)] == [0, 1, 2]
+
+        busy = pool.search_in_segment('c', _async=True)
+        assert pool.inflight() == 1
+        assert busy.client.index not in [pool.search_in_segment('c') for _ in range(4)]
+        busy.result()
+
+        # Cmd requests are passed through to a client as well
+        assert pool._cmd('version')[0] == 'version'
+
+        with pytest.raises(RuntimeError):
+            pool.reload_segments('c', [1])
+        stats = pool.stats()
+        assert stats['inflight'] == 0
+        assert sum(c['requests'] for c in stats['channels']) == 13
+        assert sum(c['errors'] for c in stats['channels']) == 1
+
+        # A call dispatched with almost nothing left of the client deadline
+        # is not held against the node when it times out, other timeouts are
+        pool.breaker = CircuitBreaker('ro0', failures=1)
+        with pytest.raises(Expired):
+            pool.flush(['c'], timeout=0.01)
+        assert pool.breaker.stats()['state'] == 'closed'
+        assert sum(c['expired'] for c in pool.stats()['channels']) == 1
+        with pytest.raises(Expired):
+            pool.flush(['c'], timeout=5)
+        assert pool.breaker.stats()['state'] == 'open'
+        assert pool.breaker.stats()['timeouts'] == 1
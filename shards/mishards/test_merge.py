@@ -0,0 +1,104 @@
+import logging
+import pytest
+import numpy as np
+from milvus.grpc_gen import milvus_pb2, status_pb2
+from mishards import merge
+
+logger = logging.getLogger(__name__)
+
+
+def brute_force(id_arrays, dis_arrays, topk, reverse):
+    ids = np.concatenate(id_arrays, axis=1)
+    diss = np.concatenate(dis_arrays, axis=1)
+    out_ids, out_diss = [], []
+    for row_ids, row_diss in zip(ids, diss):
+        pairs = sorted(zip(row_ids.tolist(), row_diss.tolist()), key=lambda x: x[1], reverse=reverse)
+        pairs = [p for p in pairs if p[0] != -1] + [p for p in pairs if p[0] == -1]
+        out_ids.append([p[0] for p in pairs[:topk]])
+        out_diss.append([p[1] for p in pairs[:topk]])
+    return out_ids, out_diss
+
+
+class TestMerge:
+    def random_shards(self, nq, topk, shards):
+        id_arrays, dis_arrays = [], []
+        for shard in range(shards):
+            id_arrays.append(np.arange(nq * topk, dtype=np.int64).reshape(nq, topk) + shard * nq * topk)
+            dis_arrays.append(np.random.random((nq, topk)).astype(np.float32))
+        return id_arrays, dis_arrays
+
+    @pytest.mark.parametrize('reverse', [False, True])
+    def test_merge_topk(self, reverse):
+        nq, topk, shards = 7, 10, 5
+        id_arrays, dis_arrays = self.random_shards(nq, topk, shards)
+        ids, diss = merge.merge_topk(id_arrays, dis_arrays, topk, reverse=reverse)
+        expected_ids, expected_diss = brute_force(id_arrays, dis_arrays, topk, reverse)
+
+        assert ids.shape == (nq, topk)
+        assert ids.tolist() == expected_ids
+        assert np.allclose(diss, expected_diss)
+
+    def test_merge_padding_sorts_last(self):
+        ids = [np.array([[1, -1, -1]], dtype=np.int64), np.array([[2, 3, -1]], dtype=np.int64)]
+        diss = [np.array([[0.5, 0.0, 0.0]], dtype=np.float32),
+                np.array([[0.1, 0.9, 0.0]], dtype=np.float32)]
+        out_ids, _ = merge.merge_topk(ids, diss, 4)
+        assert out_ids.tolist() == [[2, 1, 3, -1]]
+
+    def test_merge_fewer_candidates_than_topk(self):
+        id_arrays, dis_arrays = self.random_shards(3, 2, 2)
+        ids, diss = merge.merge_topk(id_arrays, dis_arrays, 10)
+        assert ids.shape == (3, 4)
+        assert (np.diff(diss, axis=1) >= 0).all()
+
+    def test_merge_inconsistent_nq(self):
+        id_arrays, dis_arrays = self.random_shards(3, 2, 1)
+        other_ids, other_diss = self.random_shards(4, 2, 1)
+        with pytest.raises(ValueError):
+            merge.merge_topk(id_arrays + other_ids, dis_arrays + other_diss, 2)
+
+    def test_as_topk_arrays(self):
+        result = milvus_pb2.TopKQueryResult(
+            status=status_pb2.Status(error_code=status_pb2.SUCCESS),
+            row_num=2, ids=[1, 2, 3, 4], distances=[0.1, 0.2, 0.3, 0.4])
+        ids, diss = merge.as_topk_arrays(result)
+        assert ids.tolist() == [[1, 2], [3, 4]]
+        assert diss.shape == (2, 2)
+
+
+class TestTopKReducer:
+    def result(self, ids, distances, error_code=status_pb2.SUCCESS):
+        ids = np.asarray(ids, dtype=np.int64)
+        return milvus_pb2.TopKQueryResult(
+            status=status_pb2.Status(error_code=error_code),
+            row_num=ids.shape[0], ids=ids.ravel().tolist(),
+            distances=np.asarray(distances, dtype=np.float32).ravel().tolist())
+
+    def test_fold_matches_batch(self):
+        results = [self.result(np.arange(6).reshape(2, 3) + 10 * i,
+                               np.random.random((2, 3))) for i in range(4)]
+        folded = merge.TopKReducer(3)
+        batched = merge.TopKReducer(3)
+        for r in results:
+            assert folded.add(r)
+            assert batched.add(r, fold=False)
+
+        _, folded_ids, _ = folded.result()
+        error, batched_ids, _ = batched.result()
+        assert error is None
+        assert folded_ids.tolist() == batched_ids.tolist()
+
+    def test_error(self):
+        reducer = merge.TopKReducer(3)
+        assert reducer.add(self.result([[1, 2, 3]], [[0.1, 0.2, 0.3]]))
+        bad = self.result([[1]], [[0.1]], error_code=status_pb2.UNEXPECTED_ERROR)
+        assert not reducer.add(bad)
+        assert not reducer.add(self.result([[4, 5, 6]], [[0.1, 0.2, 0.3]]))
+        error, ids, _ = reducer.result()
+        assert error.error_code == status_pb2.UNEXPECTED_ERROR
+        assert ids is None
+
+    def test_empty(self):
+        reducer = merge.TopKReducer(3)
+        assert reducer.add(milvus_pb2.TopKQueryResult(row_num=0))
+        assert reducer.result() == (None, None, None)
@@ -0,0 +1,70 @@
+import logging
+import time
+import pytest
+import mock
+from milvus.grpc_gen import milvus_pb2
+from tracer import Tracer
+from mishards.service_handler import ServiceHandler
+from mishards.test_service_handler import FakeRouter
+
+logger = logging.getLogger(__name__)
+
+
+class TestMetadataCache:
+    def test_cached_until_ddl(self):
+        from milvus import Status
+        writer = mock.MagicMock()
+        writer.has_collection.return_value = (Status(), True)
+        writer.get_collection_info.return_value = (Status(), mock.MagicMock(dimension=8))
+        writer.drop_collection.return_value = Status()
+        router = FakeRouter({})
+        router.connection = lambda metadata=None: writer
+        handler = ServiceHandler(tracer=Tracer(), router=router, max_workers=1)
+        request = milvus_pb2.CollectionName(collection_name='c')
+
+        for _ in range(3):
+            assert handler.HasCollection(request, None).bool_reply
+            assert handler.DescribeCollection(request, None).dimension == 8
+        assert writer.has_collection.call_count == 1
+        assert writer.get_collection_info.call_count == 1
+
+        handler.DropCollection(request, None)
+        writer.has_collection.return_value = (Status(), False)
+        assert not handler.HasCollection(request, None).bool_reply
+        assert writer.has_collection.call_count == 2
+
+        # A failed partition DDL invalidates as well
+        writer.create_partition.side_effect = RuntimeError('unavailable')
+        with pytest.raises(RuntimeError):
+            handler.CreatePartition(milvus_pb2.PartitionParam(collection_name='c', tag='p'), None)
+        handler.HasCollection(request, None)
+        assert writer.has_collection.call_count == 3
+
+        # Row counts change with auto flushes, they are never cached
+        writer.count_entities.return_value = (Status(), 10)
+        for _ in range(2):
+            assert handler.CountCollection(request, None).collection_row_count == 10
+        assert writer.count_entities.call_count == 2
+        handler.stop()
+
+    def test_ttl_and_errors(self):
+        from milvus import Status
+        from mishards.metadata_cache import MetadataCache
+        cache = MetadataCache(ttl=0.1, name='test.metadata.cache')
+        loader = mock.MagicMock(return_value=(Status(code=Status.COLLECTION_NOT_EXISTS), None))
+
+        cache.get('c', 'describe', loader)
+        cache.get('c', 'describe', loader)
+        assert loader.call_count == 2
+
+        loader.return_value = (Status(), 'meta')
+        assert cache.get('c', 'describe', loader)[1] == 'meta'
+        assert cache.get('c', 'describe', loader)[1] == 'meta'
+        assert loader.call_count == 3
+        time.sleep(0.15)
+        cache.get('c', 'describe', loader)
+        assert loader.call_count == 4
+
+        cache.invalidate('c', kinds=('index',))
+        cache.get('c', 'describe', loader)
+        assert loader.call_count == 4
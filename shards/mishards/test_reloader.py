@@ -0,0 +1,52 @@
+import logging
+import time
+import mock
+from milvus.client.types import MetricType
+from milvus.grpc_gen import status_pb2
+from tracer import Tracer
+from mishards.service_handler import ServiceHandler
+from mishards.test_service_handler import FakeConn, FakeRouter
+
+logger = logging.getLogger(__name__)
+
+
+class TestSegmentReloader:
+    def test_batched_reload(self):
+        from mishards.reloader import SegmentReloader
+
+        class SlowConn(FakeConn):
+            def reload_segments(self, collection_name, segment_ids, timeout=None):
+                time.sleep(0.2)
+                self.reloaded.append(list(segment_ids))
+
+        conn = SlowConn(0, 0, 1, 1)
+        reloader = SegmentReloader(FakeRouter({'ro': conn}), batch_size=2)
+        reloader.submit('ro', 'c', ['1'])
+        reloader.submit('ro', 'c', ['1', '2', '3', '4'])
+        assert len(reloader.blocking('ro', ['1', '4', '5'])) == 2
+
+        start = time.time()
+        assert reloader.wait('ro', ['4'], timeout=5)
+        assert time.time() - start >= 0.3
+        assert conn.reloaded == [['1'], ['2', '3'], ['4']]
+        assert reloader.blocking('ro', ['1', '2', '3', '4']) == []
+        reloader.stop()
+
+    def test_poll_and_search(self):
+        nq, topk = 3, 5
+        conns = {'ro{}'.format(i): FakeConn(i * 1000, 0.01, nq, topk) for i in range(2)}
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns), max_workers=2,
+                                 segment_reload_interval=60)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        status, ids, _ = handler._do_query(None, 'c', collection_meta, [[0.1]] * nq,
+                                           topk, {}, partition_tags=[])
+        assert status.error_code == status_pb2.SUCCESS
+        assert len(ids) == nq * topk
+        assert all(conn.reloaded == ['1'] for conn in conns.values())
+
+        assert list(handler.reloader.watched) == ['c']
+        handler.reloader.poll()
+        assert all(handler.reloader.wait(addr, ['1'], timeout=5) for addr in conns)
+        assert all(conn.reloaded == ['1', '1'] for conn in conns.values())
+        handler.stop()
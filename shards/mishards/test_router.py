@@ -0,0 +1,450 @@
+import logging
+import time
+import pytest
+from mishards import db
+from mishards.models import Tables, TableFiles
+from mishards.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+def add_collection(collection_name, files_num, file_type=TableFiles.FILE_TYPE_RAW, base_id=1,
+                   file_sizes=None):
+    session = db.Session
+    session.add(Tables(id=base_id, table_id=collection_name, state=Tables.NORMAL, dimension=8))
+    for i in range(files_num):
+        session.add(TableFiles(id=base_id * 1000 + i, table_id=collection_name, file_type=file_type,
+                               file_id='{}_{}'.format(collection_name, i),
+                               file_size=file_sizes[i] if file_sizes else 0,
+                               updated_time=1, created_on=1))
+    session.commit()
+    db.remove_session()
+
+
+@pytest.mark.usefixtures('app')
+class TestRouter:
+    def test_routing_cache(self, app):
+        for name in ('ro1', 'ro2', 'ro3'):
+            app.readonly_topo.create(name)
+        add_collection('c1', 20)
+
+        hits = REGISTRY.counter('router.cache.hits').value
+        misses = REGISTRY.counter('router.cache.misses').value
+
+        routing = app.router.routing('c1')
+        assert sum(len(search) for search, _ in routing.values()) == 20
+        assert sum(len(ud) for _, ud in routing.values()) == 20
+        assert REGISTRY.counter('router.cache.misses').value == misses + 1
+
+        cached = app.router.routing('c1')
+        assert REGISTRY.counter('router.cache.hits').value == hits + 1
+        assert {h: s for h, (s, _) in cached.items()} == {h: s for h, (s, _) in routing.items()}
+        assert all(not ud for _, ud in cached.values())
+
+        session = db.Session
+        f = session.query(TableFiles).filter(TableFiles.table_id == 'c1').first()
+        f.updated_time = 2
+        file_id = str(f.id)
+        session.commit()
+        db.remove_session()
+
+        updated = app.router.routing('c1')
+        assert REGISTRY.counter('router.cache.misses').value == misses + 2
+        assert [ud for _, ud in updated.values() if ud] == [[file_id]]
+
+        app.readonly_topo.create('ro4')
+        app.router.routing('c1')
+        assert REGISTRY.counter('router.cache.misses').value == misses + 3
+
+    def test_metadata_mirror(self, app):
+        from mishards.router.mirror import MetadataMirror
+        app.readonly_topo.create('ro1')
+        add_collection('c2', 5, base_id=2)
+        add_collection('c3', 3, base_id=3, file_type=TableFiles.FILE_TYPE_NEW)
+
+        mirror = MetadataMirror()
+        assert not mirror.ready
+        mirror.refresh()
+        assert mirror.ready
+        assert mirror.lag() >= 0
+
+        assert mirror.collection_list('c2') == ['c2']
+        assert len(mirror.searchable_files(['c2'])) == 5
+        assert all(load == 1 for _, _, load in mirror.searchable_file_loads(['c2']))
+        assert mirror.searchable_files(['c3']) == []
+        version = mirror.files_version(['c2'])
+
+        session = db.Session
+        f = session.query(TableFiles).filter(TableFiles.table_id == 'c2').first()
+        f.file_type = TableFiles.FILE_TYPE_TO_DELETE
+        f.updated_time = 5
+        session.commit()
+        db.remove_session()
+
+        mirror.refresh(full=False)
+        assert len(mirror.searchable_files(['c2'])) == 4
+        assert mirror.files_version(['c2']) != version
+
+        app.router.mirror = mirror
+        routing = app.router.routing('c2')
+        assert sum(len(search) for search, _ in routing.values()) == 4
+
+        session = db.Session
+        session.query(TableFiles).filter(TableFiles.table_id == 'c2').delete()
+        session.commit()
+        db.remove_session()
+
+        mirror.refresh(full=True)
+        assert mirror.searchable_files(['c2']) == []
+
+    def test_hash_ring_cache(self, app):
+        from mishards.hash_ring import HashRing
+        from mishards.router.cache import HashRingCache
+        ring = HashRing(['ro1', 'ro2', 'ro3'])
+        keys = [str(i) for i in range(1000)]
+        assert ring.get_nodes(keys) == [ring.get_node(key) for key in keys]
+        assert HashRing([]).get_nodes(keys[:2]) == [None, None]
+
+        for name in ('ro1', 'ro2'):
+            app.readonly_topo.create(name)
+        rings = HashRingCache(name='test.ring')
+        first, _ = rings.get(app.readonly_topo)
+        assert rings.get(app.readonly_topo)[0] is first
+        assert rings.locate(app.readonly_topo, [1, 2, 3]) == first.get_nodes(['1', '2', '3'])
+        assert len(rings.file_nodes) == 3
+
+        app.readonly_topo.create('ro3')
+        second, file_nodes = rings.get(app.readonly_topo)
+        assert second is not first
+        assert not file_nodes
+        assert REGISTRY.counter('test.ring.rebuilds').value == 2
+
+    def test_bounded_load(self, app):
+        from mishards.hash_ring import HashRing
+        from mishards.router import bounded_load
+        from mishards.router.factory import RouterFactory
+
+        nodes = ['ro{}'.format(i) for i in range(4)]
+        files = [(i, 1000 if i < 4 else 10) for i in range(200)]
+        assignment, loads = bounded_load.assign(HashRing(nodes), nodes, files, epsilon=0.1)
+        assert len(assignment) == len(files)
+        assert sum(loads.values()) == sum(load for _, load in files)
+        assert bounded_load.load_ratio(loads) <= 1.1 + 1e-6
+        assert bounded_load.assign(HashRing(nodes), nodes, files, epsilon=0.1)[0] == assignment
+        assert bounded_load.assign(HashRing([]), [], files) == ({}, {})
+
+        for name in nodes:
+            app.readonly_topo.create(name)
+        sizes = [1000 if i < 4 else 10 for i in range(40)]
+        add_collection('c4', 40, base_id=4, file_sizes=sizes)
+
+        router = RouterFactory().create('BoundedLoadHashRingRouter',
+                                        writable_topo=app.writable_topo,
+                                        readonly_topo=app.readonly_topo,
+                                        epsilon=0.1)
+        routing = router.routing('c4')
+        assert sum(len(search) for search, _ in routing.values()) == 40
+        host_loads = {host: sum(sizes[int(f) - 4000] for f in search)
+                      for host, (search, _) in routing.items()}
+        assert max(host_loads.values()) <= bounded_load.capacity(sum(sizes), len(nodes), 0.1)
+        assert {h: s for h, (s, _) in router.routing('c4').items()} == \
+            {h: s for h, (s, _) in routing.items()}
+
+    def test_bounded_load_partitions(self, app):
+        from mishards.router.factory import RouterFactory
+
+        nodes = ['ro{}'.format(i) for i in range(4)]
+        for name in nodes:
+            app.readonly_topo.create(name)
+        session = db.Session
+        session.add(Tables(id=6, table_id='c6', state=Tables.NORMAL, dimension=8))
+        for i, tag in enumerate(('p0', 'p1')):
+            session.add(Tables(id=60 + i, table_id='c6_{}'.format(tag), owner_table='c6',
+                               partition_tag=tag, state=Tables.NORMAL, dimension=8))
+        for i in range(60):
+            session.add(TableFiles(id=6000 + i, table_id='c6_p{}'.format(i % 2),
+                                   file_type=TableFiles.FILE_TYPE_RAW, file_id='c6_{}'.format(i),
+                                   file_size=1000 if i < 6 else 10, updated_time=1, created_on=1))
+        session.commit()
+        db.remove_session()
+
+        router = RouterFactory().create('BoundedLoadHashRingRouter',
+                                        writable_topo=app.writable_topo,
+                                        readonly_topo=app.readonly_topo,
+                                        epsilon=0.1)
+        placed = {str(file_id): host for host, collections in router.placement(nodes).items()
+                  for file_id, _ in collections.get('c6', [])}
+        assert len(placed) == 60
+
+        misses = REGISTRY.counter('router.bounded_load.assignments.misses').value
+        for tags in (None, ['p0'], ['p1']):
+            routing = router.routing('c6', partition_tags=tags)
+            routed = {f: host for host, (search, _) in routing.items() for f in search}
+            assert len(routed) == (60 if tags is None else 30)
+            assert all(placed[f] == host for f, host in routed.items())
+        assert REGISTRY.counter('router.bounded_load.assignments.misses').value == misses + 1
+
+        session = db.Session
+        session.add(TableFiles(id=6060, table_id='c6_p1', file_type=TableFiles.FILE_TYPE_RAW,
+                               file_id='c6_60', file_size=10, updated_time=1, created_on=1))
+        session.commit()
+        db.remove_session()
+        routing = router.routing('c6', partition_tags=['p0'])
+        assert sum(len(search) for search, _ in routing.values()) == 30
+        assert REGISTRY.counter('router.bounded_load.assignments.misses').value == misses + 2
+
+    def test_replicated_routing(self, app):
+        for name in ('ro1', 'ro2', 'ro3'):
+            app.readonly_topo.create(name)
+        add_collection('c5', 30, base_id=5)
+
+        router = app.router
+        router.replication_factor = 2
+        routing = router.routing('c5')
+        assert sum(len(search) for search, _ in routing.values()) == 30
+
+        replicas = router.rings.replicas(app.readonly_topo, list(range(5000, 5030)), 2)
+        assert all(len(set(r)) == 2 for r in replicas)
+        assert [r[0] for r in replicas] == router.rings.locate(app.readonly_topo, list(range(5000, 5030)))
+
+        group = app.readonly_topo.get_group('ro1')
+        with router.track('ro1'), router.track('ro1'):
+            assert group.inflight('ro1') == 2
+            assert group.inflight() == 2
+            busy = router.routing('c5')
+            assert 'ro1' not in busy
+            assert sum(len(search) for search, _ in busy.values()) == 30
+        assert group.inflight('ro1') == 0
+
+        search_files = busy[next(iter(busy))][0]
+        host, ud_files = router.alternate(next(iter(busy)), search_files)
+        assert host != next(iter(busy)) and host in ('ro1', 'ro2', 'ro3')
+        assert set(ud_files) <= set(search_files)
+
+    def test_file_versions(self, app):
+        from mishards.router.versions import FileVersionTable, file_versions
+        table = FileVersionTable(max_files=8, name='test.file_versions')
+        assert table.filter('ro1', [('3', 1), ('1', 1), ('2', 1)]) == ['3', '1', '2']
+        assert table.filter('ro1', [('1', 1), ('2', 2), ('4', 1)]) == ['2', '4']
+        assert list(table.lookup('ro1', ['2', '5'])) == [2, 0]
+        assert table.nbytes() == 4 * 2 * 8
+
+        assert table.retain([1, 2]) == 2
+        assert table.filter('ro1', [('3', 1), ('1', 1)]) == ['3']
+        table.filter('ro1', [(str(i), 1) for i in range(10, 16)])
+        assert list(table.lookup('ro1', ['1', '10'])) == [0, 1]
+        # Files already recorded do not count against the size limit
+        table.filter('ro1', [(str(i), 1) for i in range(10, 18)])
+        assert table.filter('ro1', [(str(i), 1) for i in range(10, 18)]) == []
+        assert len(table.hosts['ro1']) == 8
+
+        # Files which vanished from the routing of their collection are pruned
+        assert table.refresh(('c',), [10, 11, 12]) == 0
+        assert table.refresh(('c',), [11, 12]) == 1
+        assert list(table.lookup('ro1', ['10', '11'])) == [0, 1]
+
+        app.readonly_topo.create('ro_versions')
+        file_versions.filter('ro_versions', [('1', 1)])
+        app.readonly_topo.delete_group('ro_versions')
+        assert 'ro_versions' not in file_versions.hosts
+
+        # Without metadata mirror, routing prunes the files merged or dropped away
+        add_collection('c_versions', 4, base_id=16)
+        app.readonly_topo.create('ro_routed')
+        app.router.routing('c_versions')
+        assert list(file_versions.lookup('ro_routed', ['16000', '16001'])) == [1, 1]
+        db.Session.query(TableFiles).filter(TableFiles.id == 16000).delete()
+        db.Session.commit()
+        db.remove_session()
+        app.router.routing('c_versions')
+        assert list(file_versions.lookup('ro_routed', ['16000', '16001'])) == [0, 1]
+
+    def test_node_warmup(self, app):
+        from mishards.connections import ConnectionTopology
+        from mishards.router.factory import RouterFactory
+        from mishards.warmup import NodeWarmer
+
+        class Loader:
+            def __init__(self):
+                self.loaded = []
+
+            def reload_segments(self, collection_name, segment_ids):
+                self.loaded.extend(segment_ids)
+
+        add_collection('c6', 20, base_id=6)
+        topo = ConnectionTopology()
+        router = RouterFactory().create('FileBasedHashRingRouter',
+                                        writable_topo=app.writable_topo,
+                                        readonly_topo=topo)
+        topo.warmer = NodeWarmer(router, batch_size=4)
+
+        loaders = {}
+        for name in ('warm1', 'warm2'):
+            _, group = topo.create(name)
+            loaders[name] = group.items[name] = Loader()
+            assert name not in topo.group_names
+            assert topo.get_group(name) is None
+            topo.activate(name).join()
+            assert name in topo.group_names
+
+        all_files = [str(i) for i in range(6000, 6020)]
+        assert sorted(loaders['warm1'].loaded) == all_files
+        routing = router.routing('c6')
+        assert all(not ud_files for _, ud_files in routing.values())
+        assert sorted(loaders['warm2'].loaded) == sorted(routing['warm2'][0])
+
+        group = topo.get_group('warm2')
+        with group.track('warm2'):
+            thread = topo.retire('warm2')
+            thread.join(0.5)
+            assert 'warm2' not in topo.group_names
+            assert topo.get_group('warm2') is group
+        thread.join()
+        assert topo.get_group('warm2') is None
+        # warm1 was asked to load every file when it joined
+        assert len(loaders['warm1'].loaded) == 20
+        assert {host: len(search) for host, (search, _) in router.routing('c6').items()} == {'warm1': 20}
+
+    def test_node_warmup_failures(self, app):
+        from mishards.connections import ConnectionTopology
+        from mishards.router.factory import RouterFactory
+        from mishards.warmup import NodeWarmer
+
+        class Loader:
+            def __init__(self):
+                self.loaded = []
+
+            def reload_segments(self, collection_name, segment_ids):
+                if not self.loaded:
+                    self.loaded.append(None)
+                    raise RuntimeError('unavailable')
+                self.loaded.extend(segment_ids)
+                # The deadline passes after the second batch
+                time.sleep(0.2)
+
+        add_collection('c8', 20, base_id=8)
+        topo = ConnectionTopology()
+        router = RouterFactory().create('FileBasedHashRingRouter',
+                                        writable_topo=app.writable_topo,
+                                        readonly_topo=topo)
+        warmer = NodeWarmer(router, batch_size=4)
+        loader = Loader()
+        assert not warmer.warm(topo, ['cold1'], ['cold1'], time.time() + 0.1, conns={'cold1': loader})
+        assert len(loader.loaded) == 5
+
+        # Only the loaded segments are up to date, the others are reloaded
+        # by the first search
+        topo.create('cold1')
+        (search, ud_files), = router.routing('c8').values()
+        assert len(search) == 20
+        assert sorted(ud_files) == sorted(set(search) - set(loader.loaded[1:]))
+
+    def test_topology_snapshot(self, app):
+        import threading
+        from mishards.topology import Topology, TopoGroup, TopoObject
+
+        topo = Topology()
+        stop = threading.Event()
+        errors = []
+
+        def churn():
+            i = 0
+            while not stop.is_set():
+                name = 'snap{}'.format(i % 8)
+                if topo.has_group(name):
+                    topo.drain_group(name)
+                    topo.delete_group(name)
+                else:
+                    group = TopoGroup(name)
+                    group.add(TopoObject(name))
+                    topo.add_group(group)
+                i += 1
+
+        def read():
+            while not stop.is_set():
+                snapshot = topo.snapshot
+                names = list(snapshot.groups)
+                # A snapshot is never changed once published
+                if list(snapshot.groups) != names:
+                    errors.append(snapshot)
+                for name in names:
+                    if snapshot.groups[name].get(name) is None:
+                        errors.append(name)
+
+        threads = [threading.Thread(target=churn)] + [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        stop.wait(0.5)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert topo.generation > 0
+
+        before = topo.snapshot
+        group = TopoGroup('snap_new')
+        group.add(TopoObject('snap_new'))
+        topo.add_group(group)
+        assert 'snap_new' not in before.groups
+        assert topo.snapshot.generation == before.generation + 1
+        topo.drain_group('snap_new')
+        assert topo.get_group('snap_new') is group
+        assert 'snap_new' not in topo.group_names
+        topo.delete_group('snap_new')
+        assert topo.get_group('snap_new') is None and topo.generation == before.generation + 2
+
+    def test_circuit_breaker(self, app):
+        from mishards.breaker import HealthMonitor, is_timeout
+        from mishards.connections import ConnectionTopology
+        from mishards.router.factory import RouterFactory
+        import grpc
+
+        add_collection('c7', 30, base_id=7)
+        topo = ConnectionTopology()
+        topo.monitor = HealthMonitor(topo, failures=3, window=10, reset_timeout=0)
+        router = RouterFactory().create('FileBasedHashRingRouter',
+                                        writable_topo=app.writable_topo,
+                                        readonly_topo=topo)
+        for name in ('hb1', 'hb2', 'hb3'):
+            topo.create(name)
+
+        def owners():
+            return {file_id: host for host, (files, _) in router.routing('c7').items()
+                    for file_id in files}
+
+        before = owners()
+        breaker = topo.monitor.breakers['hb2']
+        breaker.record(grpc.FutureTimeoutError())
+        breaker.record(RuntimeError('unavailable'))
+        breaker.record(None)
+        assert 'hb2' in topo.group_names
+        for _ in range(3):
+            breaker.record(RuntimeError('unavailable'))
+        assert breaker.stats()['state'] == 'open'
+        assert breaker.stats()['timeouts'] == 1 and is_timeout(grpc.FutureTimeoutError())
+        assert 'hb2' not in topo.group_names
+        assert topo.get_group('hb2') is not None
+
+        # Only the files of the ejected node move
+        after = owners()
+        assert set(after.values()) == {'hb1', 'hb3'}
+        assert all(after[f] == host for f, host in before.items() if host != 'hb2')
+
+        probes = iter([False, True, True])
+        topo.monitor.probe = lambda name: next(probes)
+        topo.monitor.poll()
+        assert breaker.stats()['state'] == 'open'
+        topo.monitor.poll()
+        assert breaker.stats()['state'] == 'half_open'
+        topo.monitor.poll()
+        assert breaker.stats()['state'] == 'closed'
+        assert 'hb2' in topo.group_names
+        assert owners() == before
+
+        # The last routable node is never ejected
+        topo.delete_group('hb1')
+        topo.delete_group('hb3')
+        assert 'hb1' not in topo.monitor.breakers
+        for _ in range(3):
+            breaker.record(RuntimeError('unavailable'))
+        assert list(topo.group_names) == ['hb2']
@@ -0,0 +1,355 @@
+import logging
+import time
+import json
+import threading
+import asyncio
+from concurrent import futures
+import pytest
+import mock
+import numpy as np
+from milvus.client.types import MetricType
+from milvus.grpc_gen import milvus_pb2, status_pb2
+from tracer import Tracer
+from mishards import exceptions
+from mishards.service_handler import ServiceHandler
+from mishards.router import RouterMixin
+from mishards.topology import Topology
+
+logger = logging.getLogger(__name__)
+
+
+class FakeFuture:
+    def __init__(self, response, delay):
+        self._future = futures.Future()
+        self.timer = threading.Timer(delay, self.resolve, args=(response,))
+        self.timer.start()
+
+    def resolve(self, response):
+        if self._future.set_running_or_notify_cancel():
+            self._future.set_result(response)
+
+    def result(self, **kwargs):
+        return self._future.result()
+
+    def cancel(self):
+        self.timer.cancel()
+        self._future.cancel()
+
+
+class FakeConn:
+    def __init__(self, base_id, delay, nq, topk):
+        self.base_id = base_id
+        self.delay = delay
+        self.nq = nq
+        self.topk = topk
+        self.reloaded = []
+        self.timeouts = []
+
+    def reload_segments(self, collection_name, segment_ids, timeout=None):
+        self.reloaded.extend(segment_ids)
+
+    def search_in_segment(self, collection_name, file_ids, query_records, top_k, params, **kwargs):
+        self.timeouts.append(kwargs.get('timeout', None))
+        ids = np.arange(self.nq * self.topk).reshape(self.nq, self.topk) + self.base_id
+        distances = np.random.random((self.nq, self.topk)).astype(np.float32)
+        response = milvus_pb2.TopKQueryResult(
+            status=status_pb2.Status(error_code=status_pb2.SUCCESS),
+            row_num=self.nq, ids=ids.ravel().tolist(),
+            distances=np.sort(distances, axis=1).ravel().tolist())
+        return FakeFuture(response, self.delay)
+
+
+class FakeRouter(RouterMixin):
+    def __init__(self, conns, routed=None, alternates=None):
+        super().__init__(writable_topo=None, readonly_topo=Topology())
+        self.conns = conns
+        self.routed = routed or list(conns)
+        self.alternates = alternates or {}
+
+    def routing(self, collection_name, partition_tags=None, metadata=None, **kwargs):
+        return {addr: (['1', '2'], ['1']) for addr in self.routed}
+
+    def alternate(self, name, search_file_ids, metadata=None):
+        host = self.alternates.get(name, None)
+        return (host, ['2']) if host else None
+
+    def query_conn(self, name, metadata=None):
+        return self.conns[name]
+
+
+class TestServiceHandler:
+    def test_do_query_scatter_gather(self):
+        nq, topk, delay = 3, 5, 0.2
+        conns = {'ro{}'.format(i): FakeConn(i * 1000, delay, nq, topk) for i in range(5)}
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns), max_workers=8)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        start = time.time()
+        status, ids, distances = handler._do_query(None, 'c', collection_meta, [[0.1]] * nq,
+                                                   topk, {}, partition_tags=[])
+        elapsed = time.time() - start
+        handler.stop()
+
+        assert status.error_code == status_pb2.SUCCESS
+        assert len(ids) == nq * topk
+        assert elapsed < delay * len(conns) / 2
+        assert all(conn.reloaded == ['1'] for conn in conns.values())
+
+    def test_do_query_hedged(self):
+        nq, topk = 3, 5
+        conns = {
+            'fast': FakeConn(0, 0.01, nq, topk),
+            'slow': FakeConn(1000, 1, nq, topk),
+            'spare': FakeConn(2000, 0.01, nq, topk),
+        }
+        router = FakeRouter(conns, routed=['fast', 'slow'], alternates={'slow': 'spare'})
+        handler = ServiceHandler(tracer=Tracer(), router=router, max_workers=8, hedge_percentile=90)
+        for _ in range(handler.HEDGE_MIN_SAMPLES):
+            handler.latency('slow').observe(0.02)
+        hedges = handler.hedges.value
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        start = time.time()
+        status, ids, distances = handler._do_query(None, 'c', collection_meta, [[0.1]] * nq,
+                                                   topk, {}, partition_tags=[])
+        elapsed = time.time() - start
+        handler.stop()
+
+        assert status.error_code == status_pb2.SUCCESS
+        assert elapsed < 0.5
+        assert handler.hedges.value == hedges + 1
+        assert conns['spare'].reloaded == ['2']
+        assert all(i < 1000 or i >= 2000 for i in ids)
+        assert handler.latency('spare').count == 1
+
+    def test_do_query_deadline(self):
+        nq, topk = 3, 5
+        conns = {'ro{}'.format(i): FakeConn(i * 1000, 0.01 if i else 2, nq, topk) for i in range(3)}
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns), max_workers=8)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+        cancelled = handler.cancelled_calls.value
+
+        context = mock.MagicMock()
+        context.time_remaining.return_value = 0.3
+        context.is_active.return_value = True
+        start = time.time()
+        status, ids, _ = handler._do_query(context, 'c', collection_meta, [[0.1]] * nq,
+                                           topk, {}, partition_tags=[])
+        assert time.time() - start < 1
+        assert status.error_code != status_pb2.SUCCESS
+        assert 'deadline' in status.reason
+        assert all(0 < timeout <= 0.3 for conn in conns.values() for timeout in conn.timeouts)
+        assert handler.cancelled_calls.value == cancelled + 1
+
+        # The client went away
+        context.time_remaining.return_value = None
+        context.is_active.side_effect = lambda: time.time() < start + 0.2
+        start = time.time()
+        status, ids, _ = handler._do_query(context, 'c', collection_meta, [[0.1]] * nq,
+                                           topk, {}, partition_tags=[])
+        handler.stop()
+        assert time.time() - start < 1
+        assert 'cancelled' in status.reason
+        assert conns['ro0'].timeouts[-1] is None
+        assert handler.cancelled_calls.value == cancelled + 2
+
+    def test_hung_node_ejected(self):
+        from milvus.client.types import Status
+        from mishards.breaker import HealthMonitor
+        from mishards.connections import ConnectionTopology
+        nq, topk = 3, 5
+
+        class Client(FakeConn):
+            # ro0 hangs, ro1 answers at once
+            def __init__(self, name=None, uri=None, **kwargs):
+                super().__init__(int(name[-1]) * 1000, 5 if name == 'ro0' else 0.01, nq, topk)
+
+            def server_version(self, timeout=None):
+                return Status(), '0.10.0'
+
+        topo = ConnectionTopology()
+        topo.monitor = HealthMonitor(topo, failures=2)
+        with mock.patch('mishards.connections.ChannelClient', Client):
+            topo.create_many({name: 'tcp://127.0.0.1:19530' for name in ('ro0', 'ro1')})
+        conns = {name: topo.get_group(name).get(name) for name in ('ro0', 'ro1')}
+        router = FakeRouter(conns)
+        # Nothing to reload: a successful reload would reset the consecutive failures
+        router.routing = lambda *args, **kwargs: {addr: (['1', '2'], []) for addr in conns}
+        handler = ServiceHandler(tracer=Tracer(), router=router, max_workers=8)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        context = mock.MagicMock()
+        context.time_remaining.return_value = 0.3
+        context.is_active.return_value = True
+        for _ in range(2):
+            status, _, _ = handler._do_query(context, 'c', collection_meta, [[0.1]] * nq,
+                                             topk, {}, partition_tags=[])
+            assert 'deadline' in status.reason
+        handler.stop()
+
+        # The searches ran out of the client deadline on ro0 alone
+        assert topo.monitor.breakers['ro0'].stats()['timeouts'] == 2
+        assert topo.monitor.breakers['ro1'].stats()['errors'] == 0
+        assert set(topo.ejected_groups) == {'ro0'}
+        assert list(topo.group_names) == ['ro1']
+
+    def test_timeout_rate_ejects(self):
+        from milvus.client.types import Status
+        from mishards.breaker import HealthMonitor
+        from mishards.connections import ConnectionTopology
+        nq, topk = 3, 5
+        searches = []
+
+        class Client(FakeConn):
+            def __init__(self, name=None, uri=None, **kwargs):
+                super().__init__(int(name[-1]) * 1000, 0.01, nq, topk)
+                self.name = name
+
+            def server_version(self, timeout=None):
+                return Status(), '0.10.0'
+
+            def search_in_segment(self, *args, **kwargs):
+                # Every other search hangs on ro0
+                future = super().search_in_segment(*args, **kwargs)
+                if self.name == 'ro0':
+                    searches.append(future)
+                    if len(searches) % 2:
+                        future.timer.cancel()
+                return future
+
+        topo = ConnectionTopology()
+        # Neither consecutive failures nor the error rate open the breaker
+        topo.monitor = HealthMonitor(topo, failures=100, error_rate=1, timeout_rate=0.5, window=4)
+        with mock.patch('mishards.connections.ChannelClient', Client):
+            topo.create_many({name: 'tcp://127.0.0.1:19530' for name in ('ro0', 'ro1')})
+        conns = {name: topo.get_group(name).get(name) for name in ('ro0', 'ro1')}
+        router = FakeRouter(conns)
+        router.routing = lambda *args, **kwargs: {addr: (['1', '2'], []) for addr in conns}
+        handler = ServiceHandler(tracer=Tracer(), router=router, max_workers=8)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        context = mock.MagicMock()
+        context.time_remaining.return_value = 0.2
+        context.is_active.return_value = True
+        statuses = []
+        for _ in range(4):
+            status, _, _ = handler._do_query(context, 'c', collection_meta, [[0.1]] * nq,
+                                             topk, {}, partition_tags=[])
+            statuses.append(status.error_code == status_pb2.SUCCESS)
+        handler.stop()
+
+        assert statuses == [False, True, False, True]
+        stats = topo.monitor.breakers['ro0'].stats()
+        assert stats['state'] == 'open' and stats['timeouts'] == 2 and stats['trips'] == 1
+        assert set(topo.ejected_groups) == {'ro0'}
+
+    def test_do_query_detached(self):
+        from mishards.service_handler import QueryScope
+        nq, topk = 3, 5
+        conns = {'ro{}'.format(i): FakeConn(i * 1000, 0.2, nq, topk) for i in range(2)}
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns), max_workers=8)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        # The client of the context went away, a detached query runs in its own scope
+        context = mock.MagicMock()
+        context.time_remaining.return_value = 0.01
+        context.is_active.return_value = False
+        status, ids, _ = handler._do_query(context, 'c', collection_meta, [[0.1]] * nq, topk, {},
+                                           partition_tags=[], scope=QueryScope(time.time() + 5),
+                                           detached=True)
+        handler.stop()
+        assert status.error_code == status_pb2.SUCCESS
+        assert len(ids) == nq * topk
+        assert all(2 < timeout <= 5 for conn in conns.values() for timeout in conn.timeouts)
+
+    def test_do_query_partial_results(self):
+        from mishards.aio_service_handler import AsyncServiceHandler
+        nq, topk = 3, 5
+
+        class FailingConn(FakeConn):
+            def search_in_segment(self, *args, **kwargs):
+                raise RuntimeError('unavailable')
+
+        conns = {'ro0': FakeConn(0, 0.01, nq, topk), 'ro1': FakeConn(1000, 2, nq, topk),
+                 'ro2': FailingConn(2000, 0, nq, topk)}
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+        for handler_class in (ServiceHandler, AsyncServiceHandler):
+            handler = handler_class(tracer=Tracer(), router=FakeRouter(conns), max_workers=8)
+            partial = handler.partial_searches.value
+            params = {'nprobe': 8, 'shard_budget_ms': 300}
+            options = handler._partial_options(params)
+            assert options == (True, 0.3) and params == {'nprobe': 8}
+            with pytest.raises(exceptions.InvalidArgumentError):
+                handler._partial_options({'shard_budget_ms': -1})
+
+            start = time.time()
+            query = (collection_meta, [[0.1]] * nq, topk, params)
+            kwargs = dict(partition_tags=[], partial_results=True, shard_budget=0.3)
+            if handler_class is ServiceHandler:
+                status, ids, _ = handler._do_query(None, 'c', *query, **kwargs)
+            else:
+                loop = asyncio.new_event_loop()
+                try:
+                    status, ids, _ = loop.run_until_complete(handler._do_query_async('c', *query, **kwargs))
+                finally:
+                    loop.close()
+            handler.stop()
+
+            assert time.time() - start < 1
+            assert status.error_code == status_pb2.SUCCESS
+            assert status.reason == 'Partial results: 2 of 3 shards missing, 4 of 6 segments'
+            assert len(ids) == nq * topk and all(i < 1000 for i in ids)
+            assert handler.partial_searches.value == partial + 1
+
+        # Without partial results a failed shard fails the search
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns, routed=['ro0', 'ro2']))
+        with pytest.raises(RuntimeError):
+            handler._do_query(None, 'c', *query, partition_tags=[])
+        # And with partial results, when no shard answered
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter(conns, routed=['ro2']))
+        status, ids, _ = handler._do_query(None, 'c', *query, partition_tags=[], partial_results=True)
+        handler.stop()
+        assert status.error_code != status_pb2.SUCCESS
+        assert status.reason == 'Partial results: 1 of 1 shards missing, 2 of 2 segments'
+
+    def test_latency_histogram(self):
+        handler = ServiceHandler(tracer=Tracer(), router=FakeRouter({}), max_workers=1)
+        histogram = handler.latency('histogram_node')
+        for i in range(1, 101):
+            histogram.observe(i / 1000.0)
+        assert histogram.percentile(50) == pytest.approx(0.05, abs=0.001)
+        assert histogram.percentile(99) == pytest.approx(0.099, abs=0.001)
+
+        reply = handler.Cmd(milvus_pb2.Command(cmd='latency'), None)
+        handler.stop()
+        stats = json.loads(reply.string_reply)['search.latency.histogram_node']
+        assert stats['count'] == 100
+        assert sum(stats['buckets'].values()) == 100
+
+    def test_do_query_async(self):
+        from mishards.aio_service_handler import AsyncServiceHandler
+        nq, topk, delay = 3, 5, 0.2
+        conns = {'ro{}'.format(i): FakeConn(i * 1000, delay, nq, topk) for i in range(5)}
+        handler = AsyncServiceHandler(tracer=Tracer(), router=FakeRouter(conns), max_workers=2)
+        collection_meta = mock.MagicMock(metric_type=MetricType.L2)
+
+        async def search_many(n):
+            return await asyncio.gather(*[
+                handler._do_query_async('c', collection_meta, [[0.1]] * nq, topk, {}, partition_tags=[])
+                for _ in range(n)])
+
+        loop = asyncio.new_event_loop()
+        start = time.time()
+        try:
+            results = loop.run_until_complete(search_many(20))
+        finally:
+            loop.close()
+            handler.stop()
+        elapsed = time.time() - start
+
+        # 20 searches over 5 shards with only 2 worker threads
+        assert elapsed < delay * 5
+        for status, ids, distances in results:
+            assert status.error_code == status_pb2.SUCCESS
+            assert len(ids) == nq * topk
+        assert all(conn.reloaded == ['1'] * 20 for conn in conns.values())
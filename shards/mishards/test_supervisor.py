@@ -0,0 +1,45 @@
+import os
+import time
+import tempfile
+from mishards.supervisor import Supervisor
+
+
+def starts(workdir, index):
+    path = os.path.join(workdir, 'started-{}'.format(index))
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return f.read().split()
+
+
+def crash_once(index):
+    marker = os.path.join(os.environ['SUPERVISOR_TEST_DIR'], 'started-{}'.format(index))
+    crashed = os.path.exists(marker)
+    with open(marker, 'a') as f:
+        f.write(os.environ['SUPERVISOR_TEST_WORKER'] + '\n')
+    if not crashed:
+        os._exit(1)
+    time.sleep(60)
+
+
+class TestSupervisor:
+    def test_restart_crashed_workers(self):
+        workdir = tempfile.mkdtemp()
+        os.environ['SUPERVISOR_TEST_DIR'] = workdir
+        supervisor = Supervisor(crash_once, 2, min_uptime=0,
+                                worker_env=lambda index: {'SUPERVISOR_TEST_WORKER': str(index)})
+        supervisor.start()
+        try:
+            deadline = time.time() + 60
+            while time.time() < deadline and \
+                    not all(len(starts(workdir, index)) == 2 for index in range(2)):
+                supervisor.poll()
+                time.sleep(0.1)
+            assert supervisor.restarts == 2
+            assert supervisor.poll() == 2
+        finally:
+            supervisor.stop(timeout=5)
+
+        assert all(not p.is_alive() for p in supervisor.processes.values())
+        for index in range(2):
+            assert starts(workdir, index) == [str(index), str(index)]
@@ -1,6 +1,7 @@
 import logging
 import threading
 import enum
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +30,11 @@ class StatusType(enum.Enum):
 
 
 class TopoGroup:
+    """Items are published copy-on-write: writers replace `items` with an
+    updated copy under `cv`, so readers take no lock and iterate or look up a
+    dict which is never modified.
+    """
+
     def __init__(self, name):
         self.name = name
         self.items = {}
@@ -44,14 +50,16 @@ class TopoGroup:
     def on_pre_add(self, topo_object):
         return True
 
-    def _add_no_lock(self, topo_object):
+    def _add_no_lock(self, topo_object, admitted=None):
         if topo_object.name in self.items:
             return StatusType.DUPLICATED
         logger.info('Adding topo_object \"{}\" into group \"{}\"'.format(topo_object, self.name))
-        ok = self.on_pre_add(topo_object)
+        ok = self.on_pre_add(topo_object) if admitted is None else admitted
         if not ok:
             return StatusType.VERSION_ERROR
-        self.items[topo_object.name] = topo_object
+        items = dict(self.items)
+        items[topo_object.name] = topo_object
+        self.items = items
         ok = self.on_added(topo_object)
         if not ok:
             self._remove_no_lock(topo_object.name)
@@ -59,8 +67,13 @@ class TopoGroup:
         return StatusType.OK if ok else StatusType.ADD_ERROR
 
     def add(self, topo_object):
+        if topo_object.name in self.items:
+            return StatusType.DUPLICATED
+        # The admission check may be slow, e.g. probe a server, and runs
+        # without holding the lock
+        admitted = self.on_pre_add(topo_object)
         with self.cv:
-            return self._add_no_lock(topo_object)
+            return self._add_no_lock(topo_object, admitted=admitted)
 
     def __len__(self):
         return len(self.items)
@@ -73,17 +86,65 @@ class TopoGroup:
 
     def _remove_no_lock(self, name):
         logger.info('Removing topo_object \"{}\" from group \"{}\"'.format(name, self.name))
-        return self.items.pop(name, None)
+        items = dict(self.items)
+        topo_object = items.pop(name, None)
+        self.items = items
+        return topo_object
 
     def remove(self, name):
         with self.cv:
             return self._remove_no_lock(name)
 
 
+TopologySnapshot = namedtuple('TopologySnapshot', ['generation', 'groups', 'draining', 'ejected'])
+
+
 class Topology:
+    """Groups are routable once added. A group can also be added as joining,
+    which keeps it out of `group_names` until it is admitted, and a routable
+    group can be set draining, which removes it from `group_names` while
+    `get_group` still finds it for the requests in flight. An unhealthy
+    group can be ejected, which takes it out of `group_names` as well until
+    it is reinstated.
+
+    The routable, draining and ejected groups and the generation are published
+    together as an immutable `snapshot`. Writers build the next snapshot
+    under `cv` and swap it in with a single assignment, so readers never
+    lock and never see a half-updated topology. A request should read
+    `snapshot` once and use it throughout.
+    """
+
     def __init__(self):
-        self.topo_groups = {}
+        self.joining_groups = {}
         self.cv = threading.Condition()
+        # The generation is bumped on every change of the routable groups.
+        # Readers can key derived state, e.g. hash rings, on it instead of
+        # rebuilding it per request
+        self.snapshot = TopologySnapshot(0, {}, {}, {})
+
+    @property
+    def topo_groups(self):
+        return self.snapshot.groups
+
+    @property
+    def draining_groups(self):
+        return self.snapshot.draining
+
+    @property
+    def ejected_groups(self):
+        return self.snapshot.ejected
+
+    @property
+    def generation(self):
+        return self.snapshot.generation
+
+    def _publish_no_lock(self, groups=None, draining=None, ejected=None):
+        snapshot = self.snapshot
+        self.snapshot = TopologySnapshot(
+            snapshot.generation + (groups is not None),
+            snapshot.groups if groups is None else groups,
+            snapshot.draining if draining is None else draining,
+            snapshot.ejected if ejected is None else ejected)
 
     def on_duplicated_group(self, group):
         # logger.warning('Duplicated group \"{}\" found!'.format(group))
@@ -98,15 +159,25 @@ class Topology:
         return StatusType.OK
 
     def get_group(self, name):
-        return self.topo_groups.get(name, None)
+        snapshot = self.snapshot
+        group = snapshot.groups.get(name, None)
+        if group is None:
+            group = snapshot.draining.get(name, None)
+        if group is None:
+            group = snapshot.ejected.get(name, None)
+        return group
 
     def has_group(self, group):
         key = group if isinstance(group, str) else group.name
-        return key in self.topo_groups
+        snapshot = self.snapshot
+        return key in snapshot.groups or key in self.joining_groups or key in snapshot.draining \
+            or key in snapshot.ejected
 
     def _add_group_no_lock(self, group):
         logger.info('Adding group \"{}\"'.format(group))
-        self.topo_groups[group.name] = group
+        groups = dict(self.snapshot.groups)
+        groups[group.name] = group
+        self._publish_no_lock(groups=groups)
 
     def add_group(self, group):
         self.on_pre_add_group(group)
@@ -116,6 +187,97 @@ class Topology:
             self._add_group_no_lock(group)
         return self.on_post_add_group(group)
 
+    def add_groups(self, groups):
+        """Adds `groups` at once, bumping the generation a single time.
+        Returns the status of every group by name.
+        """
+        statuses = {}
+        added = []
+        with self.cv:
+            topo_groups = dict(self.snapshot.groups)
+            for group in groups:
+                self.on_pre_add_group(group)
+                if self.has_group(group) or group.name in topo_groups:
+                    statuses[group.name] = self.on_duplicated_group(group)
+                    continue
+                logger.info('Adding group \"{}\"'.format(group))
+                topo_groups[group.name] = group
+                added.append(group)
+            if added:
+                self._publish_no_lock(groups=topo_groups)
+        for group in added:
+            statuses[group.name] = self.on_post_add_group(group)
+        return statuses
+
+    def join_group(self, group):
+        """Adds `group` without making it routable, see `admit_group`.
+        """
+        self.on_pre_add_group(group)
+        with self.cv:
+            if self.has_group(group):
+                return self.on_duplicated_group(group)
+            logger.info('Group \"{}\" is joining'.format(group))
+            joining_groups = dict(self.joining_groups)
+            joining_groups[group.name] = group
+            self.joining_groups = joining_groups
+        return StatusType.OK
+
+    def admit_group(self, name):
+        with self.cv:
+            joining_groups = dict(self.joining_groups)
+            group = joining_groups.pop(name, None)
+            if group is None:
+                return None
+            self.joining_groups = joining_groups
+            self._add_group_no_lock(group)
+        self.on_post_add_group(group)
+        return group
+
+    def drain_group(self, name):
+        """Takes a routable group out of `group_names`, it is still found by
+        `get_group` until it is deleted.
+        """
+        with self.cv:
+            groups = dict(self.snapshot.groups)
+            group = groups.pop(name, None)
+            if group is None:
+                return None
+            logger.info('Group \"{}\" is draining'.format(name))
+            draining = dict(self.snapshot.draining)
+            draining[name] = group
+            self._publish_no_lock(groups=groups, draining=draining)
+        return group
+
+    def eject_group(self, name):
+        """Takes a routable group out of `group_names` until `reinstate_group`,
+        its files are routed to the other groups meanwhile. The last routable
+        group is never ejected.
+        """
+        with self.cv:
+            snapshot = self.snapshot
+            if name not in snapshot.groups or len(snapshot.groups) <= 1:
+                return None
+            groups = dict(snapshot.groups)
+            group = groups.pop(name)
+            logger.warning('Group \"{}\" is ejected'.format(name))
+            ejected = dict(snapshot.ejected)
+            ejected[name] = group
+            self._publish_no_lock(groups=groups, ejected=ejected)
+        return group
+
+    def reinstate_group(self, name):
+        with self.cv:
+            snapshot = self.snapshot
+            if name not in snapshot.ejected:
+                return None
+            ejected = dict(snapshot.ejected)
+            group = ejected.pop(name)
+            logger.info('Group \"{}\" is reinstated'.format(name))
+            groups = dict(snapshot.groups)
+            groups[name] = group
+            self._publish_no_lock(groups=groups, ejected=ejected)
+        return group
+
     def on_delete_not_existed_group(self, group):
         # logger.warning('Deleting non-existed group \"{}\"'.format(group))
         pass
@@ -131,16 +293,38 @@ class Topology:
     def _delete_group_no_lock(self, group):
         logger.info('Deleting group \"{}\"'.format(group))
         delete_key = group if isinstance(group, str) else group.name
-        return self.topo_groups.pop(delete_key, None)
+        snapshot = self.snapshot
+        if delete_key in snapshot.groups:
+            groups = dict(snapshot.groups)
+            deleted_group = groups.pop(delete_key)
+            self._publish_no_lock(groups=groups)
+            return deleted_group
+        if delete_key in snapshot.draining:
+            draining = dict(snapshot.draining)
+            deleted_group = draining.pop(delete_key)
+            self._publish_no_lock(draining=draining)
+            return deleted_group
+        if delete_key in snapshot.ejected:
+            ejected = dict(snapshot.ejected)
+            deleted_group = ejected.pop(delete_key)
+            self._publish_no_lock(ejected=ejected)
+            return deleted_group
+        if delete_key in self.joining_groups:
+            joining_groups = dict(self.joining_groups)
+            deleted_group = joining_groups.pop(delete_key)
+            self.joining_groups = joining_groups
+            return deleted_group
+        return None
 
     def delete_group(self, group):
         self.on_pre_delete_group(group)
         with self.cv:
             deleted_group = self._delete_group_no_lock(group)
-        if not deleted_group:
+        # An empty group is falsy as well
+        if deleted_group is None:
             return self.on_delete_not_existed_group(group)
         return self.on_post_delete_group(group)
 
     @property
     def group_names(self):
-        return self.topo_groups.keys()
+        return self.snapshot.groups.keys()
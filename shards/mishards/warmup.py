@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+from mishards.metrics import REGISTRY
+from mishards.router.versions import filter_file_to_update, stale_files
+
+logger = logging.getLogger(__name__)
+
+
+class NodeWarmer:
+    """Warms read-only nodes up before the routing changes.
+
+    A joining node is asked to load the segments it will own once it is part
+    of the ring, and is only then admitted. Before a node leaves, the nodes
+    taking over its segments load them, the node is taken out of the ring and
+    deleted once its requests in flight finished.
+
+    Segments are recorded in the file version table once a node loaded
+    them, segments it loaded already are skipped. A node which does not
+    finish warming up within `timeout` seconds is admitted anyway, the
+    segments it did not load are then reloaded by its first searches.
+    """
+
+    def __init__(self, router, timeout=300, drain_timeout=30, batch_size=64):
+        self.router = router
+        self.timeout = timeout
+        self.drain_timeout = drain_timeout
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.joining = set()
+        self.draining = set()
+        self.segments = REGISTRY.counter('warmup.segments')
+        self.errors = REGISTRY.counter('warmup.errors')
+        self.latency = REGISTRY.histogram('warmup.latency')
+        REGISTRY.gauge('warmup.joining', func=lambda: len(self.joining))
+        REGISTRY.gauge('warmup.draining', func=lambda: len(self.draining))
+
+    def _start(self, target, name, *args):
+        thread = threading.Thread(target=target, args=(name,) + args,
+                                  name='warmup-{}'.format(name), daemon=True)
+        thread.start()
+        return thread
+
+    def join(self, topo, name):
+        with self.lock:
+            if name in self.joining:
+                return None
+            self.joining.add(name)
+        return self._start(self._join, name, topo)
+
+    def drain(self, topo, name):
+        with self.lock:
+            if name in self.draining:
+                return None
+            self.draining.add(name)
+        return self._start(self._drain, name, topo)
+
+    def warm(self, topo, names, hosts, deadline, conns=None):
+        """Loads on every node of `hosts` the segments it would own if the
+        read-only nodes were `names`, and which it was not asked to load yet.
+        """
+        placement = self.router.placement(names)
+        for host, collections in placement.items():
+            if host not in hosts:
+                continue
+            conn = (conns or {}).get(host, None)
+            if conn is None:
+                group = topo.get_group(host)
+                conn = group.get(host) if group is not None else None
+            if conn is None:
+                continue
+            for collection_name, files in collections.items():
+                update_times = dict(files)
+                ud_file_ids = stale_files(host, files)
+                for begin in range(0, len(ud_file_ids), self.batch_size):
+                    if time.time() > deadline:
+                        logger.warning('Warming up {} timed out'.format(host))
+                        return False
+                    batch = ud_file_ids[begin:begin + self.batch_size]
+                    try:
+                        conn.reload_segments(collection_name, batch)
+                    except Exception as exc:
+                        self.errors.inc()
+                        logger.error('<{}> loading {} segments of {} failed: {}'.format(
+                            host, len(batch), collection_name, exc))
+                        continue
+                    filter_file_to_update(host, [(file_id, update_times[file_id]) for file_id in batch])
+                    self.segments.inc(len(batch))
+        return True
+
+    def _join(self, name, topo):
+        started = time.time()
+        try:
+            group = topo.joining_groups.get(name, None)
+            if group is None:
+                return
+            names = list(topo.group_names) + [name]
+            self.warm(topo, names, [name], started + self.timeout, conns={name: group.get(name)})
+        except Exception as exc:
+            self.errors.inc()
+            logger.error('Warming up {} failed: {}'.format(name, exc))
+        finally:
+            with self.lock:
+                self.joining.discard(name)
+            self.latency.observe(time.time() - started)
+            if topo.admit_group(name) is not None:
+                logger.info('{} joined after warming up for {:.1f}s'.format(name, time.time() - started))
+
+    def _drain(self, name, topo):
+        started = time.time()
+        try:
+            names = [host for host in topo.group_names if host != name]
+            if names:
+                self.warm(topo, names, names, started + self.timeout)
+        except Exception as exc:
+            self.errors.inc()
+            logger.error('Warming up the successors of {} failed: {}'.format(name, exc))
+
+        group = topo.drain_group(name)
+        deadline = time.time() + self.drain_timeout
+        while group is not None and group.inflight() and time.time() < deadline:
+            time.sleep(0.1)
+        with self.lock:
+            self.draining.discard(name)
+        topo.delete_group(name)
+        logger.info('{} left after draining for {:.1f}s'.format(name, time.time() - started))